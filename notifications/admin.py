@@ -1,12 +1,12 @@
 from django.contrib import admin
 from django.utils.html import format_html
 from django.urls import reverse
-from .models import Notification, NotificationType
+from .models import EmailJob, Notification, NotificationCounter, NotificationDelivery, NotificationPreference, NotificationType
 
 
 @admin.register(NotificationType)
 class NotificationTypeAdmin(admin.ModelAdmin):
-    list_display = ['codigo', 'nombre', 'enviar_a_cliente', 'enviar_a_tecnico', 'enviar_a_admin', 'es_activo']
+    list_display = ['codigo', 'nombre', 'enviar_a_cliente', 'enviar_a_tecnico', 'enviar_a_admin', 'dias_retencion', 'es_activo']
     list_filter = ['es_activo', 'enviar_a_cliente', 'enviar_a_tecnico', 'enviar_a_admin']
     search_fields = ['codigo', 'nombre', 'descripcion']
     readonly_fields = ['codigo']
@@ -18,6 +18,10 @@ class NotificationTypeAdmin(admin.ModelAdmin):
         ('Configuración de Destinatarios', {
             'fields': ('enviar_a_cliente', 'enviar_a_tecnico', 'enviar_a_admin'),
         }),
+        ('Retención', {
+            'fields': ('dias_retencion',),
+            'description': 'Días que se conservan las notificaciones leídas. Vacío usa el valor global; 0 las conserva siempre.',
+        }),
     )
 
 
@@ -64,4 +68,39 @@ class NotificationAdmin(admin.ModelAdmin):
         """Optimiza las consultas con select_related."""
         return super().get_queryset(request).select_related(
             'usuario', 'tipo', 'ticket'
-        )
\ No newline at end of file
+        )
+
+
+@admin.register(EmailJob)
+class EmailJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'destinatario', 'asunto', 'estado', 'grupo', 'intentos', 'proximo_intento', 'proveedor', 'fecha_envio']
+    list_filter = ['estado', 'proveedor']
+    raw_id_fields = ['ticket']
+    search_fields = ['destinatario', 'asunto']
+    readonly_fields = ['fecha_creacion', 'fecha_envio', 'bloqueado_hasta', 'proveedor', 'ultimo_error']
+    date_hierarchy = 'fecha_creacion'
+
+
+@admin.register(NotificationPreference)
+class NotificationPreferenceAdmin(admin.ModelAdmin):
+    list_display = ['usuario', 'frecuencia_email', 'fecha_actualizacion']
+    list_filter = ['frecuencia_email']
+    search_fields = ['usuario__email', 'usuario__document']
+    raw_id_fields = ['usuario']
+
+
+@admin.register(NotificationCounter)
+class NotificationCounterAdmin(admin.ModelAdmin):
+    list_display = ['usuario', 'total', 'pendientes', 'enviadas', 'leidas', 'fallidas']
+    search_fields = ['usuario__email', 'usuario__document']
+    raw_id_fields = ['usuario']
+    readonly_fields = ['total', 'pendientes', 'enviadas', 'leidas', 'fallidas']
+
+
+@admin.register(NotificationDelivery)
+class NotificationDeliveryAdmin(admin.ModelAdmin):
+    list_display = ['notificacion', 'usuario', 'estado', 'fecha_creacion', 'fecha_lectura']
+    list_filter = ['estado']
+    search_fields = ['usuario__email', 'usuario__document', 'notificacion__titulo']
+    raw_id_fields = ['notificacion', 'usuario']
+    date_hierarchy = 'fecha_creacion'
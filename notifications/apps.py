@@ -11,6 +11,16 @@ class NotificationsConfig(AppConfig):
         Método que se ejecuta cuando la aplicación está lista.
         Aquí se pueden registrar signals y otras configuraciones.
         """
+        from django.db.models.signals import post_delete, post_migrate, post_save
+
+        from .models import NotificationType
+        from .registry import invalidar_tipo, sincronizar_tipos
+
+        # Registro de tipos: sincronizar tras migrar e invalidar al editarlos
+        post_migrate.connect(sincronizar_tipos, sender=self)
+        post_save.connect(invalidar_tipo, sender=NotificationType)
+        post_delete.connect(invalidar_tipo, sender=NotificationType)
+
         # Importar signals para que se registren automáticamente
         try:
             import notifications.signals
@@ -73,6 +73,20 @@ class NotificationConfig:
             'enviar_a_cliente': False,
             'enviar_a_tecnico': True,
             'enviar_a_admin': False,
+        },
+        'ticket_cerrado': {
+            'nombre': 'Ticket Cerrado',
+            'descripcion': 'Notificación cuando se aprueba el cierre de un ticket',
+            'enviar_a_cliente': True,
+            'enviar_a_tecnico': True,
+            'enviar_a_admin': False,
+        },
+        'ticket_cancelado': {
+            'nombre': 'Ticket Cancelado',
+            'descripcion': 'Notificación cuando se cancela un ticket',
+            'enviar_a_cliente': True,
+            'enviar_a_tecnico': True,
+            'enviar_a_admin': True,
         }
     }
     
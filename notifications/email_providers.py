@@ -0,0 +1,402 @@
+"""
+Proveedores de envío de correo usados por la cola de emails.
+
+Los envíos reciben EmailJob ya renderizados y reportan el error de cada uno;
+los reintentos los gestiona la cola (ver email_queue). Por SMTP, los correos
+de un lote comparten una conexión del pool en lugar de abrir una por mensaje.
+"""
+import http.client
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from html import escape
+from smtplib import (
+    SMTPConnectError, SMTPException, SMTPRecipientsRefused, SMTPResponseException, SMTPSenderRefused,
+    SMTPServerDisconnected,
+)
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+
+from . import resilience
+from .resilience import EnvioOmitido, ProveedorNoDisponible
+
+logger = logging.getLogger(__name__)
+
+PROVEEDOR_SENDGRID = 'sendgrid'
+PROVEEDOR_SMTP = 'smtp'
+
+
+# Máximo de personalizations que acepta SendGrid en una sola petición
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+
+
+def sendgrid_habilitado() -> bool:
+    return bool(getattr(settings, "SENDGRID_API_KEY", ""))
+
+
+class SendGridError(Exception):
+    def __init__(self, status, cuerpo):
+        super().__init__(f"SendGrid respondió {status}: {cuerpo[:500]}")
+        self.status = status
+
+
+class SendGridClient:
+    """
+    Cliente HTTP mínimo para POST /v3/mail/send que mantiene viva la conexión
+    (keep-alive) entre envíos en lugar de abrir una por correo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conexion = None
+        self._host = None
+
+    def _obtener_conexion(self):
+        host = getattr(settings, "SENDGRID_API_HOST", "https://api.sendgrid.com")
+        if self._conexion is None or self._host != host:
+            self.cerrar()
+            url = urlsplit(host)
+            clase = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+            self._conexion = clase(url.netloc, timeout=getattr(settings, "EMAIL_TIMEOUT", 30))
+            self._host = host
+        return self._conexion
+
+    def cerrar(self):
+        if self._conexion is not None:
+            self._conexion.close()
+            self._conexion = None
+
+    def enviar(self, payload: dict) -> int:
+        cuerpo = json.dumps(payload).encode('utf-8')
+        headers = {
+            'Authorization': f"Bearer {getattr(settings, 'SENDGRID_API_KEY', '')}",
+            'Content-Type': 'application/json',
+        }
+        with self._lock:
+            for intento in range(2):
+                conexion = self._obtener_conexion()
+                try:
+                    conexion.request('POST', '/v3/mail/send', body=cuerpo, headers=headers)
+                    respuesta = conexion.getresponse()
+                    contenido = respuesta.read()
+                except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                        BrokenPipeError, ConnectionResetError):
+                    # El servidor cerró la conexión inactiva: reconectar una sola vez
+                    self.cerrar()
+                    if intento:
+                        raise
+                    continue
+                except Exception:
+                    self.cerrar()
+                    raise
+                if respuesta.status >= 400:
+                    raise SendGridError(respuesta.status, contenido.decode('utf-8', 'replace'))
+                return respuesta.status
+
+
+sendgrid_client = SendGridClient()
+
+
+def _token_texto(token: str) -> str:
+    # Variante del token para la parte de texto plano (no contiene al original)
+    return f"{token[:-1]}_texto{token[-1:]}"
+
+
+def _payload_sendgrid(jobs) -> dict:
+    """
+    Una petición para varios destinatarios del mismo contenido, con sus sustituciones.
+    SendGrid aplica las sustituciones a todas las partes: la de texto plano usa
+    tokens propios con el valor sin escapar y la HTML el valor escapado.
+    """
+    modelo = jobs[0]
+    personalizations = []
+    for job in jobs:
+        personalization = {'to': [{'email': job.destinatario}]}
+        if job.sustituciones:
+            personalization['substitutions'] = {}
+            for token, valor in job.sustituciones.items():
+                personalization['substitutions'][_token_texto(token)] = str(valor)
+                personalization['substitutions'][token] = escape(valor)
+        personalizations.append(personalization)
+
+    texto = modelo.cuerpo_texto
+    for token in modelo.sustituciones or {}:
+        texto = texto.replace(token, _token_texto(token))
+    contenido = [{'type': 'text/plain', 'value': texto}]
+    if modelo.cuerpo_html:
+        contenido.append({'type': 'text/html', 'value': modelo.cuerpo_html})
+    return {
+        'personalizations': personalizations,
+        'from': {'email': getattr(
+            settings,
+            "SENDGRID_FROM_EMAIL",
+            getattr(settings, "DEFAULT_FROM_EMAIL", "noreply@tickethelp.com"),
+        )},
+        'subject': modelo.asunto,
+        'content': contenido,
+    }
+
+
+def enviar_grupo_sendgrid(jobs):
+    """Envía con una sola llamada a SendGrid un grupo de correos con el mismo contenido."""
+    status = sendgrid_client.enviar(_payload_sendgrid(jobs))
+    logger.info(f"SendGrid email enviado a {len(jobs)} destinatarios (status {status})")
+
+
+def _clave_contenido(job):
+    return (job.asunto, job.cuerpo_texto, job.cuerpo_html, tuple(sorted(job.sustituciones or {})))
+
+
+def agrupar_por_contenido(indices, jobs) -> list:
+    """Agrupa (conservando el orden) los índices de trabajos con idéntico contenido."""
+    grupos = {}
+    for i in indices:
+        grupos.setdefault(_clave_contenido(jobs[i]), []).append(i)
+    resultado = []
+    for grupo in grupos.values():
+        for inicio in range(0, len(grupo), SENDGRID_MAX_PERSONALIZATIONS):
+            resultado.append(grupo[inicio:inicio + SENDGRID_MAX_PERSONALIZATIONS])
+    return resultado
+
+
+class SMTPConnectionPool:
+    """
+    Mantiene abiertas (y autenticadas) conexiones SMTP para reutilizarlas entre
+    correos del mismo lote y entre lotes del worker. Las conexiones libres se
+    guardan en orden LIFO y se descartan si superan el tiempo de inactividad.
+    """
+
+    def __init__(self, max_conexiones: int, max_inactividad: float):
+        self.max_conexiones = max_conexiones
+        self.max_inactividad = max_inactividad
+        self._libres = []
+        self._lock = threading.Lock()
+
+    def _nueva_conexion(self):
+        conexion = get_connection(timeout=getattr(settings, "EMAIL_TIMEOUT", 30), fail_silently=False)
+        conexion.open()
+        return conexion
+
+    @staticmethod
+    def _cerrar(conexion):
+        try:
+            conexion.close()
+        except Exception:
+            pass
+
+    def adquirir(self):
+        ahora = time.monotonic()
+        with self._lock:
+            while self._libres:
+                conexion, ultimo_uso = self._libres.pop()
+                if ahora - ultimo_uso <= self.max_inactividad:
+                    return conexion
+                self._cerrar(conexion)
+        return self._nueva_conexion()
+
+    def liberar(self, conexion):
+        with self._lock:
+            if len(self._libres) < self.max_conexiones:
+                self._libres.append((conexion, time.monotonic()))
+                return
+        self._cerrar(conexion)
+
+    @contextmanager
+    def conexion(self):
+        conexion = self.adquirir()
+        try:
+            yield conexion
+        except Exception:
+            self._cerrar(conexion)
+            raise
+        self.liberar(conexion)
+
+    def enviar(self, conexion, mensajes) -> int:
+        """
+        Envía los mensajes por la conexión; si el servidor la cerró (por
+        inactividad o límite de mensajes) reconecta una vez y reintenta.
+        """
+        try:
+            return conexion.send_messages(mensajes)
+        except SMTPServerDisconnected:
+            logger.info("Conexión SMTP cerrada por el servidor, reconectando")
+            self._cerrar(conexion)
+            conexion.open()
+            return conexion.send_messages(mensajes)
+
+    def cerrar_todas(self):
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for conexion, _ in libres:
+            self._cerrar(conexion)
+
+
+smtp_pool = SMTPConnectionPool(
+    max_conexiones=getattr(settings, "EMAIL_SMTP_POOL_SIZE", 2),
+    max_inactividad=getattr(settings, "EMAIL_SMTP_POOL_IDLE_SECONDS", 60),
+)
+
+
+def aplicar_sustituciones(texto: str, sustituciones: dict, html: bool = False) -> str:
+    for token, valor in (sustituciones or {}).items():
+        texto = texto.replace(token, escape(valor) if html else valor)
+    return texto
+
+
+def construir_mensaje(job) -> EmailMultiAlternatives:
+    email = EmailMultiAlternatives(
+        subject=job.asunto,
+        body=aplicar_sustituciones(job.cuerpo_texto, job.sustituciones),
+        from_email=getattr(settings, "DEFAULT_FROM_EMAIL", "noreply@tickethelp.com"),
+        to=[job.destinatario],
+    )
+    if job.cuerpo_html:
+        email.attach_alternative(aplicar_sustituciones(job.cuerpo_html, job.sustituciones, html=True), "text/html")
+    return email
+
+
+def enviar_con_smtp(job, conexion):
+    """Envío usando una conexión SMTP del pool."""
+    smtp_pool.enviar(conexion, [construir_mensaje(job)])
+    logger.info(f"SMTP email enviado exitosamente a {job.destinatario}")
+
+
+def _es_fallo_smtp(error) -> bool:
+    """
+    Errores que indican que el servidor no está disponible: conexión caída o
+    rechazada, errores de red y timeouts, y respuestas transitorias 4xx (421:
+    servicio no disponible). Un 5xx permanente de un mensaje (p. ej.
+    SMTPDataError 550/552 por su contenido) o el rechazo de un destinatario o
+    remitente afectan solo a ese correo y no cuentan para el circuito.
+    """
+    if isinstance(error, (SMTPServerDisconnected, SMTPConnectError)):
+        return True
+    if isinstance(error, (SMTPRecipientsRefused, SMTPSenderRefused)):
+        return False
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, OSError) and not isinstance(error, SMTPException)
+
+
+def _es_limite_smtp(error) -> bool:
+    # 421/450/451/452: el servidor pide bajar el ritmo
+    return isinstance(error, SMTPResponseException) and error.smtp_code in (421, 450, 451, 452)
+
+
+def _es_fallo_sendgrid(error) -> bool:
+    if isinstance(error, SendGridError):
+        return error.status >= 500
+    return True
+
+
+_sin_email_host_avisado = False
+
+
+def _avisar_sin_email_host():
+    global _sin_email_host_avisado
+    if not _sin_email_host_avisado:
+        _sin_email_host_avisado = True
+        logger.warning("Configuración de EMAIL_HOST no encontrada, saltando envíos SMTP")
+
+
+def enviar_lote_smtp(jobs) -> list:
+    """
+    Envía varios correos reutilizando una sola conexión SMTP del pool.
+    Retorna una lista paralela a `jobs` con None o la excepción de cada envío.
+    Si el circuito SMTP está abierto o se agota la cuota, los correos restantes
+    se devuelven con ProveedorNoDisponible sin intentarse; sin EMAIL_HOST, todos
+    con EnvioOmitido.
+    """
+    if not jobs:
+        return []
+    if not getattr(settings, "EMAIL_HOST", None):
+        _avisar_sin_email_host()
+        return [EnvioOmitido("Configuración de EMAIL_HOST no encontrada, envío SMTP omitido")] * len(jobs)
+
+    circuito = resilience.circuitos[PROVEEDOR_SMTP]
+    limite = resilience.limites[PROVEEDOR_SMTP]
+    errores = []
+    try:
+        circuito.verificar()
+        with smtp_pool.conexion() as conexion:
+            for job in jobs:
+                try:
+                    if errores:
+                        circuito.verificar()
+                    if not limite.adquirir(1, resilience.EMAIL_RATE_MAX_WAIT):
+                        circuito.liberar_prueba()
+                        raise ProveedorNoDisponible("Cuota de envío SMTP agotada", limite.espera_para(1))
+                    enviar_con_smtp(job, conexion)
+                except ProveedorNoDisponible as e:
+                    errores.append(e)
+                    continue
+                except Exception as e:
+                    errores.append(e)
+                    if _es_limite_smtp(e):
+                        limite.penalizar()
+                    if _es_fallo_smtp(e):
+                        circuito.registrar_fallo()
+                    else:
+                        circuito.registrar_exito()
+                    continue
+                circuito.registrar_exito()
+                limite.recuperar()
+                errores.append(None)
+    except Exception as e:
+        # No se pudo abrir la conexión: todo el resto del lote falla con el mismo error
+        if not isinstance(e, ProveedorNoDisponible):
+            circuito.registrar_fallo()
+        errores.extend([e] * (len(jobs) - len(errores)))
+    return errores
+
+
+def enviar_lote(jobs) -> list:
+    """
+    Envía un lote de correos con SendGrid si hay API key configurada (usando
+    SMTP como respaldo para los que fallen) o directamente por SMTP. Con
+    SendGrid, los correos de igual contenido salen en una sola petición; si su
+    circuito está abierto o se agotó su cuota, el grupo va directo a SMTP.
+    Retorna una lista paralela a `jobs` de tuplas (proveedor, error).
+    """
+    resultados = [None] * len(jobs)
+    pendientes_smtp = list(range(len(jobs)))
+
+    if sendgrid_habilitado():
+        circuito = resilience.circuitos[PROVEEDOR_SENDGRID]
+        limite = resilience.limites[PROVEEDOR_SENDGRID]
+        pendientes_smtp = []
+        for grupo in agrupar_por_contenido(range(len(jobs)), jobs):
+            if not circuito.permitir():
+                pendientes_smtp.extend(grupo)
+                continue
+            if not limite.adquirir(len(grupo), resilience.EMAIL_RATE_MAX_WAIT):
+                circuito.liberar_prueba()
+                pendientes_smtp.extend(grupo)
+                continue
+            try:
+                enviar_grupo_sendgrid([jobs[i] for i in grupo])
+            except Exception as e:
+                logger.warning(f"Error enviando con SendGrid a {len(grupo)} destinatarios, usando SMTP: {e}")
+                if isinstance(e, SendGridError) and e.status == 429:
+                    limite.penalizar()
+                    circuito.registrar_exito()
+                elif _es_fallo_sendgrid(e):
+                    circuito.registrar_fallo()
+                else:
+                    circuito.registrar_exito()
+                pendientes_smtp.extend(grupo)
+                continue
+            circuito.registrar_exito()
+            limite.recuperar()
+            for i in grupo:
+                resultados[i] = (PROVEEDOR_SENDGRID, None)
+        pendientes_smtp.sort()
+
+    errores = enviar_lote_smtp([jobs[i] for i in pendientes_smtp])
+    for i, error in zip(pendientes_smtp, errores):
+        resultados[i] = (PROVEEDOR_SMTP, error)
+    return resultados
@@ -0,0 +1,301 @@
+"""
+Cola persistente de correos.
+
+Las notificaciones encolan un EmailJob ya renderizado; el comando
+`run_email_worker` reclama lotes de trabajos y los envía. El reclamo usa
+SELECT ... FOR UPDATE SKIP LOCKED cuando la base de datos lo soporta
+(PostgreSQL) y, si no (SQLite), un UPDATE condicional por fila, así que
+varios workers pueden ejecutarse a la vez sin enviar dos veces el mismo correo.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Min, Q
+from django.utils import timezone
+
+from . import email_providers
+from .email_templates import renderizar
+from .models import EmailJob, NotificationPreference
+from .resilience import EnvioOmitido, ProveedorNoDisponible
+
+logger = logging.getLogger(__name__)
+
+EMAIL_QUEUE_BATCH_SIZE = getattr(settings, 'EMAIL_QUEUE_BATCH_SIZE', 20)
+EMAIL_QUEUE_MAX_ATTEMPTS = getattr(settings, 'EMAIL_QUEUE_MAX_ATTEMPTS', 5)
+# Tiempo que un worker reserva un trabajo; si muere, otro lo retoma al vencer
+EMAIL_QUEUE_LEASE_SECONDS = getattr(settings, 'EMAIL_QUEUE_LEASE_SECONDS', 300)
+EMAIL_QUEUE_RETRY_BASE_SECONDS = getattr(settings, 'EMAIL_QUEUE_RETRY_BASE_SECONDS', 30)
+EMAIL_QUEUE_RETRY_MAX_SECONDS = getattr(settings, 'EMAIL_QUEUE_RETRY_MAX_SECONDS', 3600)
+# Hora local de envío de los resúmenes diarios
+EMAIL_DIGEST_HOUR = getattr(settings, 'EMAIL_DIGEST_HOUR', 8)
+
+
+def _grupo_y_plazo(frecuencia, ticket_id, ahora):
+    """
+    Retorna (grupo, proximo_intento) para un correo nuevo según la preferencia
+    del destinatario: resumen horario/diario, ventana de agrupación por ticket
+    o envío inmediato (grupo vacío).
+    """
+    if frecuencia == NotificationPreference.Frecuencia.DIARIA:
+        local = timezone.localtime(ahora)
+        plazo = local.replace(hour=EMAIL_DIGEST_HOUR, minute=0, second=0, microsecond=0)
+        if plazo <= local:
+            plazo += timedelta(days=1)
+        return 'resumen:diario', plazo
+    if frecuencia == NotificationPreference.Frecuencia.HORARIA:
+        return 'resumen:horario', (ahora + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+
+    ventana = getattr(settings, 'EMAIL_COALESCE_WINDOW_SECONDS', 0)
+    if ventana and ticket_id:
+        return f'ticket:{ticket_id}', ahora + timedelta(seconds=ventana)
+    return '', ahora
+
+
+def _programar(jobs, frecuencias: dict = None):
+    """
+    Asigna grupo y hora de envío a correos sin guardar. Si ya hay un correo
+    pendiente del mismo destinatario y grupo, el nuevo se une a su plazo para
+    que el worker los reclame y envíe juntos.
+    """
+    ahora = timezone.now()
+    frecuencias = frecuencias or {}
+    for job in jobs:
+        job.asunto = job.asunto[:255]
+        job.max_intentos = EMAIL_QUEUE_MAX_ATTEMPTS
+        job.grupo, job.proximo_intento = _grupo_y_plazo(frecuencias.get(job.destinatario), job.ticket_id, ahora)
+
+    agrupables = [job for job in jobs if job.grupo]
+    if not agrupables:
+        return
+    plazos = {
+        (fila['destinatario'], fila['grupo']): fila['plazo']
+        for fila in EmailJob.objects.filter(
+            estado=EmailJob.Estado.PENDIENTE,
+            intentos=0,
+            proximo_intento__gt=ahora,
+            destinatario__in={job.destinatario for job in agrupables},
+            grupo__in={job.grupo for job in agrupables},
+        ).values('destinatario', 'grupo').annotate(plazo=Min('proximo_intento'))
+    }
+    for job in agrupables:
+        job.proximo_intento = plazos.get((job.destinatario, job.grupo), job.proximo_intento)
+
+
+def encolar_email(destinatario: str, asunto: str, cuerpo_texto: str, cuerpo_html: str = '',
+                  sustituciones: dict = None, ticket=None, titulo: str = '', mensaje: str = '',
+                  frecuencia: str = None) -> EmailJob:
+    """Guarda un correo para que lo envíe el worker."""
+    job = EmailJob(
+        destinatario=destinatario,
+        asunto=asunto,
+        cuerpo_texto=cuerpo_texto,
+        cuerpo_html=cuerpo_html,
+        sustituciones=sustituciones or {},
+        ticket=ticket,
+        titulo=titulo[:200],
+        mensaje=mensaje,
+    )
+    _programar([job], {destinatario: frecuencia} if frecuencia else None)
+    job.save()
+    return job
+
+
+def encolar_emails(jobs: list, frecuencias: dict = None) -> list:
+    """
+    Guarda varios EmailJob (sin guardar) con un solo INSERT. `frecuencias`
+    mapea email → NotificationPreference.Frecuencia para los destinatarios
+    que prefieren resúmenes.
+    """
+    _programar(jobs, frecuencias)
+    return EmailJob.objects.bulk_create(jobs)
+
+
+def _filtro_disponibles(ahora):
+    # Pendientes cuya hora llegó, o reservados por un worker que no terminó a tiempo
+    # y que aún tienen intentos
+    return (
+        Q(estado=EmailJob.Estado.PENDIENTE, proximo_intento__lte=ahora) |
+        Q(estado=EmailJob.Estado.PROCESANDO, bloqueado_hasta__lt=ahora, intentos__lt=F('max_intentos'))
+    )
+
+
+def _descartar_reservas_agotadas(ahora) -> int:
+    """
+    Marca como fallidos los trabajos cuya reserva venció sin intentos restantes:
+    el worker murió en cada intento, así que no se vuelven a reclamar.
+    """
+    descartados = EmailJob.objects.filter(
+        estado=EmailJob.Estado.PROCESANDO, bloqueado_hasta__lt=ahora, intentos__gte=F('max_intentos'),
+    ).update(
+        estado=EmailJob.Estado.FALLIDO,
+        bloqueado_hasta=None,
+        ultimo_error='La reserva venció en el último intento (el worker no terminó el envío)',
+    )
+    if descartados:
+        logger.error(f"{descartados} correos marcados como fallidos tras agotar sus intentos sin completarse")
+    return descartados
+
+
+def reclamar_lote(limite: int = None) -> list:
+    """
+    Reserva hasta `limite` trabajos para este worker y los retorna.
+    El contador de intentos se incrementa al reclamar, de modo que un trabajo
+    que tumba al worker también agota sus intentos.
+    """
+    limite = limite or EMAIL_QUEUE_BATCH_SIZE
+    ahora = timezone.now()
+    _descartar_reservas_agotadas(ahora)
+    reserva = {
+        'estado': EmailJob.Estado.PROCESANDO,
+        'bloqueado_hasta': ahora + timedelta(seconds=EMAIL_QUEUE_LEASE_SECONDS),
+        'intentos': F('intentos') + 1,
+    }
+    disponibles = EmailJob.objects.filter(_filtro_disponibles(ahora)).order_by('proximo_intento', 'id')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(
+                disponibles.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limite]
+            )
+            if ids:
+                EmailJob.objects.filter(pk__in=ids).update(**reserva)
+    else:
+        # Sin SKIP LOCKED: cada fila se reclama con un UPDATE condicional;
+        # si otro worker la tomó primero, el UPDATE afecta 0 filas.
+        ids = []
+        for pk in disponibles.values_list('pk', flat=True)[:limite]:
+            if EmailJob.objects.filter(_filtro_disponibles(ahora), pk=pk).update(**reserva):
+                ids.append(pk)
+
+    return list(EmailJob.objects.filter(pk__in=ids).order_by('proximo_intento', 'id'))
+
+
+def _espera_reintento(intentos: int) -> timedelta:
+    segundos = EMAIL_QUEUE_RETRY_BASE_SECONDS * (2 ** max(intentos - 1, 0))
+    return timedelta(seconds=min(segundos, EMAIL_QUEUE_RETRY_MAX_SECONDS))
+
+
+def _registrar_exito(job, proveedor):
+    EmailJob.objects.filter(pk=job.pk).update(
+        estado=EmailJob.Estado.ENVIADO,
+        proveedor=proveedor,
+        fecha_envio=timezone.now(),
+        bloqueado_hasta=None,
+        ultimo_error='',
+    )
+
+
+def _registrar_omitido(job, error):
+    EmailJob.objects.filter(pk=job.pk).update(
+        estado=EmailJob.Estado.OMITIDO,
+        bloqueado_hasta=None,
+        ultimo_error=str(error),
+    )
+
+
+def _registrar_fallo(job, error):
+    if isinstance(error, ProveedorNoDisponible):
+        # No se llegó a intentar: se devuelve el intento consumido al reclamarlo
+        logger.info(f"Envío a {job.destinatario} pospuesto {int(error.reintentar_en)} segundos: {error}")
+        EmailJob.objects.filter(pk=job.pk).update(
+            estado=EmailJob.Estado.PENDIENTE,
+            intentos=F('intentos') - 1,
+            proximo_intento=timezone.now() + timedelta(seconds=error.reintentar_en),
+            bloqueado_hasta=None,
+            ultimo_error=str(error),
+        )
+        return
+    if job.intentos >= job.max_intentos:
+        logger.error(f"Fallo definitivo enviando email a {job.destinatario} tras {job.intentos} intentos: {error}")
+        cambios = {'estado': EmailJob.Estado.FALLIDO}
+    else:
+        espera = _espera_reintento(job.intentos)
+        logger.warning(
+            f"Error enviando email a {job.destinatario} (intento {job.intentos}/{job.max_intentos}): "
+            f"{error}. Reintentando en {int(espera.total_seconds())} segundos..."
+        )
+        cambios = {'estado': EmailJob.Estado.PENDIENTE, 'proximo_intento': timezone.now() + espera}
+    EmailJob.objects.filter(pk=job.pk).update(bloqueado_hasta=None, ultimo_error=str(error)[:2000], **cambios)
+
+
+def _combinar(grupo: list) -> EmailJob:
+    """Construye (sin guardar) un único correo que resume los trabajos del grupo."""
+    primero = grupo[0]
+    entradas = [
+        {'titulo': job.titulo or job.asunto, 'mensaje': job.mensaje or job.cuerpo_texto, 'ticket_id': job.ticket_id}
+        for job in grupo
+    ]
+    tickets = {job.ticket_id for job in grupo if job.ticket_id}
+    if primero.grupo.startswith('ticket:') and len(tickets) == 1:
+        asunto = f"{len(grupo)} actualizaciones - Ticket #{tickets.pop()}"
+    else:
+        asunto = f"Resumen de {len(grupo)} notificaciones"
+
+    # El saludo conserva el marcador de sustitución del nombre, si lo hay
+    saludo = next(iter(primero.sustituciones or {}), primero.destinatario)
+    lineas = [f"Hola {saludo},", "", f"Tienes {len(grupo)} notificaciones nuevas:", ""]
+    for entrada in entradas:
+        ticket = f" (Ticket #{entrada['ticket_id']})" if entrada['ticket_id'] else ''
+        lineas += [f"- {entrada['titulo']}{ticket}", f"  {entrada['mensaje']}", ""]
+    lineas += ["---", "Sistema de Tickets"]
+
+    html = renderizar('emails/notification_digest.html', {
+        'subject': asunto,
+        'entradas': entradas,
+        'nombre_destinatario': saludo,
+    })
+    return EmailJob(
+        destinatario=primero.destinatario,
+        asunto=asunto,
+        cuerpo_texto="\n".join(lineas),
+        cuerpo_html=html,
+        sustituciones=primero.sustituciones,
+    )
+
+
+def _agrupar_envios(jobs: list) -> list:
+    """
+    Retorna una lista de (correo_a_enviar, [trabajos]) combinando los trabajos
+    reclamados del mismo destinatario y grupo en un solo correo.
+    """
+    grupos = {}
+    envios = []
+    for job in jobs:
+        if not job.grupo:
+            envios.append([job])
+            continue
+        clave = (job.destinatario, job.grupo)
+        if clave not in grupos:
+            grupos[clave] = []
+            envios.append(grupos[clave])
+        grupos[clave].append(job)
+    return [(miembros[0] if len(miembros) == 1 else _combinar(miembros), miembros) for miembros in envios]
+
+
+def procesar_lote(limite: int = None) -> dict:
+    """Reclama y envía un lote de correos. Retorna contadores del lote."""
+    resumen = {'reclamados': 0, 'enviados': 0, 'fallidos': 0, 'pospuestos': 0, 'omitidos': 0}
+    jobs = reclamar_lote(limite)
+    if not jobs:
+        return resumen
+
+    resumen['reclamados'] = len(jobs)
+    envios = _agrupar_envios(jobs)
+    resultados = email_providers.enviar_lote([correo for correo, _ in envios])
+    for (_, miembros), (proveedor, error) in zip(envios, resultados):
+        for job in miembros:
+            if error is None:
+                _registrar_exito(job, proveedor)
+                resumen['enviados'] += 1
+            elif isinstance(error, ProveedorNoDisponible):
+                _registrar_fallo(job, error)
+                resumen['pospuestos'] += 1
+            elif isinstance(error, EnvioOmitido):
+                _registrar_omitido(job, error)
+                resumen['omitidos'] += 1
+            else:
+                _registrar_fallo(job, error)
+                resumen['fallidos'] += 1
+    return resumen
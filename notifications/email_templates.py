@@ -0,0 +1,62 @@
+"""
+Plantillas HTML de los correos de notificación.
+
+Cada plantilla se compila una sola vez por proceso y se reutiliza en todos los
+envíos; con DEBUG, editar un .html limpia la caché igual que el autoreload de
+Django hace con sus propios loaders.
+"""
+from functools import lru_cache
+
+from django.contrib.auth import get_user_model
+from django.template.loader import get_template
+from django.utils.autoreload import file_changed
+
+User = get_user_model()
+
+PLANTILLAS_EMAIL = {
+    (User.Role.CLIENT, 'ticket_creado'): 'emails/ticket_created_client.html',
+    (User.Role.CLIENT, 'estado_cambiado'): 'emails/ticket_state_changed_client.html',
+    (User.Role.CLIENT, 'ticket_finalizado'): 'emails/ticket_state_changed_client.html',
+    (User.Role.CLIENT, 'ticket_cerrado'): 'emails/ticket_closed_client.html',
+    (User.Role.TECH, 'ticket_creado'): 'emails/ticket_created_technician.html',
+    (User.Role.TECH, 'ticket_asignado'): 'emails/ticket_assigned_technician.html',
+    (User.Role.TECH, 'ticket_finalizado'): 'emails/ticket_created_technician.html',
+    (User.Role.TECH, 'ticket_cerrado'): 'emails/ticket_created_technician.html',
+    (User.Role.TECH, 'tecnico_cambiado'): 'emails/technician_changed.html',
+    (User.Role.TECH, 'cambio_estado_aprobado'): 'emails/state_change_approved_technician.html',
+    (User.Role.TECH, 'cambio_estado_rechazado'): 'emails/state_change_rejected_technician.html',
+    (User.Role.ADMIN, 'ticket_creado'): 'emails/ticket_created_admin.html',
+    (User.Role.ADMIN, 'solicitud_finalizacion'): 'emails/ticket_created_admin.html',
+    (User.Role.ADMIN, 'solicitud_cambio_estado'): 'emails/state_change_request_admin.html',
+}
+
+# Plantilla usada cuando el tipo no tiene una específica para el rol
+PLANTILLAS_POR_ROL = {
+    User.Role.CLIENT: 'emails/ticket_created_client.html',
+    User.Role.TECH: 'emails/ticket_created_technician.html',
+    User.Role.ADMIN: 'emails/ticket_created_admin.html',
+}
+
+
+def nombre_plantilla(rol: str, tipo_codigo: str) -> str:
+    plantilla = PLANTILLAS_EMAIL.get((rol, tipo_codigo))
+    if plantilla:
+        return plantilla
+    return PLANTILLAS_POR_ROL.get(rol, 'emails/ticket_created_client.html')
+
+
+@lru_cache(maxsize=None)
+def obtener_plantilla(nombre: str):
+    return get_template(nombre)
+
+
+def renderizar(nombre: str, context: dict) -> str:
+    return obtener_plantilla(nombre).render(context)
+
+
+def _limpiar_al_editar(sender, file_path, **kwargs):
+    if file_path.suffix == '.html':
+        obtener_plantilla.cache_clear()
+
+
+file_changed.connect(_limpiar_al_editar)
@@ -0,0 +1,151 @@
+"""
+Consultas de la bandeja de notificaciones de un usuario.
+
+La bandeja se lee de NotificationDelivery: una fila por notificación y
+usuario (destinatario principal o de `destinatarios`) con su propio estado
+de lectura, así no hace falta unir la tabla M2M ni usar DISTINCT y los
+filtros por estado recorren el índice (usuario, estado, fecha_creacion).
+La paginación es por cursor sobre (fecha_creacion, notificacion_id) para
+que las páginas profundas cuesten lo mismo que la primera, y el total se
+cachea unos segundos.
+"""
+import base64
+import hashlib
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Prefetch, Q
+from rest_framework.exceptions import ValidationError
+
+from .models import Notification, NotificationDelivery
+from tickets.models import Ticket
+
+User = get_user_model()
+
+# Segundos que se reutiliza el total de notificaciones de una bandeja
+NOTIFICATIONS_INBOX_COUNT_TTL = getattr(settings, 'NOTIFICATIONS_INBOX_COUNT_TTL', 30)
+NOTIFICATIONS_INBOX_MAX_LIMIT = 100
+
+# Columnas de usuario que muestran los serializers de notificaciones
+CAMPOS_USUARIO = ('document', 'email', 'first_name', 'last_name', 'role')
+CAMPOS_TECNICO = ('id', 'tecnico', *(f'tecnico__{campo}' for campo in (*CAMPOS_USUARIO, 'number')))
+
+
+def bandeja(usuario):
+    """Entregas de notificaciones de `usuario`."""
+    return NotificationDelivery.objects.filter(usuario_id=usuario.pk)
+
+
+def con_relaciones(queryset):
+    """
+    Carga junto con una página de entregas todo lo que usan los serializers
+    de notificaciones (usuario, remitente, destinatarios y técnico del
+    ticket), con un número constante de consultas sin importar el tamaño de
+    la página y solo las columnas que se muestran.
+    """
+    usuarios = User.objects.only(*CAMPOS_USUARIO)
+    return queryset.select_related('notificacion__tipo').prefetch_related(
+        Prefetch('notificacion__usuario', queryset=usuarios),
+        Prefetch('notificacion__enviado_por', queryset=usuarios),
+        Prefetch('notificacion__destinatarios', queryset=usuarios),
+        Prefetch('notificacion__ticket', queryset=Ticket.objects.select_related('tecnico').only(*CAMPOS_TECNICO)),
+    )
+
+
+def filtrar(queryset, params):
+    """Aplica los filtros opcionales `estado`, `tipo` y `leidas` de la petición."""
+    estado = params.get('estado')
+    if estado:
+        queryset = queryset.filter(estado=estado)
+
+    tipo = params.get('tipo')
+    if tipo:
+        queryset = queryset.filter(notificacion__tipo__codigo=tipo)
+
+    leidas = params.get('leidas')
+    if leidas is not None:
+        if leidas.lower() == 'true':
+            queryset = queryset.filter(estado=Notification.Estado.LEIDA)
+        elif leidas.lower() == 'false':
+            queryset = queryset.exclude(estado=Notification.Estado.LEIDA)
+    return queryset
+
+
+def codificar_cursor(entrega) -> str:
+    valor = f"{entrega.fecha_creacion.isoformat()}|{entrega.notificacion_id}"
+    return base64.urlsafe_b64encode(valor.encode()).decode()
+
+
+def decodificar_cursor(cursor: str):
+    try:
+        fecha, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(fecha), int(pk)
+    except (ValueError, UnicodeError):
+        raise ValidationError({'cursor': 'Cursor inválido.'})
+
+
+def paginar(queryset, params):
+    """
+    Retorna (entregas, siguiente_cursor). Con `cursor` se continúa después de la
+    última notificación de la página anterior; sin él se admite `offset` para
+    los clientes que aún paginan por desplazamiento.
+    """
+    try:
+        limite = min(int(params.get('limit', 20)), NOTIFICATIONS_INBOX_MAX_LIMIT)
+        offset = int(params.get('offset', 0))
+    except ValueError:
+        raise ValidationError({'limit': 'Los parámetros limit y offset deben ser enteros.'})
+
+    queryset = queryset.order_by('-fecha_creacion', '-notificacion_id')
+    cursor = params.get('cursor')
+    if cursor:
+        fecha, pk = decodificar_cursor(cursor)
+        queryset = queryset.filter(Q(fecha_creacion__lt=fecha) | Q(fecha_creacion=fecha, notificacion_id__lt=pk))
+        offset = 0
+
+    # Se pide una fila extra para saber si hay otra página sin contar
+    pagina = list(queryset[offset:offset + limite + 1])
+    siguiente = codificar_cursor(pagina[limite - 1]) if len(pagina) > limite else None
+    return pagina[:limite], siguiente
+
+
+def notificaciones(entregas) -> list:
+    """
+    Retorna las notificaciones de una página de entregas (cargadas con
+    select_related('notificacion')) con el estado y la fecha de lectura del
+    usuario de cada entrega.
+    """
+    resultado = []
+    for entrega in entregas:
+        notificacion = entrega.notificacion
+        notificacion.estado = entrega.estado
+        notificacion.fecha_lectura = entrega.fecha_lectura
+        resultado.append(notificacion)
+    return resultado
+
+
+def etag(usuario_pk, version: int, request) -> str:
+    """
+    ETag de una respuesta de la bandeja: cambia con la versión de los
+    contadores del usuario (cualquier entrega creada, leída o eliminada) y
+    con la ruta y los parámetros de la petición.
+    """
+    consulta = hashlib.md5(request.get_full_path().encode()).hexdigest()[:12]
+    return f'"{usuario_pk}-{version}-{consulta}"'
+
+
+def contar(queryset, usuario, params, version: int = None) -> int:
+    """
+    Total de la bandeja filtrada, cacheado NOTIFICATIONS_INBOX_COUNT_TTL
+    segundos. Con `version` (la de NotificationCounter) la clave cambia en
+    cuanto cambia la bandeja, así el total nunca queda desactualizado.
+    """
+    filtros = '&'.join(f"{campo}={params.get(campo, '')}" for campo in ('estado', 'tipo', 'leidas'))
+    clave = f"notifications:inbox-count:{usuario.pk}:{version}:{hashlib.md5(filtros.encode()).hexdigest()}"
+    total = cache.get(clave)
+    if total is None:
+        total = queryset.count()
+        cache.set(clave, total, NOTIFICATIONS_INBOX_COUNT_TTL)
+    return total
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from notifications.retention import NOTIFICATIONS_RETENTION_BATCH_SIZE, depurar_notificaciones
+
+
+class Command(BaseCommand):
+    help = (
+        "Archiva (JSONL comprimido en el storage) y elimina por lotes las notificaciones leídas "
+        "que superan la retención de su tipo. Pensado para ejecutarse periódicamente (cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=NOTIFICATIONS_RETENTION_BATCH_SIZE,
+            help='Notificaciones archivadas y eliminadas por transacción.',
+        )
+        parser.add_argument(
+            '--no-archive', action='store_true',
+            help='Elimina sin guardar el archivo JSONL.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Solo reporta cuántas notificaciones se depurarían.',
+        )
+
+    def handle(self, *args, **options):
+        resumen = depurar_notificaciones(
+            dry_run=options['dry_run'],
+            batch_size=options['batch_size'],
+            archivar_antes=not options['no_archive'],
+        )
+
+        detalle = ', '.join(f"{codigo}: {cantidad}" for codigo, cantidad in resumen['por_tipo'].items()) or 'ninguna'
+        if options['dry_run']:
+            self.stdout.write(f"[dry-run] Notificaciones vencidas: {resumen['eliminadas']} ({detalle})")
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Notificaciones eliminadas: {resumen['eliminadas']} ({detalle}), "
+            f"archivos generados: {len(resumen['archivos'])}"
+        ))
@@ -0,0 +1,33 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from notifications.models import NotificationCounter
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcula los contadores de notificaciones por usuario a partir de las "
+        "notificaciones reales y corrige los que se hayan desviado."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', dest='usuarios', action='append', default=[],
+            help='Documento de un usuario a reconciliar (puede repetirse). Por defecto, todos.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Cantidad de usuarios recalculados por consulta.',
+        )
+
+    def handle(self, *args, **options):
+        usuarios = get_user_model().objects.order_by('pk')
+        if options['usuarios']:
+            usuarios = usuarios.filter(pk__in=options['usuarios'])
+        ids = list(usuarios.values_list('pk', flat=True))
+
+        corregidos = 0
+        for inicio in range(0, len(ids), options['batch_size']):
+            corregidos += NotificationCounter.recalcular(ids[inicio:inicio + options['batch_size']])
+
+        self.stdout.write(f"Usuarios revisados: {len(ids)}, contadores corregidos: {corregidos}")
@@ -0,0 +1,61 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from notifications.email_providers import sendgrid_client, smtp_pool
+from notifications.email_queue import EMAIL_QUEUE_BATCH_SIZE, procesar_lote
+
+
+class Command(BaseCommand):
+    help = (
+        "Procesa la cola persistente de correos (EmailJob). Puede ejecutarse en varios "
+        "procesos a la vez; cada uno reclama trabajos distintos."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Procesa un solo lote y termina (útil para cron o pruebas).',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=EMAIL_QUEUE_BATCH_SIZE,
+            help='Cantidad de correos reclamados por lote.',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=2.0,
+            help='Segundos de espera cuando la cola está vacía.',
+        )
+
+    def handle(self, *args, **options):
+        self._detener = False
+        if not options['once']:
+            signal.signal(signal.SIGTERM, self._solicitar_detencion)
+            signal.signal(signal.SIGINT, self._solicitar_detencion)
+
+        try:
+            self._procesar(options)
+        finally:
+            smtp_pool.cerrar_todas()
+            sendgrid_client.cerrar()
+
+    def _procesar(self, options):
+        while True:
+            close_old_connections()
+            resumen = procesar_lote(options['batch_size'])
+            if resumen['reclamados']:
+                self.stdout.write(
+                    f"Lote procesado: enviados {resumen['enviados']}, fallidos {resumen['fallidos']}, "
+                    f"pospuestos {resumen['pospuestos']}, omitidos {resumen['omitidos']}"
+                )
+            if options['once'] or self._detener:
+                break
+            if not resumen['reclamados']:
+                time.sleep(options['sleep'])
+            if self._detener:
+                break
+
+    def _solicitar_detencion(self, signum, frame):
+        # Termina el lote en curso antes de salir para no dejar trabajos reservados
+        self._detener = True
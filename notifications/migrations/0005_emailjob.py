@@ -0,0 +1,39 @@
+# Generated by Django 5.0.6 on 2026-10-19 01:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0004_alter_notification_datos_adicionales_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('destinatario', models.EmailField(max_length=254)),
+                ('asunto', models.CharField(max_length=255)),
+                ('cuerpo_texto', models.TextField()),
+                ('cuerpo_html', models.TextField(blank=True)),
+                ('estado', models.CharField(choices=[('PENDIENTE', 'Pendiente'), ('PROCESANDO', 'Procesando'), ('ENVIADO', 'Enviado'), ('FALLIDO', 'Fallido')], default='PENDIENTE', max_length=20)),
+                ('intentos', models.PositiveIntegerField(default=0)),
+                ('max_intentos', models.PositiveIntegerField(default=5)),
+                ('proximo_intento', models.DateTimeField(default=django.utils.timezone.now)),
+                ('bloqueado_hasta', models.DateTimeField(blank=True, null=True)),
+                ('proveedor', models.CharField(blank=True, max_length=20)),
+                ('ultimo_error', models.TextField(blank=True)),
+                ('fecha_creacion', models.DateTimeField(default=django.utils.timezone.now)),
+                ('fecha_envio', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Correo en Cola',
+                'verbose_name_plural': 'Correos en Cola',
+                'ordering': ['proximo_intento', 'id'],
+                'indexes': [models.Index(fields=['estado', 'proximo_intento'], name='notificatio_estado_41a472_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-19 01:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0005_emailjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailjob',
+            name='sustituciones',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
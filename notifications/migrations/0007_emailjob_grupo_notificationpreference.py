@@ -0,0 +1,58 @@
+# Generated by Django 5.0.6 on 2026-10-19 01:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0006_emailjob_sustituciones'),
+        ('tickets', '0008_add_ticket_attachment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationPreference',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frecuencia_email', models.CharField(choices=[('INMEDIATA', 'Inmediata'), ('HORARIA', 'Resumen cada hora'), ('DIARIA', 'Resumen diario')], default='INMEDIATA', max_length=20)),
+                ('fecha_actualizacion', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Preferencia de Notificaciones',
+                'verbose_name_plural': 'Preferencias de Notificaciones',
+            },
+        ),
+        migrations.AddField(
+            model_name='emailjob',
+            name='grupo',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='emailjob',
+            name='mensaje',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='emailjob',
+            name='ticket',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='correos', to='tickets.ticket'),
+        ),
+        migrations.AddField(
+            model_name='emailjob',
+            name='titulo',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddIndex(
+            model_name='emailjob',
+            index=models.Index(fields=['destinatario', 'grupo'], name='notificatio_destina_8c2d24_idx'),
+        ),
+        migrations.AddField(
+            model_name='notificationpreference',
+            name='usuario',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='preferencia_notificaciones', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
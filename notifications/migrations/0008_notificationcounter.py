@@ -0,0 +1,55 @@
+# Generated by Django 5.0.6 on 2026-10-19 01:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def crear_contadores(apps, schema_editor):
+    """Crea los contadores de todos los usuarios a partir de sus notificaciones actuales."""
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Notification = apps.get_model('notifications', 'Notification')
+    NotificationCounter = apps.get_model('notifications', 'NotificationCounter')
+
+    conteos = {
+        fila.pop('usuario_id'): fila
+        for fila in Notification.objects.order_by().values('usuario_id').annotate(
+            total=Count('id'),
+            pendientes=Count('id', filter=Q(estado='PENDIENTE')),
+            enviadas=Count('id', filter=Q(estado='ENVIADA')),
+            leidas=Count('id', filter=Q(estado='LEIDA')),
+            fallidas=Count('id', filter=Q(estado='FALLIDA')),
+        )
+    }
+    NotificationCounter.objects.bulk_create(
+        [NotificationCounter(usuario_id=pk, **conteos.get(pk, {})) for pk in User.objects.values_list('pk', flat=True)],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0007_emailjob_grupo_notificationpreference'),
+        ('users', '0006_alter_user_number'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationCounter',
+            fields=[
+                ('usuario', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='contador_notificaciones', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('total', models.IntegerField(default=0)),
+                ('pendientes', models.IntegerField(default=0)),
+                ('enviadas', models.IntegerField(default=0)),
+                ('leidas', models.IntegerField(default=0)),
+                ('fallidas', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Contador de Notificaciones',
+                'verbose_name_plural': 'Contadores de Notificaciones',
+            },
+        ),
+        migrations.RunPython(crear_contadores, migrations.RunPython.noop),
+    ]
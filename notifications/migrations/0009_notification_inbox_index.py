@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-19 01:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0008_notificationcounter'),
+        ('tickets', '0008_add_ticket_attachment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['usuario', '-fecha_creacion', '-id'], name='notif_usuario_fecha_id_idx'),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 5.0.6 on 2026-10-19 01:44
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def crear_entregas(apps, schema_editor):
+    """
+    Crea una entrega por el destinatario principal y por cada usuario de
+    `destinatarios`, y recalcula los contadores a partir de ellas.
+    """
+    Notification = apps.get_model('notifications', 'Notification')
+    NotificationDelivery = apps.get_model('notifications', 'NotificationDelivery')
+    NotificationCounter = apps.get_model('notifications', 'NotificationCounter')
+    Destinatario = Notification.destinatarios.through
+
+    entregas = []
+
+    def guardar(forzar=False):
+        if entregas and (forzar or len(entregas) >= 1000):
+            NotificationDelivery.objects.bulk_create(entregas)
+            entregas.clear()
+
+    for notificacion in Notification.objects.order_by('pk').iterator(chunk_size=1000):
+        entregas.append(NotificationDelivery(
+            notificacion_id=notificacion.pk, usuario_id=notificacion.usuario_id, estado=notificacion.estado,
+            fecha_creacion=notificacion.fecha_creacion, fecha_lectura=notificacion.fecha_lectura,
+        ))
+        guardar()
+    filas = Destinatario.objects.exclude(user_id=models.F('notification__usuario_id')).values_list(
+        'notification_id', 'user_id', 'notification__estado', 'notification__fecha_creacion'
+    )
+    for notificacion_id, usuario_id, estado, fecha in filas.iterator(chunk_size=1000):
+        # La lectura registrada en la notificación era la del destinatario principal
+        entregas.append(NotificationDelivery(
+            notificacion_id=notificacion_id, usuario_id=usuario_id,
+            estado='ENVIADA' if estado == 'LEIDA' else estado, fecha_creacion=fecha,
+        ))
+        guardar()
+    guardar(forzar=True)
+
+    conteos = NotificationDelivery.objects.order_by().values('usuario_id').annotate(
+        total=Count('id'),
+        pendientes=Count('id', filter=Q(estado='PENDIENTE')),
+        enviadas=Count('id', filter=Q(estado='ENVIADA')),
+        leidas=Count('id', filter=Q(estado='LEIDA')),
+        fallidas=Count('id', filter=Q(estado='FALLIDA')),
+    )
+    for fila in conteos:
+        NotificationCounter.objects.update_or_create(usuario_id=fila.pop('usuario_id'), defaults=fila)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0009_notification_inbox_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('estado', models.CharField(choices=[('PENDIENTE', 'Pendiente'), ('ENVIADA', 'Enviada'), ('LEIDA', 'Leída'), ('FALLIDA', 'Fallida')], default='PENDIENTE', max_length=20)),
+                ('fecha_creacion', models.DateTimeField(default=django.utils.timezone.now)),
+                ('fecha_lectura', models.DateTimeField(blank=True, null=True)),
+                ('notificacion', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entregas', to='notifications.notification')),
+                ('usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entregas_notificaciones', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Entrega de Notificación',
+                'verbose_name_plural': 'Entregas de Notificaciones',
+                'ordering': ['-fecha_creacion', '-notificacion_id'],
+                'indexes': [models.Index(fields=['usuario', 'estado', '-fecha_creacion'], name='notif_entrega_estado_idx'), models.Index(fields=['usuario', '-fecha_creacion', '-notificacion'], name='notif_entrega_bandeja_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='notificationdelivery',
+            constraint=models.UniqueConstraint(fields=('notificacion', 'usuario'), name='notif_entrega_unica'),
+        ),
+        migrations.RunPython(crear_entregas, migrations.RunPython.noop),
+    ]
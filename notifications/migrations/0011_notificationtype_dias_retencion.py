@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-19 01:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0010_notificationdelivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationtype',
+            name='dias_retencion',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
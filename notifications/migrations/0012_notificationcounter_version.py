@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-19 01:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0011_notificationtype_dias_retencion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationcounter',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
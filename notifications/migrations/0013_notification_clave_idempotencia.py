@@ -0,0 +1,25 @@
+# Generated by Django 5.0.6 on 2026-10-19 02:03
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0012_notificationcounter_version'),
+        ('tickets', '0008_add_ticket_attachment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='clave_idempotencia',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(fields=('clave_idempotencia',), name='notif_clave_idempotencia_unica'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-19 02:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0013_notification_clave_idempotencia'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailjob',
+            name='estado',
+            field=models.CharField(choices=[('PENDIENTE', 'Pendiente'), ('PROCESANDO', 'Procesando'), ('ENVIADO', 'Enviado'), ('FALLIDO', 'Fallido'), ('OMITIDO', 'Omitido')], default='PENDIENTE', max_length=20),
+        ),
+    ]
@@ -1,4 +1,9 @@
-from django.db import models
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import models, transaction
+from django.db.models import Count, F, Q
 from django.conf import settings
 from django.utils import timezone
 
@@ -13,6 +18,10 @@ class NotificationType(models.Model):
     enviar_a_tecnico = models.BooleanField(default=False)
     enviar_a_admin = models.BooleanField(default=False)
 
+    # Días que se conservan las notificaciones leídas de este tipo antes de archivarlas.
+    # Vacío usa NOTIFICATIONS_RETENTION_DAYS; 0 las conserva siempre.
+    dias_retencion = models.PositiveIntegerField(null=True, blank=True)
+
     class Meta:
         verbose_name = "Tipo de Notificación"
         verbose_name_plural = "Tipos de Notificaciones"
@@ -47,13 +56,21 @@ class Notification(models.Model):
     fecha_lectura = models.DateTimeField(null=True, blank=True)
 
     datos_adicionales = models.JSONField(default=dict, blank=True)
+    # Evento que originó la notificación (tipo, ticket, transición y destinatario);
+    # evita duplicados cuando el mismo evento se notifica dos veces
+    clave_idempotencia = models.CharField(max_length=255, null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = "Notificación"
         verbose_name_plural = "Notificaciones"
         ordering = ["-fecha_creacion"]
+        constraints = [
+            models.UniqueConstraint(fields=["clave_idempotencia"], name="notif_clave_idempotencia_unica"),
+        ]
         indexes = [
             models.Index(fields=["usuario", "estado"]),
+            # Paginación por cursor de la bandeja: (usuario, fecha_creacion, id) descendente
+            models.Index(fields=["usuario", "-fecha_creacion", "-id"], name="notif_usuario_fecha_id_idx"),
             models.Index(fields=["fecha_creacion"]),
             models.Index(fields=["ticket", "tipo"]),
         ]
@@ -66,7 +83,11 @@ class Notification(models.Model):
         self.fecha_envio = timezone.now()
         self.save(update_fields=['estado', 'fecha_envio'])
 
-    def marcar_como_leida(self):
+    def marcar_como_leida(self, usuario=None):
+        """Marca la notificación como leída para `usuario` (por defecto, el destinatario principal)."""
+        if usuario is not None and usuario.pk != self.usuario_id:
+            self.entregas.filter(usuario_id=usuario.pk).marcar_como_leidas()
+            return
         self.estado = self.Estado.LEIDA
         self.fecha_lectura = timezone.now()
         self.save(update_fields=['estado', 'fecha_lectura'])
@@ -83,10 +104,361 @@ class Notification(models.Model):
     def es_pendiente(self):
         return self.estado == self.Estado.PENDIENTE
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Estado guardado, para reflejar en la entrega del destinatario principal si cambia
+        instance._estado_guardado = dict(zip(field_names, values)).get('estado')
+        return instance
+
     def save(self, *args, **kwargs):
         try:
             if self.enviado_por and not self.enviado_por_role:
                 self.enviado_por_role = getattr(self.enviado_por, 'role', '') or ''
         except Exception:
             pass
-        return super().save(*args, **kwargs)
\ No newline at end of file
+        creada = self._state.adding
+        anterior = getattr(self, '_estado_guardado', None)
+        update_fields = kwargs.get('update_fields')
+        # Guardar solo la lectura ya cambia la versión de la bandeja vía las entregas;
+        # cualquier otro cambio (mensaje, tipo, fecha_envio...) debe invalidar el ETag
+        contenido_cambiado = not creada and not (update_fields and set(update_fields) <= {'estado', 'fecha_lectura'})
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+            if creada:
+                NotificationDelivery.crear([(self, self.usuario_id)])
+            elif anterior and anterior != self.estado:
+                self.entregas.filter(usuario_id=self.usuario_id).cambiar_estado(
+                    self.estado, fecha_lectura=self.fecha_lectura, sincronizar_notificacion=False
+                )
+            if contenido_cambiado:
+                NotificationCounter.invalidar(self.entregas.values('usuario_id'))
+        self._estado_guardado = self.estado
+
+
+class EmailJob(models.Model):
+    """
+    Correo pendiente de envío. Se persiste al crear la notificación y lo
+    entrega el proceso `manage.py run_email_worker`, de modo que los envíos
+    sobreviven a reinicios de los workers web.
+    """
+    class Estado(models.TextChoices):
+        PENDIENTE = 'PENDIENTE', 'Pendiente'
+        PROCESANDO = 'PROCESANDO', 'Procesando'
+        ENVIADO = 'ENVIADO', 'Enviado'
+        FALLIDO = 'FALLIDO', 'Fallido'
+        # Sin proveedor configurado (p. ej. desarrollo sin EMAIL_HOST): no se envía ni se reintenta
+        OMITIDO = 'OMITIDO', 'Omitido'
+
+    destinatario = models.EmailField()
+    ticket = models.ForeignKey('tickets.Ticket', on_delete=models.SET_NULL, null=True, blank=True, related_name="correos")
+    # Título y mensaje de la notificación original, usados al combinar varios correos en uno
+    titulo = models.CharField(max_length=200, blank=True)
+    mensaje = models.TextField(blank=True)
+    # Clave de agrupación: correos pendientes con el mismo destinatario y grupo se envían juntos
+    grupo = models.CharField(max_length=50, blank=True)
+    asunto = models.CharField(max_length=255)
+    cuerpo_texto = models.TextField()
+    cuerpo_html = models.TextField(blank=True)
+    # Valores por destinatario (p. ej. el nombre del saludo) que se reemplazan al enviar,
+    # así correos idénticos a varios destinatarios comparten el mismo cuerpo
+    sustituciones = models.JSONField(default=dict, blank=True)
+
+    estado = models.CharField(max_length=20, choices=Estado.choices, default=Estado.PENDIENTE)
+    intentos = models.PositiveIntegerField(default=0)
+    max_intentos = models.PositiveIntegerField(default=5)
+    proximo_intento = models.DateTimeField(default=timezone.now)
+    bloqueado_hasta = models.DateTimeField(null=True, blank=True)
+    proveedor = models.CharField(max_length=20, blank=True)
+    ultimo_error = models.TextField(blank=True)
+
+    fecha_creacion = models.DateTimeField(default=timezone.now)
+    fecha_envio = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Correo en Cola"
+        verbose_name_plural = "Correos en Cola"
+        ordering = ["proximo_intento", "id"]
+        indexes = [
+            models.Index(fields=["estado", "proximo_intento"]),
+            models.Index(fields=["destinatario", "grupo"]),
+        ]
+
+    def __str__(self):
+        return f"[{self.estado}] {self.asunto} → {self.destinatario}"
+
+
+class NotificationPreference(models.Model):
+    """Preferencia de cada usuario sobre la frecuencia de sus correos de notificación."""
+    class Frecuencia(models.TextChoices):
+        INMEDIATA = 'INMEDIATA', 'Inmediata'
+        HORARIA = 'HORARIA', 'Resumen cada hora'
+        DIARIA = 'DIARIA', 'Resumen diario'
+
+    usuario = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="preferencia_notificaciones")
+    frecuencia_email = models.CharField(max_length=20, choices=Frecuencia.choices, default=Frecuencia.INMEDIATA)
+    fecha_actualizacion = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Preferencia de Notificaciones"
+        verbose_name_plural = "Preferencias de Notificaciones"
+
+    def __str__(self):
+        return f"{self.usuario} - {self.get_frecuencia_email_display()}"
+
+    @classmethod
+    def frecuencias_para(cls, usuarios) -> dict:
+        """Retorna {email: frecuencia} de los usuarios con preferencia distinta de la inmediata."""
+        return dict(
+            cls.objects.filter(usuario__in=usuarios)
+            .exclude(frecuencia_email=cls.Frecuencia.INMEDIATA)
+            .values_list('usuario__email', 'frecuencia_email')
+        )
+
+
+class NotificationDeliveryQuerySet(models.QuerySet):
+
+    def no_leidas(self):
+        return self.exclude(estado=Notification.Estado.LEIDA)
+
+    def cambiar_estado(self, nuevo, fecha_lectura=None, sincronizar_notificacion=True) -> int:
+        """
+        Pasa las entregas a `nuevo` con un solo UPDATE y retorna cuántas
+        cambiaron. Las filas se bloquean antes para ajustar los contadores de
+        cada usuario según el estado que tenían; las entregas del destinatario
+        principal también actualizan `Notification.estado`.
+        """
+        with transaction.atomic(savepoint=False):
+            filas = list(
+                self.exclude(estado=nuevo).select_for_update(of=('self',))
+                .values_list('pk', 'usuario_id', 'estado', 'notificacion_id', 'notificacion__usuario_id')
+            )
+            if not filas:
+                return 0
+            cambios = {'estado': nuevo}
+            if nuevo == Notification.Estado.LEIDA:
+                cambios['fecha_lectura'] = fecha_lectura or timezone.now()
+            actualizadas = NotificationDelivery.objects.filter(pk__in=[fila[0] for fila in filas]).update(**cambios)
+
+            deltas = defaultdict(lambda: defaultdict(int))
+            for _, usuario_id, anterior, _, _ in filas:
+                for campo, delta in NotificationCounter.deltas_cambio(anterior, nuevo).items():
+                    deltas[usuario_id][campo] += delta
+            NotificationCounter.ajustar(deltas)
+
+            principales = [notificacion_id for _, usuario_id, _, notificacion_id, principal in filas if usuario_id == principal]
+            if sincronizar_notificacion and principales:
+                Notification.objects.filter(pk__in=principales).update(**cambios)
+        return actualizadas
+
+    def marcar_como_leidas(self) -> int:
+        return self.cambiar_estado(Notification.Estado.LEIDA)
+
+
+class NotificationDelivery(models.Model):
+    """
+    Entrega de una notificación a uno de sus usuarios (el destinatario
+    principal y cada uno de `destinatarios`), con su propio estado de lectura.
+    La bandeja y las estadísticas se leen de esta tabla; `fecha_creacion` se
+    copia de la notificación para paginar sin JOIN.
+    """
+    notificacion = models.ForeignKey(Notification, on_delete=models.CASCADE, related_name="entregas")
+    usuario = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="entregas_notificaciones")
+    estado = models.CharField(max_length=20, choices=Notification.Estado.choices, default=Notification.Estado.PENDIENTE)
+    fecha_creacion = models.DateTimeField(default=timezone.now)
+    fecha_lectura = models.DateTimeField(null=True, blank=True)
+
+    objects = NotificationDeliveryQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "Entrega de Notificación"
+        verbose_name_plural = "Entregas de Notificaciones"
+        ordering = ["-fecha_creacion", "-notificacion_id"]
+        constraints = [
+            models.UniqueConstraint(fields=["notificacion", "usuario"], name="notif_entrega_unica"),
+        ]
+        indexes = [
+            models.Index(fields=["usuario", "estado", "-fecha_creacion"], name="notif_entrega_estado_idx"),
+            models.Index(fields=["usuario", "-fecha_creacion", "-notificacion"], name="notif_entrega_bandeja_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.notificacion_id} → {self.usuario_id} [{self.estado}]"
+
+    @classmethod
+    def crear(cls, pares) -> list:
+        """
+        Inserta con un bulk_create las entregas de `pares` (notificacion, usuario_id)
+        y las suma a los contadores. Los destinatarios adicionales no heredan la
+        lectura del principal.
+        """
+        entregas = [
+            cls(
+                notificacion=notificacion,
+                usuario_id=usuario_id,
+                estado=(
+                    Notification.Estado.ENVIADA
+                    if notificacion.estado == Notification.Estado.LEIDA and usuario_id != notificacion.usuario_id
+                    else notificacion.estado
+                ),
+                fecha_creacion=notificacion.fecha_creacion,
+                fecha_lectura=notificacion.fecha_lectura if usuario_id == notificacion.usuario_id else None,
+            )
+            for notificacion, usuario_id in pares
+        ]
+        if entregas:
+            cls.objects.bulk_create(entregas)
+            NotificationCounter.registrar_creadas(entregas)
+        return entregas
+
+
+_ajustes_por_fila = threading.local()
+
+
+class NotificationCounter(models.Model):
+    """
+    Contadores de las entregas de notificaciones de cada usuario. Se mantienen
+    con incrementos F() al crear, cambiar de estado o eliminar entregas, de
+    modo que las estadísticas se leen por clave primaria.
+    `manage.py reconcile_notification_counters` los recalcula si se desvían.
+    """
+    CAMPO_POR_ESTADO = {
+        Notification.Estado.PENDIENTE: 'pendientes',
+        Notification.Estado.ENVIADA: 'enviadas',
+        Notification.Estado.LEIDA: 'leidas',
+        Notification.Estado.FALLIDA: 'fallidas',
+    }
+
+    usuario = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name="contador_notificaciones"
+    )
+    total = models.IntegerField(default=0)
+    pendientes = models.IntegerField(default=0)
+    enviadas = models.IntegerField(default=0)
+    leidas = models.IntegerField(default=0)
+    fallidas = models.IntegerField(default=0)
+    # Aumenta con cada cambio de las entregas del usuario; identifica la versión de su bandeja (ETag)
+    version = models.BigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Contador de Notificaciones"
+        verbose_name_plural = "Contadores de Notificaciones"
+
+    def __str__(self):
+        return f"{self.usuario_id}: {self.total} notificaciones, {self.no_leidas} sin leer"
+
+    @property
+    def no_leidas(self):
+        return self.pendientes + self.enviadas
+
+    @classmethod
+    def deltas_cambio(cls, anterior, nuevo) -> dict:
+        return {cls.CAMPO_POR_ESTADO[anterior]: -1, cls.CAMPO_POR_ESTADO[nuevo]: 1}
+
+    @classmethod
+    @contextmanager
+    def sin_ajustes_por_fila(cls):
+        """
+        Desactiva en este hilo el descuento por cada entrega eliminada, para
+        borrados masivos que ajustan los contadores en bloque.
+        """
+        _ajustes_por_fila.desactivados = True
+        try:
+            yield
+        finally:
+            _ajustes_por_fila.desactivados = False
+
+    @classmethod
+    def ajustes_por_fila_activos(cls) -> bool:
+        return not getattr(_ajustes_por_fila, 'desactivados', False)
+
+    @classmethod
+    def ajustar(cls, deltas: dict, crear: bool = True):
+        """
+        Aplica `deltas` ({usuario_id: {campo: delta}}) con un UPDATE por cada
+        combinación distinta de cambios. Si a algún usuario le falta la fila y
+        `crear` es True, sus contadores se recalculan desde cero.
+        """
+        usuarios_por_cambio = defaultdict(list)
+        for usuario_id, cambios in deltas.items():
+            cambios = tuple(sorted((campo, delta) for campo, delta in cambios.items() if delta))
+            if cambios:
+                usuarios_por_cambio[cambios].append(usuario_id)
+
+        for cambios, usuario_ids in usuarios_por_cambio.items():
+            actualizadas = cls.objects.filter(usuario_id__in=usuario_ids).update(
+                version=F('version') + 1, **{campo: F(campo) + delta for campo, delta in cambios}
+            )
+            if crear and actualizadas < len(usuario_ids):
+                cls.recalcular(usuario_ids)
+
+    @classmethod
+    def registrar_creadas(cls, entregas):
+        """Suma entregas recién insertadas con bulk_create."""
+        deltas = defaultdict(lambda: defaultdict(int))
+        for entrega in entregas:
+            deltas[entrega.usuario_id]['total'] += 1
+            deltas[entrega.usuario_id][cls.CAMPO_POR_ESTADO[entrega.estado]] += 1
+        cls.ajustar(deltas)
+
+    @classmethod
+    def conteos(cls, usuario_ids=None) -> dict:
+        """Cuenta las entregas reales por usuario: {usuario_id: {campo: valor}}."""
+        entregas = NotificationDelivery.objects.order_by()
+        if usuario_ids is not None:
+            entregas = entregas.filter(usuario_id__in=usuario_ids)
+        filas = entregas.values('usuario_id').annotate(
+            total=Count('id'),
+            **{campo: Count('id', filter=Q(estado=estado)) for estado, campo in cls.CAMPO_POR_ESTADO.items()},
+        )
+        return {fila.pop('usuario_id'): fila for fila in filas}
+
+    @classmethod
+    def recalcular(cls, usuario_ids) -> int:
+        """Recalcula los contadores de los usuarios indicados y retorna cuántos se corrigieron."""
+        usuario_ids = list(usuario_ids)
+        reales = cls.conteos(usuario_ids)
+        vacio = dict.fromkeys(['total', *cls.CAMPO_POR_ESTADO.values()], 0)
+        existentes = {c.usuario_id: c for c in cls.objects.filter(usuario_id__in=usuario_ids)}
+
+        corregidos, nuevos = [], []
+        for usuario_id in usuario_ids:
+            valores = reales.get(usuario_id, vacio)
+            contador = existentes.get(usuario_id)
+            if contador is None:
+                nuevos.append(cls(usuario_id=usuario_id, **valores))
+            elif any(getattr(contador, campo) != valor for campo, valor in valores.items()):
+                for campo, valor in valores.items():
+                    setattr(contador, campo, valor)
+                contador.version += 1
+                corregidos.append(contador)
+
+        if corregidos:
+            cls.objects.bulk_update(corregidos, [*vacio, 'version'])
+        if nuevos:
+            cls.objects.bulk_create(nuevos, ignore_conflicts=True)
+        return len(corregidos) + len(nuevos)
+
+    @classmethod
+    def invalidar(cls, usuario_ids) -> int:
+        """
+        Cambia la versión de las bandejas de `usuario_ids` (lista o subconsulta)
+        sin tocar los contadores, para que su ETag deje de coincidir cuando
+        cambia el contenido de una notificación.
+        """
+        return cls.objects.filter(usuario_id__in=usuario_ids).update(version=F('version') + 1)
+
+    @classmethod
+    def version_de(cls, usuario) -> int:
+        """Versión actual de la bandeja del usuario (una lectura por clave primaria)."""
+        version = cls.objects.filter(pk=usuario.pk).values_list('version', flat=True).first()
+        return cls.para_usuario(usuario).version if version is None else version
+
+    @classmethod
+    def para_usuario(cls, usuario) -> 'NotificationCounter':
+        """Retorna los contadores del usuario, creándolos si aún no existen."""
+        try:
+            return cls.objects.get(pk=usuario.pk)
+        except cls.DoesNotExist:
+            cls.recalcular([usuario.pk])
+            return cls.objects.get(pk=usuario.pk)
@@ -0,0 +1,180 @@
+"""
+Pub/sub para enviar notificaciones en tiempo real a los clientes conectados.
+
+Con PostgreSQL el backend por defecto es PostgresPubSub, que reparte entre
+todos los procesos web (WEB_CONCURRENCY) con LISTEN/NOTIFY sin servicios
+adicionales. MemoryPubSub reparte dentro del mismo proceso y solo se usa con
+SQLite (desarrollo local y pruebas, un proceso). NOTIFICATIONS_PUBSUB_BACKEND
+admite cualquier clase que implemente suscribir(), cancelar() y publicar().
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Mensajes pendientes por suscriptor; si un cliente lento se atrasa se descartan los más antiguos
+NOTIFICATIONS_STREAM_QUEUE_SIZE = getattr(settings, 'NOTIFICATIONS_STREAM_QUEUE_SIZE', 100)
+
+
+def canal_usuario(usuario_id) -> str:
+    return f"usuario:{usuario_id}"
+
+
+class Suscripcion:
+    """Cola asíncrona de un cliente conectado; se puede alimentar desde cualquier hilo."""
+
+    def __init__(self, canal: str, max_pendientes: int = NOTIFICATIONS_STREAM_QUEUE_SIZE):
+        self.canal = canal
+        self._loop = asyncio.get_running_loop()
+        self._cola = asyncio.Queue(maxsize=max_pendientes)
+
+    def entregar(self, mensaje):
+        try:
+            self._loop.call_soon_threadsafe(self._encolar, mensaje)
+        except RuntimeError:
+            # El loop del cliente ya se cerró
+            pass
+
+    def _encolar(self, mensaje):
+        if self._cola.full():
+            self._cola.get_nowait()
+        self._cola.put_nowait(mensaje)
+
+    async def obtener(self, timeout: float):
+        return await asyncio.wait_for(self._cola.get(), timeout)
+
+
+class MemoryPubSub:
+    def __init__(self):
+        self._suscripciones = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def suscribir(self, canal: str) -> Suscripcion:
+        suscripcion = Suscripcion(canal)
+        with self._lock:
+            self._suscripciones[canal].add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, suscripcion: Suscripcion):
+        with self._lock:
+            suscripciones = self._suscripciones.get(suscripcion.canal)
+            if suscripciones is not None:
+                suscripciones.discard(suscripcion)
+                if not suscripciones:
+                    del self._suscripciones[suscripcion.canal]
+
+    def publicar(self, canal: str, mensaje: dict):
+        with self._lock:
+            suscripciones = list(self._suscripciones.get(canal, ()))
+        for suscripcion in suscripciones:
+            suscripcion.entregar(mensaje)
+
+
+class PostgresPubSub(MemoryPubSub):
+    """
+    Publica con NOTIFY y cada proceso mantiene un hilo con una conexión
+    dedicada en LISTEN que entrega los mensajes a sus suscripciones locales.
+    Solo funciona con la base de datos en PostgreSQL.
+    """
+    CANAL = 'tickethelp_notificaciones'
+    # NOTIFY admite hasta 8000 bytes; los mensajes más largos se envían sin el texto
+    MAX_PAYLOAD = 7500
+
+    def __init__(self, alias: str = 'default'):
+        super().__init__()
+        self._alias = alias
+        self._hilo = None
+
+    def suscribir(self, canal: str) -> Suscripcion:
+        self._escuchar_en_segundo_plano()
+        return super().suscribir(canal)
+
+    def publicar(self, canal: str, mensaje: dict):
+        payload = json.dumps({'canal': canal, 'mensaje': mensaje})
+        if len(payload.encode('utf-8')) > self.MAX_PAYLOAD:
+            payload = json.dumps({'canal': canal, 'mensaje': {**mensaje, 'mensaje': ''}})
+        with connections[self._alias].cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [self.CANAL, payload])
+
+    def _escuchar_en_segundo_plano(self):
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._escuchar, name='notifications-listen', daemon=True)
+                self._hilo.start()
+
+    def _escuchar(self):
+        base = connections[self._alias]
+        while True:
+            try:
+                conexion = base.get_new_connection(base.get_connection_params())
+                conexion.autocommit = True
+                with conexion:
+                    conexion.execute(f"LISTEN {self.CANAL}")
+                    for aviso in conexion.notifies():
+                        datos = json.loads(aviso.payload)
+                        super().publicar(datos['canal'], datos['mensaje'])
+            except Exception as e:
+                logger.error(f"Conexión LISTEN de notificaciones interrumpida: {e}")
+                time.sleep(5)
+
+
+_pubsub = None
+_pubsub_lock = threading.Lock()
+
+
+def get_pubsub():
+    global _pubsub
+    if _pubsub is None:
+        with _pubsub_lock:
+            if _pubsub is None:
+                clase = import_string(
+                    getattr(settings, 'NOTIFICATIONS_PUBSUB_BACKEND', 'notifications.pubsub.MemoryPubSub')
+                )
+                _pubsub = clase()
+    return _pubsub
+
+
+def serializar_notificacion(notification) -> dict:
+    """Datos mínimos que recibe el cliente; no consulta la base de datos si el tipo ya está cargado."""
+    return {
+        'id': notification.pk,
+        'titulo': notification.titulo,
+        'mensaje': notification.mensaje,
+        'estado': notification.estado,
+        'tipo_codigo': notification.tipo.codigo,
+        'ticket_id': notification.ticket_id,
+        'fecha_creacion': notification.fecha_creacion.isoformat(),
+    }
+
+
+def publicar_notificaciones(notificaciones, usuario_ids=None):
+    """
+    Publica las notificaciones a sus destinatarios una vez confirmada la
+    transacción. `usuario_ids` permite publicarlas a otros usuarios
+    (p. ej. los agregados a `destinatarios`).
+    """
+    envios = []
+    for notification in notificaciones:
+        mensaje = serializar_notificacion(notification)
+        for usuario_id in (usuario_ids or [notification.usuario_id]):
+            envios.append((canal_usuario(usuario_id), mensaje))
+    if not envios:
+        return
+
+    def _publicar():
+        pubsub = get_pubsub()
+        for canal, mensaje in envios:
+            try:
+                pubsub.publicar(canal, mensaje)
+            except Exception as e:
+                logger.error(f"Error publicando notificación en {canal}: {e}")
+
+    transaction.on_commit(_publicar)
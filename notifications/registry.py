@@ -0,0 +1,90 @@
+"""
+Registro en memoria de los tipos de notificación.
+
+Los tipos definidos en NotificationConfig.NOTIFICATION_TYPES se sincronizan
+con la base de datos después de cada `migrate` y quedan cacheados por
+`codigo`, así crear una notificación no consulta NotificationType. La caché
+se invalida al editar o borrar un tipo (p. ej. desde el admin) y cada entrada
+expira tras NOTIFICATION_TYPE_CACHE_TTL segundos para que los demás procesos
+también vean esos cambios.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .config import NotificationConfig
+from .models import NotificationType
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_TYPE_CACHE_TTL = getattr(settings, 'NOTIFICATION_TYPE_CACHE_TTL', 300)
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _guardar(tipo):
+    with _lock:
+        _cache[tipo.codigo] = (tipo, time.monotonic() + NOTIFICATION_TYPE_CACHE_TTL)
+
+
+def _guardar_al_confirmar(tipo):
+    # Solo se cachean tipos confirmados: si la transacción se revierte, la caché
+    # no queda apuntando a una fila que no existe. Fuera de una transacción
+    # on_commit ejecuta el callback de inmediato.
+    transaction.on_commit(lambda: _guardar(tipo))
+
+
+def limpiar_cache_tipos():
+    with _lock:
+        _cache.clear()
+
+
+def invalidar_tipo(sender, instance, **kwargs):
+    with _lock:
+        _cache.pop(instance.codigo, None)
+
+
+def sincronizar_tipos(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Crea los tipos de NotificationConfig que falten (sin pisar ediciones hechas
+    desde el admin) y carga todos los tipos en la caché. Se conecta a post_migrate.
+    """
+    existentes = {t.codigo: t for t in NotificationType.objects.using(using).all()}
+    nuevos = [
+        NotificationType(codigo=codigo, **datos)
+        for codigo, datos in NotificationConfig.NOTIFICATION_TYPES.items()
+        if codigo not in existentes
+    ]
+    if nuevos:
+        NotificationType.objects.using(using).bulk_create(nuevos, ignore_conflicts=True)
+        logger.info(f"Tipos de notificación creados: {', '.join(t.codigo for t in nuevos)}")
+        existentes = {t.codigo: t for t in NotificationType.objects.using(using).all()}
+
+    limpiar_cache_tipos()
+    for tipo in existentes.values():
+        _guardar(tipo)
+
+
+def obtener_tipo(codigo: str, defaults: dict = None):
+    """
+    Retorna el NotificationType de `codigo` desde la caché. Si no está se busca
+    en la base de datos; con `defaults` se crea si no existe. Retorna None si
+    el tipo no existe y no se indicaron `defaults` (los faltantes no se cachean).
+    """
+    with _lock:
+        entrada = _cache.get(codigo)
+    if entrada and entrada[1] > time.monotonic():
+        return entrada[0]
+
+    if defaults is None:
+        tipo = NotificationType.objects.filter(codigo=codigo).first()
+        if tipo is None:
+            return None
+    else:
+        tipo, _ = NotificationType.objects.get_or_create(codigo=codigo, defaults=defaults)
+    _guardar_al_confirmar(tipo)
+    return tipo
@@ -0,0 +1,192 @@
+"""
+Protección de los proveedores de correo: circuit breaker y limitador de tasa.
+
+Cada proveedor (SendGrid, SMTP) tiene su propio circuito y su propio token
+bucket. Cuando un proveedor falla varias veces seguidas el circuito se abre y
+los envíos se cortan de inmediato (sin gastar intentos) hasta que pase el
+tiempo de espera; entonces se deja pasar un envío de prueba (semiabierto). El
+token bucket mantiene el ritmo dentro de la cuota del proveedor y se reduce a
+la mitad cuando el proveedor responde que se excedió el límite.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+
+class ProveedorNoDisponible(Exception):
+    """El envío no se intentó; debe reprogramarse sin contar como intento fallido."""
+
+    def __init__(self, mensaje, reintentar_en: float):
+        super().__init__(mensaje)
+        self.reintentar_en = reintentar_en
+
+
+class EnvioOmitido(Exception):
+    """No hay proveedor configurado: el correo se descarta sin reintentos."""
+
+
+class CircuitBreaker:
+    CERRADO = 'cerrado'
+    ABIERTO = 'abierto'
+    SEMIABIERTO = 'semiabierto'
+
+    def __init__(self, nombre: str, umbral_fallos: int, tiempo_espera: float, reloj=time.monotonic):
+        self.nombre = nombre
+        self.umbral_fallos = umbral_fallos
+        self.tiempo_espera = tiempo_espera
+        self._reloj = reloj
+        self._lock = threading.Lock()
+        self._estado = self.CERRADO
+        self._fallos = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+
+    @property
+    def estado(self) -> str:
+        with self._lock:
+            return self._estado_actual()
+
+    def _estado_actual(self) -> str:
+        if self._estado == self.ABIERTO and self._reloj() - self._abierto_desde >= self.tiempo_espera:
+            self._estado = self.SEMIABIERTO
+            self._prueba_en_curso = False
+        return self._estado
+
+    def permitir(self) -> bool:
+        """Indica si se puede intentar un envío. En semiabierto solo deja pasar uno."""
+        with self._lock:
+            estado = self._estado_actual()
+            if estado == self.CERRADO:
+                return True
+            if estado == self.SEMIABIERTO and not self._prueba_en_curso:
+                self._prueba_en_curso = True
+                return True
+            return False
+
+    def liberar_prueba(self):
+        """
+        Devuelve el envío de prueba concedido por permitir() cuando al final no
+        se intentó (p. ej. no había cuota), para que el siguiente pueda probar.
+        Sin esto el circuito quedaría semiabierto sin resultado para siempre.
+        """
+        with self._lock:
+            self._prueba_en_curso = False
+
+    def segundos_para_reintentar(self) -> float:
+        with self._lock:
+            if self._estado_actual() != self.ABIERTO:
+                return 0.0
+            return max(self.tiempo_espera - (self._reloj() - self._abierto_desde), 0.0)
+
+    def registrar_exito(self):
+        with self._lock:
+            self._estado = self.CERRADO
+            self._fallos = 0
+            self._prueba_en_curso = False
+
+    def registrar_fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if self._estado_actual() == self.SEMIABIERTO or self._fallos >= self.umbral_fallos:
+                self._estado = self.ABIERTO
+                self._abierto_desde = self._reloj()
+                self._prueba_en_curso = False
+
+    def verificar(self):
+        """Lanza ProveedorNoDisponible si el circuito no permite envíos."""
+        if not self.permitir():
+            raise ProveedorNoDisponible(
+                f"Circuito de {self.nombre} abierto", max(self.segundos_para_reintentar(), 1.0)
+            )
+
+
+class TokenBucket:
+    """
+    Limitador de tasa: `tasa` tokens por segundo con ráfagas de hasta
+    `capacidad`. La tasa baja a la mitad con penalizar() (p. ej. ante un 429)
+    y se recupera poco a poco con cada envío exitoso.
+    """
+
+    def __init__(self, tasa: float, capacidad: float, reloj=time.monotonic, dormir=time.sleep):
+        self.tasa_nominal = tasa
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self._reloj = reloj
+        self._dormir = dormir
+        self._lock = threading.Lock()
+        self._tokens = capacidad
+        self._ultimo = reloj()
+
+    def _recargar(self):
+        ahora = self._reloj()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    def espera_para(self, tokens: float = 1) -> float:
+        with self._lock:
+            self._recargar()
+            faltantes = min(tokens, self.capacidad) - self._tokens
+            return max(faltantes / self.tasa, 0.0)
+
+    def adquirir(self, tokens: float = 1, espera_maxima: float = 0.0) -> bool:
+        """
+        Consume `tokens` esperando como máximo `espera_maxima` segundos.
+        Retorna False (sin consumir) si no alcanzan dentro de ese tiempo.
+        """
+        tokens = min(tokens, self.capacidad)
+        with self._lock:
+            self._recargar()
+            espera = (tokens - self._tokens) / self.tasa
+            if espera > espera_maxima:
+                return False
+            if espera > 0:
+                self._dormir(espera)
+                self._recargar()
+            self._tokens -= tokens
+            return True
+
+    def penalizar(self):
+        with self._lock:
+            self.tasa = max(self.tasa / 2, self.tasa_nominal / 16)
+
+    def recuperar(self):
+        with self._lock:
+            self.tasa = min(self.tasa * 1.1, self.tasa_nominal)
+
+
+def _crear_circuito(nombre):
+    return CircuitBreaker(
+        nombre,
+        umbral_fallos=getattr(settings, 'EMAIL_BREAKER_FAILURE_THRESHOLD', 5),
+        tiempo_espera=getattr(settings, 'EMAIL_BREAKER_RESET_SECONDS', 60),
+    )
+
+
+circuitos = {
+    'sendgrid': _crear_circuito('sendgrid'),
+    'smtp': _crear_circuito('smtp'),
+}
+
+limites = {
+    'sendgrid': TokenBucket(
+        tasa=getattr(settings, 'EMAIL_SENDGRID_RATE_PER_SECOND', 10),
+        capacidad=getattr(settings, 'EMAIL_SENDGRID_BURST', 100),
+    ),
+    'smtp': TokenBucket(
+        tasa=getattr(settings, 'EMAIL_SMTP_RATE_PER_SECOND', 5),
+        capacidad=getattr(settings, 'EMAIL_SMTP_BURST', 20),
+    ),
+}
+
+# Tiempo máximo que el worker espera por tokens antes de reprogramar el correo
+EMAIL_RATE_MAX_WAIT = getattr(settings, 'EMAIL_RATE_MAX_WAIT', 2.0)
+
+
+def reiniciar():
+    """Restablece circuitos y limitadores (usado por las pruebas)."""
+    for nombre in circuitos:
+        circuitos[nombre] = _crear_circuito(nombre)
+    for limite in limites.values():
+        limite.tasa = limite.tasa_nominal
+        limite._tokens = limite.capacidad
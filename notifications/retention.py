@@ -0,0 +1,133 @@
+"""
+Retención de notificaciones.
+
+Las notificaciones leídas por todos sus usuarios y más antiguas que la
+retención de su tipo (NotificationType.dias_retencion, o por defecto
+NOTIFICATIONS_RETENTION_DAYS) se archivan como JSONL comprimido en el
+storage por defecto (S3 o MEDIA_ROOT) y se eliminan por lotes acotados,
+de modo que la tabla caliente solo guarda lo reciente o pendiente. Cada
+lote se archiva antes de borrarlo, así una ejecución interrumpida no pierde
+datos. Lo ejecuta `manage.py prune_notifications`.
+"""
+import gzip
+import json
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
+
+from .models import Notification, NotificationCounter, NotificationDelivery, NotificationType
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS_RETENTION_DAYS = getattr(settings, 'NOTIFICATIONS_RETENTION_DAYS', 180)
+NOTIFICATIONS_RETENTION_BATCH_SIZE = getattr(settings, 'NOTIFICATIONS_RETENTION_BATCH_SIZE', 500)
+NOTIFICATIONS_ARCHIVE_PATH = getattr(settings, 'NOTIFICATIONS_ARCHIVE_PATH', 'notifications/archive')
+
+CAMPOS_ARCHIVO = (
+    'id', 'usuario_id', 'ticket_id', 'tipo__codigo', 'titulo', 'mensaje', 'descripcion',
+    'enviado_por_id', 'enviado_por_role', 'estado', 'fecha_creacion', 'fecha_envio', 'fecha_lectura',
+    'datos_adicionales',
+)
+
+
+def dias_de_retencion(tipo) -> int:
+    """Días de retención de `tipo`; 0 significa que no se depura."""
+    if tipo.dias_retencion is not None:
+        return tipo.dias_retencion
+    return NOTIFICATIONS_RETENTION_DAYS or 0
+
+
+def vencidas(tipo, ahora=None):
+    """Notificaciones de `tipo` fuera de su retención y sin entregas por leer."""
+    dias = dias_de_retencion(tipo)
+    if not dias:
+        return Notification.objects.none()
+    limite = (ahora or timezone.now()) - timedelta(days=dias)
+    por_leer = NotificationDelivery.objects.filter(notificacion=OuterRef('pk')).no_leidas()
+    return Notification.objects.filter(tipo=tipo, fecha_creacion__lt=limite).exclude(Exists(por_leer))
+
+
+def _registros(ids) -> list:
+    """Filas a archivar: la notificación con sus destinatarios y entregas."""
+    entregas = defaultdict(list)
+    for entrega in NotificationDelivery.objects.filter(notificacion_id__in=ids).values(
+        'notificacion_id', 'usuario_id', 'estado', 'fecha_lectura'
+    ):
+        entregas[entrega.pop('notificacion_id')].append(entrega)
+
+    registros = []
+    for fila in Notification.objects.filter(pk__in=ids).order_by('pk').values(*CAMPOS_ARCHIVO):
+        fila['tipo'] = fila.pop('tipo__codigo')
+        fila['entregas'] = entregas.get(fila['id'], [])
+        registros.append(fila)
+    return registros
+
+
+def archivar(registros, nombre: str) -> str:
+    """Guarda `registros` como JSONL comprimido con gzip y retorna la ruta en el storage."""
+    lineas = ''.join(json.dumps(r, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n' for r in registros)
+    ruta = f"{NOTIFICATIONS_ARCHIVE_PATH}/{nombre}.jsonl.gz"
+    return default_storage.save(ruta, ContentFile(gzip.compress(lineas.encode('utf-8'))))
+
+
+def eliminar(ids) -> int:
+    """
+    Elimina las notificaciones `ids` y sus entregas, descontando de los
+    contadores con un UPDATE por combinación de cambios en vez de uno por entrega.
+    """
+    with transaction.atomic():
+        deltas = defaultdict(lambda: defaultdict(int))
+        for fila in NotificationDelivery.objects.filter(notificacion_id__in=ids).values(
+            'usuario_id', 'estado'
+        ).annotate(cantidad=Count('id')).order_by():
+            deltas[fila['usuario_id']]['total'] -= fila['cantidad']
+            deltas[fila['usuario_id']][NotificationCounter.CAMPO_POR_ESTADO[fila['estado']]] -= fila['cantidad']
+        NotificationCounter.ajustar(deltas, crear=False)
+
+        with NotificationCounter.sin_ajustes_por_fila():
+            _, eliminadas = Notification.objects.filter(pk__in=ids).delete()
+    return eliminadas.get(Notification._meta.label, 0)
+
+
+def depurar_notificaciones(dry_run: bool = False, batch_size: int = None, archivar_antes: bool = True) -> dict:
+    """
+    Archiva y elimina las notificaciones vencidas de todos los tipos.
+    Retorna contadores por tipo y totales.
+    """
+    batch_size = batch_size or NOTIFICATIONS_RETENTION_BATCH_SIZE
+    ahora = timezone.now()
+    sello = ahora.strftime('%Y%m%d-%H%M%S')
+    resumen = {'eliminadas': 0, 'archivos': [], 'por_tipo': {}}
+
+    for tipo in NotificationType.objects.order_by('codigo'):
+        queryset = vencidas(tipo, ahora)
+        if dry_run:
+            cantidad = queryset.count()
+            if cantidad:
+                resumen['por_tipo'][tipo.codigo] = cantidad
+                resumen['eliminadas'] += cantidad
+            continue
+
+        lote = 0
+        while True:
+            ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            lote += 1
+            if archivar_antes:
+                resumen['archivos'].append(archivar(_registros(ids), f"{tipo.codigo}-{sello}-{lote:04d}"))
+            eliminadas = eliminar(ids)
+            resumen['por_tipo'][tipo.codigo] = resumen['por_tipo'].get(tipo.codigo, 0) + eliminadas
+            resumen['eliminadas'] += eliminadas
+
+    if resumen['eliminadas'] and not dry_run:
+        logger.info(f"Notificaciones depuradas: {resumen['eliminadas']} en {len(resumen['archivos'])} archivos")
+    return resumen
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import Notification, NotificationType
+from .models import Notification, NotificationPreference, NotificationType
+from .registry import obtener_tipo
 
 
 class NotificationUpdateSerializer(serializers.ModelSerializer):
@@ -9,10 +10,47 @@ class NotificationUpdateSerializer(serializers.ModelSerializer):
         
     def update(self, instance, validated_data):
         if validated_data.get('estado') == Notification.Estado.LEIDA:
-            instance.marcar_como_leida()
+            request = self.context.get('request')
+            instance.marcar_como_leida(request.user if request else None)
+            instance.estado = Notification.Estado.LEIDA
         return instance
 
 
+class NotificationBulkMarkReadSerializer(serializers.Serializer):
+    """Selecciona las notificaciones a marcar como leídas por ids o por filtros."""
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, max_length=1000)
+    tipo = serializers.CharField(required=False, help_text="Código del tipo de notificación")
+    ticket = serializers.IntegerField(required=False, help_text="ID del ticket relacionado")
+    before = serializers.DateTimeField(required=False, help_text="Solo notificaciones creadas antes de esta fecha")
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError(
+                "Indique 'ids' o al menos un filtro (tipo, ticket, before). Use mark-all-read/ para marcar todas."
+            )
+        return attrs
+
+    def filtrar(self, queryset):
+        """Aplica la selección validada a un queryset de entregas (NotificationDelivery)."""
+        data = self.validated_data
+        if 'ids' in data:
+            queryset = queryset.filter(notificacion_id__in=data['ids'])
+        if 'tipo' in data:
+            queryset = queryset.filter(notificacion__tipo__codigo=data['tipo'])
+        if 'ticket' in data:
+            queryset = queryset.filter(notificacion__ticket_id=data['ticket'])
+        if 'before' in data:
+            queryset = queryset.filter(fecha_creacion__lt=data['before'])
+        return queryset
+
+
+class NotificationPreferenceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = NotificationPreference
+        fields = ['frecuencia_email', 'fecha_actualizacion']
+        read_only_fields = ['fecha_actualizacion']
+
+
 class NotificationTypeSerializer(serializers.ModelSerializer):
     class Meta:
         model = NotificationType
@@ -186,51 +224,48 @@ class CreateNotificationSerializer(serializers.ModelSerializer):
         ]
     
     def validate_user_documents(self, value):
-        """Valida que los documentos de los destinatarios existan y retorna los usuarios."""
+        """Valida con una sola consulta que los destinatarios existan y retorna los usuarios."""
         from django.contrib.auth import get_user_model
         User = get_user_model()
-        users = []
-        for doc in value:
-            try:
-                users.append(User.objects.get(document=doc))
-            except User.DoesNotExist:
-                raise serializers.ValidationError(f"Usuario no encontrado: {doc}")
-        return users
+        documentos = list(dict.fromkeys(value))
+        usuarios = User.objects.in_bulk(documentos, field_name='document')
+        faltantes = [doc for doc in documentos if doc not in usuarios]
+        if faltantes:
+            raise serializers.ValidationError(f"Usuarios no encontrados: {', '.join(faltantes)}")
+        return [usuarios[doc] for doc in documentos]
     
     def validate_tipo_codigo(self, value):
-        """Valida que el tipo de notificación exista."""
-        try:
-            NotificationType.objects.get(codigo=value, es_activo=True)
-        except NotificationType.DoesNotExist:
+        """Valida que el tipo de notificación exista (desde el registro en memoria)."""
+        tipo = obtener_tipo(value)
+        if tipo is None or not tipo.es_activo:
             raise serializers.ValidationError("Tipo de notificación no encontrado o inactivo")
+        self._tipo = tipo
         return value
     
     def validate_ticket_id(self, value):
         """Valida que el ticket exista si se proporciona."""
+        self._ticket = None
         if value is not None:
             from tickets.models import Ticket
-            try:
-                Ticket.objects.get(id=value)
-            except Ticket.DoesNotExist:
+            self._ticket = Ticket.objects.filter(id=value).first()
+            if self._ticket is None:
                 raise serializers.ValidationError("Ticket no encontrado")
         return value
     
+    def validate(self, attrs):
+        # Los objetos ya consultados al validar pasan a create sin volver a buscarlos
+        attrs['tipo'] = self._tipo
+        attrs['ticket'] = getattr(self, '_ticket', None)
+        return attrs
+    
     def create(self, validated_data):
         """Crea la notificación."""
-        from django.contrib.auth import get_user_model
-        from tickets.models import Ticket
         from django.utils import timezone
         
-        User = get_user_model()
         # Obtener destinatarios (validate_user_documents devuelve lista de User)
         destinatarios = validated_data.pop('user_documents', [])
-
-        # Obtener tipo de notificación
-        tipo = NotificationType.objects.get(codigo=validated_data['tipo_codigo'])
-
-        ticket = None
-        if validated_data.get('ticket_id'):
-            ticket = Ticket.objects.get(id=validated_data['ticket_id'])
+        tipo = validated_data['tipo']
+        ticket = validated_data['ticket']
 
         # Verificar que el emisor viene en el contexto y tiene rol permitido
         request = self.context.get('request')
@@ -261,4 +296,6 @@ class CreateNotificationSerializer(serializers.ModelSerializer):
 
         if destinatarios:
             notification.destinatarios.set(destinatarios)
+
+        return notification
     
\ No newline at end of file
@@ -1,27 +1,26 @@
 import logging
-import time
-import socket
+from contextlib import nullcontext
 from typing import Dict, Any, Optional
-from concurrent.futures import ThreadPoolExecutor
 
-from django.core.mail import send_mail, EmailMultiAlternatives
+from django.core.mail import send_mail
 from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from django.template.loader import render_to_string
-from smtplib import SMTPException, SMTPServerDisconnected
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
 
-from .models import Notification, NotificationType
+from .email_queue import encolar_email, encolar_emails
+from .email_templates import nombre_plantilla, renderizar
+from .models import EmailJob, Notification, NotificationDelivery, NotificationPreference, NotificationType
+from .pubsub import publicar_notificaciones
+from .registry import obtener_tipo
 from tickets.models import Ticket
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
-# Pool global de hilos para envío de correos, evita crear un hilo nuevo por email
-EMAIL_MAX_WORKERS = getattr(settings, "EMAIL_MAX_WORKERS", 5)
-_email_executor = ThreadPoolExecutor(max_workers=EMAIL_MAX_WORKERS)
+# Marcador del saludo: se reemplaza por el nombre de cada destinatario al enviar,
+# de modo que el cuerpo renderizado es el mismo para todos y puede agruparse
+TOKEN_NOMBRE_DESTINATARIO = '-nombre_destinatario-'
 
 
 class NotificationService:
@@ -41,14 +40,16 @@ class NotificationService:
                     ticket, 'ticket_creado',
                     'Su ticket ha sido creado exitosamente',
                     'Su ticket ha sido registrado en nuestro sistema.',
-                    resultados
+                    resultados,
+                    evento='creacion'
                 )
             if ticket.tecnico:
                 cls._enviar_notificacion_tecnico(
                     ticket, 'ticket_asignado',
                     'Nuevo ticket asignado',
                     'Se le ha asignado un nuevo ticket.',
-                    resultados
+                    resultados,
+                    evento='creacion'
                 )
                 
         except Exception as e:
@@ -75,7 +76,8 @@ class NotificationService:
                     f'Estado del ticket actualizado a: {ticket.estado.nombre}',
                     f'El estado de su ticket ha cambiado de "{estado_anterior}" a "{ticket.estado.nombre}".',
                     resultados,
-                    datos_adicionales={'estado_anterior': estado_anterior}
+                    datos_adicionales={'estado_anterior': estado_anterior},
+                    evento=cls._evento_ticket(ticket)
                 )
                 
         except Exception as e:
@@ -94,15 +96,13 @@ class NotificationService:
         }
         
         try:
-            administradores = User.objects.filter(role=User.Role.ADMIN, is_active=True)
-            
-            for admin in administradores:
-                cls._enviar_notificacion_admin(
-                    ticket, 'solicitud_finalizacion',
-                    'Solicitud de finalización de ticket',
-                    f'El técnico {ticket.tecnico.email} solicita finalizar el ticket #{ticket.pk}.',
-                    resultados
-                )
+            cls._enviar_notificacion_masiva(
+                cls._administradores_activos(), ticket, 'solicitud_finalizacion',
+                'Solicitud de finalización de ticket',
+                f'El técnico {ticket.tecnico.email} solicita finalizar el ticket #{ticket.pk}.',
+                resultados,
+                evento=cls._evento_ticket(ticket)
+            )
                 
         except Exception as e:
             logger.error(f"Error enviando solicitud de finalización: {e}")
@@ -125,7 +125,8 @@ class NotificationService:
                     ticket, 'ticket_finalizado',
                     'Ticket finalizado',
                     'Su ticket ha sido finalizado exitosamente.',
-                    resultados
+                    resultados,
+                    evento=cls._evento_ticket(ticket)
                 )
             
             if ticket.tecnico:
@@ -133,7 +134,8 @@ class NotificationService:
                     ticket, 'ticket_finalizado',
                     'Ticket finalizado',
                     'El ticket que tenía asignado ha sido finalizado.',
-                    resultados
+                    resultados,
+                    evento=cls._evento_ticket(ticket)
                 )
                 
         except Exception as e:
@@ -164,24 +166,21 @@ class NotificationService:
             if state_request.requested_by:
                 tecnico_nombre = state_request.requested_by.get_full_name()
             
-            # Obtener todos los administradores activos
-            administradores = User.objects.filter(role=User.Role.ADMIN, is_active=True)
-            
-            for admin in administradores:
-                cls._enviar_notificacion_admin(
-                    ticket, 'solicitud_cambio_estado',
-                    'Solicitud de cambio de estado',
-                    f'El técnico {tecnico_nombre} solicita cambiar el estado del ticket #{ticket_pk} de "{from_state_nombre}" a "{to_state_nombre}". Razón: {reason}',
-                    resultados,
-                    usuario_destino=admin,
-                    datos_adicionales={
-                        'state_request_id': state_request.id,
-                        'from_state': from_state_nombre,
-                        'to_state': to_state_nombre,
-                        'reason': reason,
-                        'requested_by': tecnico_nombre
-                    }
-                )
+            # Notificar a todos los administradores activos en un solo lote
+            cls._enviar_notificacion_masiva(
+                cls._administradores_activos(), ticket, 'solicitud_cambio_estado',
+                'Solicitud de cambio de estado',
+                f'El técnico {tecnico_nombre} solicita cambiar el estado del ticket #{ticket_pk} de "{from_state_nombre}" a "{to_state_nombre}". Razón: {reason}',
+                resultados,
+                datos_adicionales={
+                    'state_request_id': state_request.id,
+                    'from_state': from_state_nombre,
+                    'to_state': to_state_nombre,
+                    'reason': reason,
+                    'requested_by': tecnico_nombre
+                },
+                evento=f"solicitud:{state_request.pk}"
+            )
                 
         except Exception as e:
             logger.error(f"Error enviando solicitud de cambio de estado: {e}")
@@ -227,7 +226,8 @@ class NotificationService:
                         'state_request_id': state_request.id,
                         'approved_by': approved_by_name,
                         'new_state': to_state_nombre
-                    }
+                    },
+                    evento=f"aprobacion:{state_request.pk}"
                 )
             
             # Notificar al cliente sobre el cambio de estado
@@ -242,7 +242,8 @@ class NotificationService:
                         'from_state': from_state_nombre,
                         'to_state': to_state_nombre,
                         'approved_by': approved_by_name
-                    }
+                    },
+                    evento=f"aprobacion:{state_request.pk}"
                 )
             
             # Notificar al administrador que aprobó el cambio
@@ -258,7 +259,8 @@ class NotificationService:
                         'from_state': from_state_nombre,
                         'to_state': to_state_nombre,
                         'requested_by': requested_by_name
-                    }
+                    },
+                    evento=f"aprobacion:{state_request.pk}"
                 )
                 
         except Exception as e:
@@ -308,7 +310,8 @@ class NotificationService:
                         'to_state': to_state_nombre,
                         'rejected_by': rejected_by_name,
                         'rejection_reason': rejection_reason
-                    }
+                    },
+                    evento=f"rechazo:{state_request.pk}"
                 )
             
             # Notificar al cliente sobre el rechazo del cambio
@@ -324,7 +327,8 @@ class NotificationService:
                         'to_state': to_state_nombre,
                         'rejected_by': rejected_by_name,
                         'rejection_reason': rejection_reason
-                    }
+                    },
+                    evento=f"rechazo:{state_request.pk}"
                 )
             
             # Notificar al administrador que rechazó el cambio
@@ -341,7 +345,8 @@ class NotificationService:
                         'to_state': to_state_nombre,
                         'requested_by': requested_by_name,
                         'rejection_reason': rejection_reason
-                    }
+                    },
+                    evento=f"rechazo:{state_request.pk}"
                 )
                 
         except Exception as e:
@@ -365,6 +370,7 @@ class NotificationService:
             estado_final = ticket.estado.nombre
             approved_by = state_request.approved_by.get_full_name() if state_request and state_request.approved_by else "Administrador"
             approval_message = state_request.reason if state_request else None
+            evento = f"cierre:{state_request.pk}" if state_request else cls._evento_ticket(ticket)
             
             # Notificar al cliente
             if ticket.cliente:
@@ -379,7 +385,8 @@ class NotificationService:
                         'approved_by': approved_by,
                         'approval_message': approval_message,
                         'fecha_cierre': ticket.estado.updated_at if hasattr(ticket.estado, 'updated_at') else None
-                    }
+                    },
+                    evento=evento
                 )
             
             # Notificar al técnico
@@ -395,7 +402,8 @@ class NotificationService:
                         'approved_by': approved_by,
                         'approval_message': approval_message,
                         'fecha_cierre': ticket.estado.updated_at if hasattr(ticket.estado, 'updated_at') else None
-                    }
+                    },
+                    evento=evento
                 )
                 
         except Exception as e:
@@ -414,13 +422,16 @@ class NotificationService:
         }
         
         try:
+            evento = cls._evento_ticket(ticket)
+
             # Notificar al cliente
             if ticket.cliente:
                 cls._enviar_notificacion_cliente(
                     ticket, 'ticket_cancelado',
                     'Su ticket ha sido cancelado',
                     f'Su ticket #{ticket.pk} "{ticket.titulo}" ha sido cancelado exitosamente.',
-                    resultados
+                    resultados,
+                    evento=evento
                 )
             
             # Notificar al técnico (si está asignado)
@@ -429,20 +440,18 @@ class NotificationService:
                     ticket, 'ticket_cancelado',
                     'Ticket cancelado',
                     f'El ticket #{ticket.pk} "{ticket.titulo}" que tenía asignado ha sido cancelado.',
-                    resultados
+                    resultados,
+                    evento=evento
                 )
 
             # Notificar a los administradores
-            administradores = User.objects.filter(role=User.Role.ADMIN, is_active=True)
-            for admin in administradores:
-                # No notificar al admin si él mismo fue el que lo canceló (opcional, pero mejor notificar a todos)
-                cls._enviar_notificacion_admin(
-                    ticket, 'ticket_cancelado',
-                    'Ticket cancelado',
-                    f'El ticket #{ticket.pk} "{ticket.titulo}" ha sido cancelado.',
-                    resultados,
-                    usuario_destino=admin
-                )
+            cls._enviar_notificacion_masiva(
+                cls._administradores_activos(), ticket, 'ticket_cancelado',
+                'Ticket cancelado',
+                f'El ticket #{ticket.pk} "{ticket.titulo}" ha sido cancelado.',
+                resultados,
+                evento=evento
+            )
                 
         except Exception as e:
             logger.error(f"Error enviando notificaciones de ticket cancelado: {e}")
@@ -462,6 +471,8 @@ class NotificationService:
         }
         
         try:
+            evento = cls._evento_ticket(ticket)
+
             if tecnico_anterior:
                 cls._enviar_notificacion_tecnico(
                     ticket, 'tecnico_cambiado',
@@ -484,7 +495,8 @@ class NotificationService:
                             'documento': ticket.tecnico.document,
                             'telefono': ticket.tecnico.number
                         }
-                    }
+                    },
+                    evento=evento
                 )
             
             if ticket.tecnico:
@@ -508,7 +520,8 @@ class NotificationService:
                             'documento': ticket.tecnico.document,
                             'telefono': ticket.tecnico.number
                         }
-                    }
+                    },
+                    evento=evento
                 )
                 
         except Exception as e:
@@ -520,40 +533,51 @@ class NotificationService:
     @classmethod
     def _enviar_notificacion_cliente(cls, ticket: Ticket, tipo_codigo: str, titulo: str, 
                                    mensaje: str, resultados: Dict, usuario_destino: User = None,
-                                   datos_adicionales: Dict = None):
+                                   datos_adicionales: Dict = None, evento: str = None):
         usuario = usuario_destino or ticket.cliente
         cls._enviar_notificacion_completa(
-            usuario, ticket, tipo_codigo, titulo, mensaje, resultados, datos_adicionales
+            usuario, ticket, tipo_codigo, titulo, mensaje, resultados, datos_adicionales,
+            evento=evento
         )
     
     @classmethod
     def _enviar_notificacion_tecnico(cls, ticket: Ticket, tipo_codigo: str, titulo: str,
                                    mensaje: str, resultados: Dict, usuario_destino: User = None,
-                                   datos_adicionales: Dict = None):
+                                   datos_adicionales: Dict = None, evento: str = None):
         usuario = usuario_destino or ticket.tecnico
         cls._enviar_notificacion_completa(
-            usuario, ticket, tipo_codigo, titulo, mensaje, resultados, datos_adicionales
+            usuario, ticket, tipo_codigo, titulo, mensaje, resultados, datos_adicionales,
+            evento=evento
         )
     
     @classmethod
     def _enviar_notificacion_admin(cls, ticket: Ticket, tipo_codigo: str, titulo: str,
                                  mensaje: str, resultados: Dict, usuario_destino: User = None,
-                                 datos_adicionales: Dict = None):
+                                 datos_adicionales: Dict = None, evento: str = None):
         usuario = usuario_destino or ticket.administrador
         cls._enviar_notificacion_completa(
-            usuario, ticket, tipo_codigo, titulo, mensaje, resultados, datos_adicionales
+            usuario, ticket, tipo_codigo, titulo, mensaje, resultados, datos_adicionales,
+            evento=evento
         )
     
     @classmethod
     def _enviar_notificacion_completa(cls, usuario: User, ticket: Ticket, tipo_codigo: str,
                                     titulo: str, mensaje: str, resultados: Dict,
-                                    datos_adicionales: Dict = None):
+                                    datos_adicionales: Dict = None, evento: str = None):
+        """
+        Crea la notificación y encola el correo. Con `evento` la notificación
+        lleva una clave de idempotencia y, si el mismo evento ya se notificó a
+        este usuario (reintento o signal y vista a la vez), no se repite
+        ninguna de las dos cosas.
+        """
         if not cls._validar_usuario_para_notificacion(usuario):
             logger.warning(f"Usuario inválido para notificación: {usuario}")
             return
-        cls._crear_notificacion_interna(
-            usuario, ticket, tipo_codigo, titulo, mensaje, datos_adicionales
-        )
+        clave = cls._clave_idempotencia(tipo_codigo, ticket, evento, usuario) if evento else None
+        if not cls._crear_notificacion_interna(
+            usuario, ticket, tipo_codigo, titulo, mensaje, datos_adicionales, clave
+        ):
+            return
         resultados['notificaciones_internas'] += 1
         
         # Enviar email
@@ -567,44 +591,213 @@ class NotificationService:
             resultados['emails_fallidos'] += 1
             resultados['errores'].append(f"Email fallido para {usuario.email}: {str(e)}")
     
+    @classmethod
+    def _administradores_activos(cls):
+        return list(User.objects.filter(role=User.Role.ADMIN, is_active=True))
+
+    @classmethod
+    def _enviar_notificacion_masiva(cls, usuarios, ticket: Ticket, tipo_codigo: str,
+                                    titulo: str, mensaje: str, resultados: Dict,
+                                    datos_adicionales: Dict = None,
+                                    verificar_existencia: bool = False,
+                                    evento: str = None):
+        """
+        Notifica a varios destinatarios con un número constante de consultas:
+        resuelve el tipo una vez, valida en memoria (los usuarios ya vienen de
+        la base de datos), inserta todas las notificaciones con un bulk_create
+        y encola todos los correos en otro, renderizando una vez por plantilla.
+        Con `verificar_existencia` se confirma la lista contra la base de datos
+        en una sola consulta, útil si las instancias pueden estar desactualizadas.
+        Con `evento` cada notificación lleva su clave de idempotencia y se omiten
+        los destinatarios a los que ya se notificó ese evento (notificación y
+        correo), de modo que repetir el envío no duplica nada.
+        """
+        if verificar_existencia:
+            destinatarios = cls._filtrar_usuarios_existentes(usuarios)
+        else:
+            destinatarios = [u for u in usuarios if cls._validar_usuario_para_notificacion(u)]
+        if not destinatarios:
+            return
+
+        claves = {}
+        if evento:
+            claves = {
+                usuario.pk: cls._clave_idempotencia(tipo_codigo, ticket, evento, usuario)
+                for usuario in destinatarios
+            }
+            existentes = set(
+                Notification.objects.filter(clave_idempotencia__in=claves.values())
+                .values_list('clave_idempotencia', flat=True)
+            )
+            destinatarios = [u for u in destinatarios if claves[u.pk] not in existentes]
+            if not destinatarios:
+                logger.info(f"Evento {tipo_codigo}:{ticket.pk}:{evento} ya notificado, se omite")
+                return
+
+        try:
+            tipo_notificacion = cls._obtener_tipo_notificacion(tipo_codigo, titulo, destinatarios[0])
+            ahora = timezone.now()
+            nuevas = [
+                Notification(
+                    usuario=usuario,
+                    ticket=ticket,
+                    tipo=tipo_notificacion,
+                    titulo=titulo,
+                    mensaje=mensaje,
+                    datos_adicionales=datos_adicionales or {},
+                    estado=Notification.Estado.ENVIADA,
+                    fecha_creacion=ahora,
+                    fecha_envio=ahora,
+                    clave_idempotencia=claves.get(usuario.pk),
+                )
+                for usuario in destinatarios
+            ]
+            if claves:
+                # Otro proceso puede notificar el mismo evento entre la consulta
+                # anterior y el insert: la restricción única descarta esas filas.
+                # ignore_conflicts no devuelve las pk, así que se releen las que
+                # insertó esta llamada (mismas claves y misma fecha_creacion)
+                Notification.objects.bulk_create(nuevas, ignore_conflicts=True)
+                creadas = list(Notification.objects.filter(
+                    clave_idempotencia__in=[n.clave_idempotencia for n in nuevas],
+                    fecha_creacion=ahora,
+                ))
+                for notificacion in creadas:
+                    notificacion.tipo = tipo_notificacion
+                insertados = {notificacion.usuario_id for notificacion in creadas}
+                destinatarios = [u for u in destinatarios if u.pk in insertados]
+            else:
+                creadas = Notification.objects.bulk_create(nuevas)
+            resultados['notificaciones_internas'] += len(creadas)
+            # bulk_create no pasa por save() ni dispara post_save: crear las
+            # entregas y publicar al stream explícitamente
+            NotificationDelivery.crear([(notificacion, notificacion.usuario_id) for notificacion in creadas])
+            publicar_notificaciones(creadas)
+        except Exception as e:
+            logger.error(f"Error creando notificaciones internas masivas: {e}")
+
+        if not destinatarios:
+            return
+
+        try:
+            if datos_adicionales:
+                ticket._notification_data = datos_adicionales
+            renderizados = {}
+            correos = []
+            for usuario in destinatarios:
+                plantilla = cls._obtener_plantilla_html(usuario, tipo_codigo)
+                if plantilla not in renderizados:
+                    renderizados[plantilla] = cls._renderizar_email(usuario, ticket, tipo_codigo, titulo, mensaje)
+                asunto, texto, html = renderizados[plantilla]
+                correos.append(EmailJob(
+                    destinatario=usuario.email,
+                    ticket=ticket,
+                    titulo=titulo[:200],
+                    mensaje=mensaje,
+                    asunto=asunto,
+                    cuerpo_texto=texto,
+                    cuerpo_html=html,
+                    sustituciones={TOKEN_NOMBRE_DESTINATARIO: usuario.first_name or usuario.email},
+                ))
+            encolar_emails(correos, NotificationPreference.frecuencias_para(destinatarios))
+            resultados['emails_enviados'] += len(correos)
+        except Exception as e:
+            logger.error(f"Error encolando emails masivos de {tipo_codigo}: {e}")
+            resultados['emails_fallidos'] += len(destinatarios)
+            resultados['errores'].append(f"Emails fallidos para {tipo_codigo}: {str(e)}")
+
+    @classmethod
+    def _obtener_tipo_notificacion(cls, tipo_codigo: str, titulo: str, usuario: User) -> NotificationType:
+        # Los tipos conocidos vienen de la caché del registro; los nuevos se crean una vez
+        return obtener_tipo(
+            tipo_codigo,
+            defaults={
+                'nombre': titulo,
+                'descripcion': f'Notificación automática para {tipo_codigo}',
+                'enviar_a_cliente': usuario.role == User.Role.CLIENT,
+                'enviar_a_tecnico': usuario.role == User.Role.TECH,
+                'enviar_a_admin': usuario.role == User.Role.ADMIN,
+            }
+        )
+
+    @classmethod
+    def _evento_ticket(cls, ticket: Ticket) -> str:
+        """
+        Identifica el último guardado del ticket: estado anterior, estado nuevo
+        y `actualizado_en` previo, que registra el pre_save de tickets. El
+        signal y la vista que notifican el mismo cambio obtienen el mismo valor;
+        una transición repetida más tarde parte de otro `actualizado_en`. Si el
+        ticket no viene de un save se usa su versión actual.
+        """
+        marca = getattr(ticket, '_old_actualizado_en', None)
+        if marca is None:
+            return f"{ticket.estado_id}@{ticket.actualizado_en.isoformat()}"
+        anterior = getattr(ticket, '_old_estado', None)
+        return f"{anterior.pk if anterior else ''}>{ticket.estado_id}@{marca.isoformat()}"
+
+    @classmethod
+    def _clave_idempotencia(cls, tipo_codigo: str, ticket: Ticket, evento: str, usuario: User) -> str:
+        return f"{tipo_codigo}:{ticket.pk}:{evento}:{usuario.pk}"
+
     @classmethod
     def _crear_notificacion_interna(cls, usuario: User, ticket: Ticket, tipo_codigo: str,
-                                  titulo: str, mensaje: str, datos_adicionales: Dict = None):
+                                  titulo: str, mensaje: str, datos_adicionales: Dict = None,
+                                  clave: str = None) -> bool:
+        """Retorna False si ya existe una notificación con la misma clave de idempotencia."""
         try:
-            # Optimización: usar only() para obtener solo los campos necesarios
-            tipo_notificacion, created = NotificationType.objects.get_or_create(
-                codigo=tipo_codigo,
-                defaults={
-                    'nombre': titulo,
-                    'descripcion': f'Notificación automática para {tipo_codigo}',
-                    'enviar_a_cliente': usuario.role == User.Role.CLIENT,
-                    'enviar_a_tecnico': usuario.role == User.Role.TECH,
-                    'enviar_a_admin': usuario.role == User.Role.ADMIN,
-                }
-            )
+            tipo_notificacion = cls._obtener_tipo_notificacion(tipo_codigo, titulo, usuario)
             
-            # Optimización: crear notificación con bulk_create si hay múltiples, o create si es una sola
-            notification = Notification.objects.create(
-                usuario=usuario,
-                ticket=ticket,
-                tipo=tipo_notificacion,
-                titulo=titulo,
-                mensaje=mensaje,
-                datos_adicionales=datos_adicionales or {},
-                estado=Notification.Estado.ENVIADA,
-                fecha_envio=timezone.now()
-            )
+            # El savepoint solo hace falta si la clave puede chocar con otra notificación
+            with transaction.atomic() if clave else nullcontext():
+                Notification.objects.create(
+                    usuario=usuario,
+                    ticket=ticket,
+                    tipo=tipo_notificacion,
+                    titulo=titulo,
+                    mensaje=mensaje,
+                    datos_adicionales=datos_adicionales or {},
+                    estado=Notification.Estado.ENVIADA,
+                    fecha_envio=timezone.now(),
+                    clave_idempotencia=clave
+                )
             
+        except IntegrityError as e:
+            if clave and Notification.objects.filter(clave_idempotencia=clave).exists():
+                logger.info(f"Notificación ya enviada para el evento {clave}, se omite")
+                return False
+            logger.error(f"Error creando notificación interna: {e}")
         except Exception as e:
             logger.error(f"Error creando notificación interna: {e}")
+        return True
     
     @classmethod
     def _enviar_email(cls, usuario: User, ticket: Ticket, tipo_codigo: str,
                      titulo: str, mensaje: str):
         """
-        Decide el método de envío:
-        - Si hay SENDGRID_API_KEY configurada, usa la API HTTP de SendGrid.
-        - En caso contrario, usa el backend SMTP configurado en Django.
+        Renderiza el correo y lo guarda en la cola persistente (EmailJob).
+        El envío real (SendGrid o SMTP, con reintentos) lo hace el comando
+        `run_email_worker`, así la petición HTTP no espera al proveedor y los
+        correos no se pierden si el proceso web se reinicia.
+        """
+        subject, text_content, html_content = cls._renderizar_email(
+            usuario, ticket, tipo_codigo, titulo, mensaje
+        )
+        encolar_email(
+            usuario.email, subject, text_content, html_content,
+            sustituciones={TOKEN_NOMBRE_DESTINATARIO: usuario.first_name or usuario.email},
+            ticket=ticket,
+            titulo=titulo,
+            mensaje=mensaje,
+            frecuencia=NotificationPreference.frecuencias_para([usuario]).get(usuario.email),
+        )
+
+    @classmethod
+    def _renderizar_email(cls, usuario: User, ticket: Ticket, tipo_codigo: str,
+                          titulo: str, mensaje: str):
+        """
+        Retorna (asunto, texto, html). El nombre del destinatario queda como
+        TOKEN_NOMBRE_DESTINATARIO, así el resultado sirve para todos los
+        usuarios que comparten plantilla.
         """
         subject = f"{titulo} - Ticket #{ticket.pk}"
 
@@ -617,195 +810,26 @@ class NotificationService:
             "titulo": titulo,
             "mensaje": mensaje,
             "datos_adicionales": getattr(ticket, "_notification_data", {}),
+            "nombre_destinatario": TOKEN_NOMBRE_DESTINATARIO,
         }
 
-        def _send_via_sendgrid():
-            """Envío usando la API HTTP de SendGrid."""
-            api_key = getattr(settings, "SENDGRID_API_KEY", "")
-            if not api_key:
-                raise RuntimeError("SENDGRID_API_KEY no está configurada")
-
-            html_content = render_to_string(template_html, context)
-            text_content = cls._generar_contenido_texto_plano(
-                usuario, ticket, titulo, mensaje
-            )
-
-            message = Mail(
-                from_email=getattr(
-                    settings,
-                    "SENDGRID_FROM_EMAIL",
-                    getattr(
-                        settings, "DEFAULT_FROM_EMAIL", "noreply@tickethelp.com"
-                    ),
-                ),
-                to_emails=[usuario.email],
-                subject=subject,
-                plain_text_content=text_content,
-                html_content=html_content,
-            )
-
-            max_retries = 3
-            retry_delay = 2
-
-            for attempt in range(max_retries):
-                try:
-                    sg = SendGridAPIClient(api_key)
-                    response = sg.send(message)
-                    logger.info(
-                        f"SendGrid email enviado a {usuario.email} "
-                        f"(status {response.status_code}, intento {attempt + 1})"
-                    )
-                    return
-                except Exception as e:
-                    if attempt < max_retries - 1:
-                        wait_time = retry_delay * (2**attempt)
-                        logger.warning(
-                            f"Error enviando email con SendGrid a {usuario.email} "
-                            f"(intento {attempt + 1}/{max_retries}): {e}. "
-                            f"Reintentando en {wait_time} segundos..."
-                        )
-                        time.sleep(wait_time)
-                    else:
-                        logger.error(
-                            f"Fallo definitivo enviando email con SendGrid a "
-                            f"{usuario.email}: {e}"
-                        )
-                        # Dejar que fuera se intente fallback SMTP
-                        raise
-
-        def _send_via_smtp():
-            """Envío usando el backend SMTP configurado en Django."""
-            if not getattr(settings, "EMAIL_HOST", None):
-                logger.warning(
-                    "Configuración de EMAIL_HOST no encontrada, saltando envío SMTP"
-                )
-                return
-
-            html_content = render_to_string(template_html, context)
-            text_content = cls._generar_contenido_texto_plano(
-                usuario, ticket, titulo, mensaje
-            )
-
-            email = EmailMultiAlternatives(
-                subject=subject,
-                body=text_content,
-                from_email=getattr(
-                    settings, "DEFAULT_FROM_EMAIL", "noreply@tickethelp.com"
-                ),
-                to=[usuario.email],
-            )
-            email.attach_alternative(html_content, "text/html")
-
-            max_retries = 3
-            retry_delay = 2  # segundos
-
-            for attempt in range(max_retries):
-                try:
-                    from django.core.mail import get_connection
-
-                    connection = get_connection(
-                        timeout=getattr(settings, "EMAIL_TIMEOUT", 30)
-                    )
-                    email.connection = connection
-                    email.send()
-                    logger.info(
-                        f"SMTP email enviado exitosamente a {usuario.email} "
-                        f"(intento {attempt + 1})"
-                    )
-                    return  # Éxito, salir del loop
-                except (
-                    SMTPException,
-                    SMTPServerDisconnected,
-                    ConnectionError,
-                    TimeoutError,
-                    socket.error,
-                    OSError,
-                ) as e:
-                    if attempt < max_retries - 1:
-                        wait_time = retry_delay * (2**attempt)
-                        logger.warning(
-                            f"Error de conexión SMTP para {usuario.email} "
-                            f"(intento {attempt + 1}/{max_retries}): {e}. "
-                            f"Reintentando en {wait_time} segundos..."
-                        )
-                        time.sleep(wait_time)
-                    else:
-                        logger.error(
-                            f"Error enviando email SMTP para {usuario.email} "
-                            f"después de {max_retries} intentos: {e}"
-                        )
-                        raise
-
-        def _send():
-            """
-            Función interna que decide el proveedor y se ejecuta en un hilo del pool
-            para no bloquear la petición HTTP.
-            """
-            try:
-                if getattr(settings, "SENDGRID_API_KEY", ""):
-                    _send_via_sendgrid()
-                else:
-                    _send_via_smtp()
-            except Exception:
-                # Fallback: si SendGrid falla, intentar SMTP, si no se intentó ya
-                if getattr(settings, "SENDGRID_API_KEY", ""):
-                    try:
-                        _send_via_smtp()
-                    except Exception as e:
-                        logger.error(
-                            f"No se pudo enviar email ni con SendGrid ni con SMTP "
-                            f"para {usuario.email}: {e}"
-                        )
-                else:
-                    logger.error(
-                        f"No se pudo enviar email para {usuario.email} por error inesperado"
-                    )
-
-        # Encolar el envío en el pool de hilos para que no bloquee la petición
-        try:
-            _email_executor.submit(_send)
-        except Exception as e:
-            # Si por alguna razón el pool falla, intentar envío síncrono como último recurso
-            logger.error(f"No se pudo encolar envío de email en pool: {e}")
-            _send()
+        html_content = renderizar(template_html, context)
+        text_content = cls._generar_contenido_texto_plano(
+            usuario, ticket, titulo, mensaje, nombre=TOKEN_NOMBRE_DESTINATARIO
+        )
+        return subject, text_content, html_content
     
     @classmethod
     def _obtener_plantilla_html(cls, usuario: User, tipo_codigo: str) -> str:
-        plantillas = {
-            (User.Role.CLIENT, 'ticket_creado'): 'emails/ticket_created_client.html',
-            (User.Role.CLIENT, 'estado_cambiado'): 'emails/ticket_state_changed_client.html',
-            (User.Role.CLIENT, 'ticket_finalizado'): 'emails/ticket_state_changed_client.html',
-            (User.Role.CLIENT, 'ticket_cerrado'): 'emails/ticket_closed_client.html',
-            (User.Role.TECH, 'ticket_creado'): 'emails/ticket_created_technician.html',
-            (User.Role.TECH, 'ticket_asignado'): 'emails/ticket_assigned_technician.html',
-            (User.Role.TECH, 'ticket_finalizado'): 'emails/ticket_created_technician.html',
-            (User.Role.TECH, 'ticket_cerrado'): 'emails/ticket_created_technician.html',
-            (User.Role.TECH, 'tecnico_cambiado'): 'emails/technician_changed.html',
-            (User.Role.TECH, 'cambio_estado_aprobado'): 'emails/state_change_approved_technician.html',
-            (User.Role.TECH, 'cambio_estado_rechazado'): 'emails/state_change_rejected_technician.html',
-            (User.Role.ADMIN, 'ticket_creado'): 'emails/ticket_created_admin.html',
-            (User.Role.ADMIN, 'solicitud_finalizacion'): 'emails/ticket_created_admin.html',
-            (User.Role.ADMIN, 'solicitud_cambio_estado'): 'emails/state_change_request_admin.html',
-        }
-        
-        plantilla = plantillas.get((usuario.role, tipo_codigo))
-        if not plantilla:
-            if usuario.role == User.Role.CLIENT:
-                plantilla = 'emails/ticket_created_client.html'
-            elif usuario.role == User.Role.TECH:
-                plantilla = 'emails/ticket_created_technician.html'
-            elif usuario.role == User.Role.ADMIN:
-                plantilla = 'emails/ticket_created_admin.html'
-            else:
-                plantilla = 'emails/ticket_created_client.html'
-        return plantilla
+        return nombre_plantilla(usuario.role, tipo_codigo)
     
     @classmethod
-    def _generar_contenido_texto_plano(cls, usuario: User, ticket: Ticket, titulo: str, mensaje: str) -> str:
+    def _generar_contenido_texto_plano(cls, usuario: User, ticket: Ticket, titulo: str, mensaje: str,
+                                       nombre: str = None) -> str:
         return f"""
 {titulo}
 
-Hola {usuario.first_name or usuario.email},
+Hola {nombre or usuario.first_name or usuario.email},
 
 {mensaje}
 
@@ -848,7 +872,9 @@ Sistema de Tickets
     def _validar_usuario_para_notificacion(cls, usuario: User) -> bool:
         """
         Valida que un usuario sea válido para recibir notificaciones.
-        Reutiliza patrones de validación del proyecto.
+        La validación es en memoria sobre la instancia ya cargada; para
+        confirmar contra la base de datos una lista de usuarios usar
+        _filtrar_usuarios_existentes (una sola consulta).
         """
         try:
             if not usuario:
@@ -865,18 +891,6 @@ Sistema de Tickets
                 logger.warning(f"Usuario {usuario.document if hasattr(usuario, 'document') else 'sin_documento'} está inactivo")
                 return False
             
-            # Verificar que el usuario exista en la base de datos
-            # Reutilizando el patrón de users/views.py línea 194
-            if hasattr(usuario, 'document'):
-                usuario_existente = User.objects.filter(
-                    document=usuario.document,
-                    is_active=True
-                ).exists()
-                
-                if not usuario_existente:
-                    logger.warning(f"Usuario con documento {usuario.document} no existe en la base de datos")
-                    return False
-            
             if '@' not in usuario.email or '.' not in usuario.email.split('@')[-1]:
                 logger.warning(f"Email {usuario.email} tiene formato inválido")
                 return False
@@ -885,4 +899,24 @@ Sistema de Tickets
             
         except Exception as e:
             logger.error(f"Error validando usuario para notificación: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    @classmethod
+    def _filtrar_usuarios_existentes(cls, usuarios) -> list:
+        """
+        Retorna los usuarios válidos que además siguen existiendo y activos en
+        la base de datos, verificándolos todos con una sola consulta.
+        """
+        candidatos = [u for u in usuarios if cls._validar_usuario_para_notificacion(u)]
+        if not candidatos:
+            return []
+        existentes = set(
+            User.objects.filter(
+                document__in=[u.document for u in candidatos],
+                is_active=True
+            ).values_list('document', flat=True)
+        )
+        for usuario in candidatos:
+            if usuario.document not in existentes:
+                logger.warning(f"Usuario con documento {usuario.document} no existe en la base de datos")
+        return [u for u in candidatos if u.document in existentes]
@@ -3,11 +3,14 @@ Signals para integrar notificaciones con el flujo de tickets.
 Se ejecutan automáticamente cuando ocurren eventos en los tickets.
 """
 import logging
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.db.models import Q
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
 
 from tickets.models import Ticket
+from .models import Notification, NotificationCounter, NotificationDelivery, NotificationType
+from .pubsub import publicar_notificaciones
 from .services import NotificationService
 
 User = get_user_model()
@@ -135,3 +138,81 @@ def ticket_technician_changed_post_save(sender, instance, created, **kwargs):
                        f"Internas: {resultados.get('notificaciones_internas', 0)}")
     except Exception as e:
         logger.error(f"Error en post_save enviando notificaciones de cambio de técnico: {e}")
+
+
+@receiver(post_save, sender=Notification)
+def notification_created_push(sender, instance, created, **kwargs):
+    """Publica las notificaciones nuevas a los clientes conectados al stream."""
+    if created:
+        publicar_notificaciones([instance])
+
+
+@receiver(m2m_changed, sender=Notification.destinatarios.through)
+def notification_recipients_push(sender, instance, action, reverse, pk_set, **kwargs):
+    """Publica la notificación a los usuarios agregados como destinatarios."""
+    if action == 'post_add' and not reverse and pk_set:
+        publicar_notificaciones([instance], usuario_ids=pk_set)
+
+
+@receiver(m2m_changed, sender=Notification.destinatarios.through)
+def notification_recipients_deliveries(sender, instance, action, reverse, pk_set, **kwargs):
+    """Mantiene una entrega por cada usuario de `destinatarios` (además del principal)."""
+    if action == 'pre_clear':
+        # Tras el clear ya no se sabe quiénes eran: se guardan antes
+        pares = sender.objects.filter(**{'user' if reverse else 'notification': instance})
+        instance._destinatarios_previos = set(pares.values_list('notification_id', 'user_id'))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        pares = getattr(instance, '_destinatarios_previos', set())
+    elif reverse:
+        pares = {(notificacion_id, instance.pk) for notificacion_id in pk_set or ()}
+    else:
+        pares = {(instance.pk, usuario_id) for usuario_id in pk_set or ()}
+    if not pares:
+        return
+
+    notificaciones = Notification.objects.only('id', 'usuario_id', 'estado', 'fecha_creacion', 'fecha_lectura').in_bulk(
+        {notificacion_id for notificacion_id, _ in pares}
+    )
+    # El destinatario principal conserva su entrega aunque también figure en destinatarios
+    pares = {
+        (notificacion_id, usuario_id) for notificacion_id, usuario_id in pares
+        if notificacion_id in notificaciones and usuario_id != notificaciones[notificacion_id].usuario_id
+    }
+    if action == 'post_add':
+        NotificationDelivery.crear([(notificaciones[n], u) for n, u in sorted(pares)])
+    else:
+        filtro = Q()
+        for notificacion_id, usuario_id in pares:
+            filtro |= Q(notificacion_id=notificacion_id, usuario_id=usuario_id)
+        if filtro:
+            NotificationDelivery.objects.filter(filtro).delete()
+
+
+@receiver(post_delete, sender=NotificationDelivery)
+def notification_delivery_deleted_counter(sender, instance, **kwargs):
+    """Descuenta la entrega eliminada de los contadores de su usuario."""
+    estado = instance.__dict__.get('estado')
+    if estado and NotificationCounter.ajustes_por_fila_activos():
+        # Sin crear la fila: al borrar un usuario sus contadores se eliminan en cascada
+        NotificationCounter.ajustar(
+            {instance.usuario_id: {'total': -1, NotificationCounter.CAMPO_POR_ESTADO[estado]: -1}}, crear=False
+        )
+
+
+@receiver(post_save, sender=User)
+def user_created_counter(sender, instance, created, **kwargs):
+    """Crea los contadores en cero para que los incrementos posteriores sean un solo UPDATE."""
+    if created:
+        NotificationCounter.objects.get_or_create(usuario=instance)
+
+
+@receiver(post_save, sender=NotificationType)
+def notification_type_changed_etag(sender, instance, created, **kwargs):
+    """El nombre del tipo se muestra en la bandeja: al editarlo cambia la versión de quienes lo tienen."""
+    if not created:
+        NotificationCounter.invalidar(
+            NotificationDelivery.objects.filter(notificacion__tipo=instance).values('usuario_id')
+        )
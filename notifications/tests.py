@@ -1,8 +1,33 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from smtplib import SMTPDataError, SMTPServerDisconnected
+from unittest import mock
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
 from django.utils import timezone
-from tickets.models import Ticket, Estado
-from .models import Notification, NotificationType
+from tickets.models import Ticket, Estado, StateChangeRequest
+from .config import NotificationConfig
+from .models import (
+    EmailJob, Notification, NotificationCounter, NotificationDelivery, NotificationPreference, NotificationType,
+)
+from .serializers import CreateNotificationSerializer
+from .services import NotificationService
+from . import email_providers, email_queue, email_templates, registry, resilience, retention
 
 User = get_user_model()
 
@@ -81,4 +106,1026 @@ class NotificationModelTest(TestCase):
         self.notification.marcar_como_leida()
         
         self.assertTrue(self.notification.es_leida)
-        self.assertFalse(self.notification.es_pendiente)
\ No newline at end of file
+        self.assertFalse(self.notification.es_pendiente)
+
+
+class ContadorSMTPBackend(LocmemEmailBackend):
+    """Backend de prueba que cuenta aperturas y puede simular desconexiones."""
+    aperturas = 0
+    desconexiones_pendientes = 0
+
+    def open(self):
+        ContadorSMTPBackend.aperturas += 1
+        return True
+
+    def send_messages(self, messages):
+        if ContadorSMTPBackend.desconexiones_pendientes:
+            ContadorSMTPBackend.desconexiones_pendientes -= 1
+            raise SMTPServerDisconnected('Connection unexpectedly closed')
+        return super().send_messages(messages)
+
+
+@override_settings(SENDGRID_API_KEY='', EMAIL_HOST='smtp.test.com', EMAIL_COALESCE_WINDOW_SECONDS=0)
+class EmailQueueTest(TestCase):
+    """Tests para la cola persistente de correos y el worker."""
+
+    def setUp(self):
+        self.cliente = User.objects.create_user(
+            email='cola@test.com',
+            document='11223344',
+            password='testpass123',
+            role=User.Role.CLIENT
+        )
+        estado, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto'})
+        self.ticket = Ticket.objects.create(
+            titulo='Ticket cola',
+            descripcion='Prueba de la cola de correos',
+            cliente=self.cliente,
+            estado=estado
+        )
+        EmailJob.objects.all().delete()
+        mail.outbox.clear()
+        email_providers.smtp_pool.cerrar_todas()
+        self.addCleanup(email_providers.smtp_pool.cerrar_todas)
+        resilience.reiniciar()
+
+    def test_enviar_email_encola_sin_enviar(self):
+        """El servicio solo persiste el correo; no contacta al proveedor."""
+        NotificationService._enviar_email(self.cliente, self.ticket, 'ticket_creado', 'Ticket creado', 'Hola')
+
+        job = EmailJob.objects.get()
+        self.assertEqual(job.destinatario, 'cola@test.com')
+        self.assertEqual(job.estado, EmailJob.Estado.PENDIENTE)
+        self.assertIn(f"Ticket #{self.ticket.pk}", job.asunto)
+        self.assertTrue(job.cuerpo_html)
+        self.assertEqual(job.sustituciones, {'-nombre_destinatario-': 'cola@test.com'})
+        self.assertEqual(len(mail.outbox), 0)
+
+        email_queue.procesar_lote()
+        self.assertIn('Hola cola@test.com', mail.outbox[0].body)
+        self.assertIn('cola@test.com', mail.outbox[0].alternatives[0][0])
+        self.assertNotIn('-nombre_destinatario-', mail.outbox[0].alternatives[0][0])
+
+    def test_worker_envia_trabajos_pendientes(self):
+        email_queue.encolar_email('cola@test.com', 'Asunto', 'Texto', '<p>Texto</p>')
+
+        call_command('run_email_worker', '--once', stdout=StringIO())
+
+        job = EmailJob.objects.get()
+        self.assertEqual(job.estado, EmailJob.Estado.ENVIADO)
+        self.assertEqual(job.intentos, 1)
+        self.assertEqual(job.proveedor, 'smtp')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['cola@test.com'])
+
+    def test_reclamo_no_duplica_trabajos(self):
+        email_queue.encolar_email('cola@test.com', 'Asunto', 'Texto')
+
+        self.assertEqual(len(email_queue.reclamar_lote()), 1)
+        self.assertEqual(email_queue.reclamar_lote(), [])
+
+        # Si el worker muere, el trabajo vuelve a estar disponible al vencer la reserva
+        EmailJob.objects.update(bloqueado_hasta=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(email_queue.reclamar_lote()), 1)
+
+    def test_reserva_vencida_sin_intentos_se_marca_fallida(self):
+        job = email_queue.encolar_email('cola@test.com', 'Asunto', 'Texto')
+        EmailJob.objects.filter(pk=job.pk).update(max_intentos=2)
+
+        def vencer():
+            EmailJob.objects.update(bloqueado_hasta=timezone.now() - timedelta(seconds=1))
+
+        # El worker muere en cada intento
+        self.assertEqual(len(email_queue.reclamar_lote()), 1)
+        vencer()
+        self.assertEqual(len(email_queue.reclamar_lote()), 1)
+        vencer()
+        self.assertEqual(email_queue.reclamar_lote(), [])
+
+        job.refresh_from_db()
+        self.assertEqual(job.estado, EmailJob.Estado.FALLIDO)
+        self.assertEqual(job.intentos, 2)
+        self.assertIsNone(job.bloqueado_hasta)
+        self.assertTrue(job.ultimo_error)
+
+    def test_fallo_reprograma_y_luego_marca_fallido(self):
+        job = email_queue.encolar_email('cola@test.com', 'Asunto', 'Texto')
+        EmailJob.objects.filter(pk=job.pk).update(max_intentos=2)
+
+        with mock.patch('notifications.email_providers.enviar_con_smtp', side_effect=OSError('sin conexión')):
+            resumen = email_queue.procesar_lote()
+            job.refresh_from_db()
+            self.assertEqual(resumen['fallidos'], 1)
+            self.assertEqual(job.estado, EmailJob.Estado.PENDIENTE)
+            self.assertGreater(job.proximo_intento, timezone.now())
+            self.assertIn('sin conexión', job.ultimo_error)
+
+            # Todavía no toca reintentar
+            self.assertEqual(email_queue.procesar_lote()['reclamados'], 0)
+
+            EmailJob.objects.filter(pk=job.pk).update(proximo_intento=timezone.now())
+            email_queue.procesar_lote()
+            job.refresh_from_db()
+            self.assertEqual(job.estado, EmailJob.Estado.FALLIDO)
+            self.assertEqual(job.intentos, 2)
+
+    def test_sin_email_host_omite_sin_reintentar(self):
+        email_queue.encolar_email('cola@test.com', 'Asunto', 'Texto')
+
+        with override_settings(EMAIL_HOST=''):
+            resumen = email_queue.procesar_lote()
+
+        job = EmailJob.objects.get()
+        self.assertEqual(resumen['omitidos'], 1)
+        self.assertEqual(resumen['fallidos'], 0)
+        self.assertEqual(job.estado, EmailJob.Estado.OMITIDO)
+        self.assertEqual(email_queue.procesar_lote()['reclamados'], 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(EMAIL_BACKEND='notifications.tests.ContadorSMTPBackend')
+    def test_lote_reutiliza_una_conexion_smtp(self):
+        ContadorSMTPBackend.aperturas = 0
+        for i in range(5):
+            email_queue.encolar_email(f'destino{i}@test.com', 'Asunto', 'Texto')
+
+        email_queue.procesar_lote()
+        email_queue.encolar_email('otro@test.com', 'Asunto', 'Texto')
+        email_queue.procesar_lote()
+
+        self.assertEqual(ContadorSMTPBackend.aperturas, 1)
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(EmailJob.objects.filter(estado=EmailJob.Estado.ENVIADO).count(), 6)
+
+    @override_settings(EMAIL_BACKEND='notifications.tests.ContadorSMTPBackend')
+    def test_reconecta_si_el_servidor_cierra_la_conexion(self):
+        ContadorSMTPBackend.aperturas = 0
+        ContadorSMTPBackend.desconexiones_pendientes = 1
+        email_queue.encolar_email('cola@test.com', 'Asunto', 'Texto')
+
+        resumen = email_queue.procesar_lote()
+
+        self.assertEqual(resumen['enviados'], 1)
+        self.assertEqual(ContadorSMTPBackend.aperturas, 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class FakeSendGridHandler(BaseHTTPRequestHandler):
+    """Imita POST /v3/mail/send de SendGrid y registra las peticiones recibidas."""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.conexiones += 1
+
+    def do_POST(self):
+        cuerpo = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.peticiones.append({
+            'path': self.path,
+            'authorization': self.headers.get('Authorization'),
+            'payload': json.loads(cuerpo),
+        })
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SendGridBatchTest(TestCase):
+    """Tests del envío agrupado por SendGrid contra un servidor local."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.servidor = ThreadingHTTPServer(('127.0.0.1', 0), FakeSendGridHandler)
+        cls.servidor.peticiones = []
+        cls.servidor.conexiones = 0
+        threading.Thread(target=cls.servidor.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servidor.shutdown()
+        cls.servidor.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.servidor.peticiones.clear()
+        self.servidor.conexiones = 0
+        self.override = override_settings(
+            EMAIL_COALESCE_WINDOW_SECONDS=0,
+            SENDGRID_API_KEY='SG.prueba',
+            SENDGRID_API_HOST=f'http://127.0.0.1:{self.servidor.server_address[1]}',
+        )
+        self.override.enable()
+        self.addCleanup(self.override.disable)
+        self.addCleanup(email_providers.sendgrid_client.cerrar)
+        email_providers.sendgrid_client.cerrar()
+        resilience.reiniciar()
+
+        estado, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto'})
+        cliente = User.objects.create_user(
+            email='cliente_sg@test.com', document='55000001', password='testpass123', role=User.Role.CLIENT
+        )
+        self.ticket = Ticket.objects.create(titulo='Ticket SG', descripcion='Prueba', cliente=cliente, estado=estado)
+        self.admins = [
+            User.objects.create_user(
+                email=f'admin_sg{i}@test.com', document=f'5500001{i}', password='testpass123',
+                role=User.Role.ADMIN, first_name=f'Admin{i}'
+            )
+            for i in range(3)
+        ]
+        EmailJob.objects.all().delete()
+
+    def test_notificacion_a_varios_admins_es_una_peticion(self):
+        for admin in self.admins:
+            NotificationService._enviar_email(
+                admin, self.ticket, 'solicitud_cambio_estado', 'Solicitud de cambio', 'Revisar'
+            )
+
+        resumen = email_queue.procesar_lote()
+
+        self.assertEqual(resumen['enviados'], 3)
+        self.assertEqual(len(self.servidor.peticiones), 1)
+        peticion = self.servidor.peticiones[0]
+        self.assertEqual(peticion['path'], '/v3/mail/send')
+        self.assertEqual(peticion['authorization'], 'Bearer SG.prueba')
+        personalizations = peticion['payload']['personalizations']
+        self.assertEqual([p['to'][0]['email'] for p in personalizations], [a.email for a in self.admins])
+        self.assertEqual(
+            [p['substitutions']['-nombre_destinatario-'] for p in personalizations],
+            ['Admin0', 'Admin1', 'Admin2'],
+        )
+        self.assertTrue(all(j.proveedor == 'sendgrid' for j in EmailJob.objects.all()))
+
+    def test_texto_plano_recibe_las_sustituciones_sin_escapar(self):
+        jobs = [
+            EmailJob(
+                destinatario=f'{nombre}@test.com', asunto='Asunto',
+                cuerpo_texto='Hola -nombre_destinatario-,', cuerpo_html='<p>Hola -nombre_destinatario-,</p>',
+                sustituciones={'-nombre_destinatario-': nombre},
+            )
+            for nombre in ('Ana & Luis', 'Bea')
+        ]
+
+        payload = email_providers._payload_sendgrid(jobs)
+
+        texto, html = payload['content']
+        self.assertNotIn('-nombre_destinatario-', texto['value'])
+        self.assertEqual(html['value'], '<p>Hola -nombre_destinatario-,</p>')
+        # Lo que SendGrid hace con cada personalización
+        for personalization, nombre in zip(payload['personalizations'], ('Ana & Luis', 'Bea')):
+            recibido = {}
+            for parte in (texto, html):
+                valor = parte['value']
+                for token, sustitucion in personalization['substitutions'].items():
+                    valor = valor.replace(token, sustitucion)
+                recibido[parte['type']] = valor
+            self.assertEqual(recibido['text/plain'], f'Hola {nombre},')
+        self.assertEqual(recibido['text/html'], '<p>Hola Bea,</p>')
+        self.assertIn('Ana &amp; Luis', payload['personalizations'][0]['substitutions'].values())
+
+    def test_cliente_reutiliza_la_conexion(self):
+        email_queue.encolar_email('uno@test.com', 'Asunto A', 'Texto A')
+        email_queue.encolar_email('dos@test.com', 'Asunto B', 'Texto B')
+        email_queue.procesar_lote()
+        email_queue.encolar_email('tres@test.com', 'Asunto C', 'Texto C')
+        email_queue.procesar_lote()
+
+        self.assertEqual(len(self.servidor.peticiones), 3)
+        self.assertEqual(self.servidor.conexiones, 1)
+
+
+class AdminFanOutTest(TestCase):
+    """Tests del envío masivo de notificaciones a administradores."""
+
+    def setUp(self):
+        estado, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto'})
+        cliente = User.objects.create_user(
+            email='cliente_fan@test.com', document='66000001', password='testpass123', role=User.Role.CLIENT
+        )
+        tecnico = User.objects.create_user(
+            email='tecnico_fan@test.com', document='66000002', password='testpass123', role=User.Role.TECH
+        )
+        self.ticket = Ticket.objects.create(
+            titulo='Ticket fan-out', descripcion='Prueba', cliente=cliente, tecnico=tecnico, estado=estado
+        )
+        self.ticket = Ticket.objects.select_related('estado', 'tecnico').get(pk=self.ticket.pk)
+        Notification.objects.all().delete()
+        EmailJob.objects.all().delete()
+
+    def crear_admins(self, cantidad, inicio=0):
+        for i in range(inicio, inicio + cantidad):
+            User.objects.create_user(
+                email=f'admin_fan{i}@test.com', document=f'6610{i:04d}', password='testpass123', role=User.Role.ADMIN
+            )
+
+    def test_solicitud_finalizacion_notifica_a_cada_admin(self):
+        self.crear_admins(3)
+        resultados = NotificationService.enviar_solicitud_finalizacion(self.ticket)
+
+        self.assertEqual(resultados['notificaciones_internas'], 3)
+        self.assertEqual(resultados['emails_enviados'], 3)
+        self.assertEqual(
+            sorted(Notification.objects.values_list('usuario__email', flat=True)),
+            ['admin_fan0@test.com', 'admin_fan1@test.com', 'admin_fan2@test.com'],
+        )
+        self.assertEqual(EmailJob.objects.count(), 3)
+        self.assertEqual(EmailJob.objects.values('cuerpo_html').distinct().count(), 1)
+
+    def test_consultas_constantes_por_cantidad_de_admins(self):
+        self.crear_admins(2)
+        NotificationService.enviar_solicitud_finalizacion(self.ticket)
+        # Cada guardado del ticket es un evento distinto
+        self.ticket.save()
+        with CaptureQueriesContext(connection) as pocos:
+            NotificationService.enviar_solicitud_finalizacion(self.ticket)
+
+        self.crear_admins(8, inicio=2)
+        self.ticket.save()
+        with CaptureQueriesContext(connection) as muchos:
+            resultados = NotificationService.enviar_solicitud_finalizacion(self.ticket)
+
+        self.assertEqual(resultados['notificaciones_internas'], 10)
+        self.assertEqual(len(pocos.captured_queries), len(muchos.captured_queries))
+
+    def test_envio_masivo_repetido_no_duplica(self):
+        self.crear_admins(3)
+        NotificationService.enviar_solicitud_finalizacion(self.ticket)
+        resultados = NotificationService.enviar_solicitud_finalizacion(self.ticket)
+
+        self.assertEqual(resultados['notificaciones_internas'], 0)
+        self.assertEqual(resultados['emails_enviados'], 0)
+        self.assertEqual(Notification.objects.count(), 3)
+        self.assertEqual(EmailJob.objects.count(), 3)
+        self.assertEqual(NotificationDelivery.objects.count(), 3)
+
+    def test_envio_masivo_repetido_solo_notifica_a_los_nuevos_admins(self):
+        self.crear_admins(2)
+        NotificationService.enviar_solicitud_finalizacion(self.ticket)
+        self.crear_admins(1, inicio=2)
+        resultados = NotificationService.enviar_solicitud_finalizacion(self.ticket)
+
+        self.assertEqual(resultados['notificaciones_internas'], 1)
+        self.assertEqual(resultados['emails_enviados'], 1)
+        self.assertEqual(Notification.objects.filter(usuario__email='admin_fan2@test.com').count(), 1)
+        self.assertEqual(Notification.objects.count(), 3)
+        self.assertEqual(EmailJob.objects.count(), 3)
+
+    def test_envio_masivo_concurrente_ignora_las_filas_ya_insertadas(self):
+        self.crear_admins(3)
+        evento = NotificationService._evento_ticket(self.ticket)
+        admin = User.objects.get(email='admin_fan0@test.com')
+        consulta_previa = Notification.objects.filter
+
+        def insertar_en_paralelo(*args, **kwargs):
+            # Otro proceso notifica a un admin entre la consulta y el insert
+            if 'clave_idempotencia__in' in kwargs and not Notification.objects.exists():
+                Notification.objects.create(
+                    usuario=admin, ticket=self.ticket, titulo='Otro proceso', mensaje='-',
+                    tipo=registry.obtener_tipo('solicitud_finalizacion', defaults={'nombre': 'Solicitud'}),
+                    clave_idempotencia=NotificationService._clave_idempotencia(
+                        'solicitud_finalizacion', self.ticket, evento, admin
+                    ),
+                )
+                return Notification.objects.none()
+            return consulta_previa(*args, **kwargs)
+
+        with mock.patch.object(Notification.objects, 'filter', side_effect=insertar_en_paralelo):
+            resultados = NotificationService.enviar_solicitud_finalizacion(self.ticket)
+
+        self.assertEqual(resultados['notificaciones_internas'], 2)
+        self.assertEqual(resultados['emails_enviados'], 2)
+        self.assertEqual(Notification.objects.filter(usuario=admin).count(), 1)
+        self.assertEqual(NotificationDelivery.objects.filter(usuario=admin).count(), 1)
+        self.assertEqual(EmailJob.objects.filter(destinatario=admin.email).count(), 0)
+
+
+class RecipientValidationTest(TestCase):
+    """La validación de destinatarios no debe consultar la base de datos por usuario."""
+
+    def setUp(self):
+        self.usuarios = [
+            User.objects.create_user(
+                email=f'valido{i}@test.com', document=f'6700{i:04d}', password='testpass123', role=User.Role.TECH
+            )
+            for i in range(5)
+        ]
+
+    def test_validacion_individual_sin_consultas(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(all(
+                NotificationService._validar_usuario_para_notificacion(u) for u in self.usuarios
+            ))
+        self.usuarios[0].is_active = False
+        self.assertFalse(NotificationService._validar_usuario_para_notificacion(self.usuarios[0]))
+
+    def test_verificacion_por_lote_en_una_consulta(self):
+        User.objects.filter(pk=self.usuarios[1].pk).update(is_active=False)
+
+        with self.assertNumQueries(1):
+            existentes = NotificationService._filtrar_usuarios_existentes(self.usuarios)
+
+        self.assertEqual(len(existentes), 4)
+        self.assertNotIn(self.usuarios[1], existentes)
+
+    def test_consultas_por_notificacion_individual(self):
+        estado, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto'})
+        ticket = Ticket.objects.create(titulo='Ticket', descripcion='Prueba', cliente=self.usuarios[0], estado=estado)
+        ticket = Ticket.objects.select_related('estado').get(pk=ticket.pk)
+        resultados = {'emails_enviados': 0, 'emails_fallidos': 0, 'notificaciones_internas': 0, 'errores': []}
+        NotificationService._enviar_notificacion_completa(
+            self.usuarios[1], ticket, 'ticket_asignado', 'Asignado', 'Mensaje', resultados
+        )
+
+        # El tipo sale del registro en memoria: INSERT de la notificación y de su entrega,
+        # UPDATE de los contadores, preferencia del destinatario, plazo de agrupación
+        # pendiente e INSERT del correo
+        with self.assertNumQueries(6):
+            NotificationService._enviar_notificacion_completa(
+                self.usuarios[2], ticket, 'ticket_asignado', 'Asignado', 'Mensaje', resultados
+            )
+
+
+class NotificationTypeRegistryTest(TestCase):
+    """Tests del registro en memoria de tipos de notificación."""
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        # Recargar la caché con los datos confirmados tras revertir la clase
+        registry.sincronizar_tipos()
+
+    def setUp(self):
+        registry.sincronizar_tipos()
+
+    def test_tipos_de_config_sincronizados(self):
+        codigos = set(NotificationType.objects.values_list('codigo', flat=True))
+        self.assertTrue(set(NotificationConfig.NOTIFICATION_TYPES).issubset(codigos))
+
+    def test_obtener_tipo_no_consulta_la_base_de_datos(self):
+        with self.assertNumQueries(0):
+            tipo = registry.obtener_tipo('ticket_cerrado')
+        self.assertEqual(tipo.codigo, 'ticket_cerrado')
+
+    def test_edicion_invalida_la_cache(self):
+        tipo = registry.obtener_tipo('tecnico_cambiado')
+        tipo.nombre = 'Cambio de técnico'
+        tipo.save()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(registry.obtener_tipo('tecnico_cambiado').nombre, 'Cambio de técnico')
+
+    def test_codigo_inexistente_no_se_cachea(self):
+        self.assertIsNone(registry.obtener_tipo('no_existe'))
+        NotificationType.objects.create(codigo='no_existe', nombre='Nuevo')
+        self.assertIsNotNone(registry.obtener_tipo('no_existe'))
+
+
+class EmailTemplateCacheTest(TestCase):
+    """Las plantillas de correo se compilan una vez por proceso."""
+
+    def setUp(self):
+        email_templates.obtener_plantilla.cache_clear()
+        self.addCleanup(email_templates.obtener_plantilla.cache_clear)
+
+    def test_plantilla_compilada_una_sola_vez(self):
+        estado, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto'})
+        cliente = User.objects.create_user(
+            email='cliente_tpl@test.com', document='68000001', password='testpass123', role=User.Role.CLIENT
+        )
+        ticket = Ticket.objects.create(titulo='Plantillas', descripcion='Prueba', cliente=cliente, estado=estado)
+        EmailJob.objects.all().delete()
+        email_templates.obtener_plantilla.cache_clear()
+
+        with mock.patch.object(email_templates, 'get_template', wraps=email_templates.get_template) as get_template:
+            for _ in range(3):
+                NotificationService._enviar_email(cliente, ticket, 'ticket_creado', 'Creado', 'Mensaje')
+
+        get_template.assert_called_once_with('emails/ticket_created_client.html')
+        self.assertEqual(EmailJob.objects.filter(destinatario='cliente_tpl@test.com').count(), 3)
+
+    def test_plantilla_por_defecto_segun_rol(self):
+        self.assertEqual(
+            email_templates.nombre_plantilla(User.Role.ADMIN, 'ticket_cancelado'),
+            'emails/ticket_created_admin.html',
+        )
+
+
+@override_settings(SENDGRID_API_KEY='', EMAIL_HOST='smtp.test.com', EMAIL_COALESCE_WINDOW_SECONDS=60)
+class EmailCoalescingTest(TestCase):
+    """Agrupación de correos por ventana de tiempo y resúmenes según preferencia."""
+
+    def setUp(self):
+        estado, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto'})
+        self.cliente = User.objects.create_user(
+            email='agrupa@test.com', document='69000001', password='testpass123',
+            role=User.Role.CLIENT, first_name='Ana'
+        )
+        self.ticket = Ticket.objects.create(titulo='Agrupar', descripcion='Prueba', cliente=self.cliente, estado=estado)
+        self.otro_ticket = Ticket.objects.create(titulo='Otro', descripcion='Prueba', cliente=self.cliente, estado=estado)
+        EmailJob.objects.all().delete()
+        mail.outbox.clear()
+        email_providers.smtp_pool.cerrar_todas()
+        self.addCleanup(email_providers.smtp_pool.cerrar_todas)
+        resilience.reiniciar()
+
+    def notificar(self, ticket, titulo):
+        NotificationService._enviar_email(self.cliente, ticket, 'estado_cambiado', titulo, f'Mensaje {titulo}')
+
+    def vencer_plazos(self):
+        EmailJob.objects.update(proximo_intento=timezone.now())
+
+    def test_correos_del_mismo_ticket_se_envian_como_uno(self):
+        self.notificar(self.ticket, 'Primero')
+        self.notificar(self.ticket, 'Segundo')
+        self.assertEqual(EmailJob.objects.values('proximo_intento').distinct().count(), 1)
+        self.assertEqual(email_queue.procesar_lote()['reclamados'], 0)
+
+        self.vencer_plazos()
+        resumen = email_queue.procesar_lote()
+
+        self.assertEqual(resumen['enviados'], 2)
+        self.assertEqual(len(mail.outbox), 1)
+        correo = mail.outbox[0]
+        self.assertEqual(correo.subject, f"2 actualizaciones - Ticket #{self.ticket.pk}")
+        self.assertIn('Hola Ana', correo.body)
+        self.assertIn('Primero', correo.body)
+        self.assertIn('Segundo', correo.alternatives[0][0])
+
+    def test_tickets_distintos_no_se_combinan(self):
+        self.notificar(self.ticket, 'Primero')
+        self.notificar(self.otro_ticket, 'Segundo')
+        self.vencer_plazos()
+        email_queue.procesar_lote()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_preferencia_diaria_programa_un_resumen(self):
+        NotificationPreference.objects.create(
+            usuario=self.cliente, frecuencia_email=NotificationPreference.Frecuencia.DIARIA
+        )
+        self.notificar(self.ticket, 'Primero')
+        self.notificar(self.otro_ticket, 'Segundo')
+
+        plazos = set(EmailJob.objects.values_list('grupo', 'proximo_intento'))
+        self.assertEqual(len(plazos), 1)
+        grupo, plazo = plazos.pop()
+        self.assertEqual(grupo, 'resumen:diario')
+        self.assertGreater(plazo, timezone.now())
+        self.assertEqual(timezone.localtime(plazo).hour, email_queue.EMAIL_DIGEST_HOUR)
+
+        self.vencer_plazos()
+        email_queue.procesar_lote()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'Resumen de 2 notificaciones')
+
+    def test_endpoint_de_preferencias(self):
+        client = APIClient()
+        client.force_authenticate(user=self.cliente)
+        url = reverse('notifications:notification-preferences')
+
+        response = client.get(url)
+        self.assertEqual(response.data['frecuencia_email'], 'INMEDIATA')
+        response = client.put(url, {'frecuencia_email': 'HORARIA'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(NotificationPreference.objects.get(usuario=self.cliente).frecuencia_email, 'HORARIA')
+
+
+class RelojFalso:
+    def __init__(self):
+        self.ahora = 1000.0
+
+    def __call__(self):
+        return self.ahora
+
+    def dormir(self, segundos):
+        self.ahora += segundos
+
+
+class ProviderResilienceTest(TestCase):
+    """Circuit breaker y limitador de tasa de los proveedores de correo."""
+
+    def setUp(self):
+        self.reloj = RelojFalso()
+
+    def test_circuito_abre_y_se_recupera(self):
+        circuito = resilience.CircuitBreaker('smtp', umbral_fallos=2, tiempo_espera=30, reloj=self.reloj)
+        circuito.registrar_fallo()
+        self.assertTrue(circuito.permitir())
+        circuito.registrar_fallo()
+        self.assertEqual(circuito.estado, circuito.ABIERTO)
+        self.assertFalse(circuito.permitir())
+
+        self.reloj.ahora += 30
+        self.assertTrue(circuito.permitir())
+        self.assertFalse(circuito.permitir())  # semiabierto: una sola prueba
+        circuito.registrar_fallo()
+        self.assertEqual(circuito.estado, circuito.ABIERTO)
+
+        self.reloj.ahora += 30
+        self.assertTrue(circuito.permitir())
+        circuito.registrar_exito()
+        self.assertEqual(circuito.estado, circuito.CERRADO)
+
+    def test_token_bucket_limita_y_se_adapta(self):
+        limite = resilience.TokenBucket(tasa=2, capacidad=2, reloj=self.reloj, dormir=self.reloj.dormir)
+        self.assertTrue(limite.adquirir())
+        self.assertTrue(limite.adquirir())
+        self.assertFalse(limite.adquirir(espera_maxima=0.1))
+        self.assertTrue(limite.adquirir(espera_maxima=1))
+        self.assertAlmostEqual(self.reloj.ahora, 1000.5)
+
+        limite.penalizar()
+        self.assertEqual(limite.tasa, 1)
+        for _ in range(20):
+            limite.recuperar()
+        self.assertEqual(limite.tasa, 2)
+
+    @override_settings(SENDGRID_API_KEY='', EMAIL_HOST='smtp.test.com', EMAIL_COALESCE_WINDOW_SECONDS=0)
+    def test_circuito_abierto_pospone_sin_gastar_intentos(self):
+        resilience.reiniciar()
+        self.addCleanup(resilience.reiniciar)
+        resilience.circuitos['smtp'] = resilience.CircuitBreaker('smtp', umbral_fallos=2, tiempo_espera=60)
+        for i in range(5):
+            email_queue.encolar_email(f'destino{i}@test.com', 'Asunto', 'Texto')
+
+        with mock.patch('notifications.email_providers.enviar_con_smtp', side_effect=OSError('caído')) as envio:
+            resumen = email_queue.procesar_lote()
+
+        self.assertEqual(envio.call_count, 2)
+        self.assertEqual(resumen['fallidos'], 2)
+        self.assertEqual(resumen['pospuestos'], 3)
+        pospuestos = EmailJob.objects.filter(intentos=0)
+        self.assertEqual(pospuestos.count(), 3)
+        self.assertTrue(all(j.proximo_intento > timezone.now() for j in pospuestos))
+
+    @override_settings(SENDGRID_API_KEY='', EMAIL_HOST='smtp.test.com', EMAIL_COALESCE_WINDOW_SECONDS=0)
+    def test_rechazo_permanente_de_un_mensaje_no_abre_el_circuito(self):
+        resilience.reiniciar()
+        self.addCleanup(resilience.reiniciar)
+        resilience.circuitos['smtp'] = resilience.CircuitBreaker('smtp', umbral_fallos=2, tiempo_espera=60)
+        for i in range(4):
+            email_queue.encolar_email(f'destino{i}@test.com', 'Asunto', 'Texto')
+
+        rechazo = SMTPDataError(552, b'Message size exceeds fixed limit')
+        with mock.patch('notifications.email_providers.enviar_con_smtp', side_effect=rechazo) as envio:
+            resumen = email_queue.procesar_lote()
+
+        self.assertEqual(envio.call_count, 4)
+        self.assertEqual(resumen['fallidos'], 4)
+        self.assertEqual(resumen['pospuestos'], 0)
+        self.assertEqual(resilience.circuitos['smtp'].estado, resilience.CircuitBreaker.CERRADO)
+
+        # Una respuesta transitoria del servidor sí cuenta como fallo
+        self.assertTrue(email_providers._es_fallo_smtp(SMTPDataError(421, b'Service not available')))
+        self.assertTrue(email_providers._es_fallo_smtp(SMTPServerDisconnected()))
+        self.assertTrue(email_providers._es_fallo_smtp(TimeoutError()))
+        self.assertFalse(email_providers._es_fallo_smtp(SMTPDataError(550, b'Rejected content')))
+
+    @override_settings(SENDGRID_API_KEY='clave', EMAIL_HOST='smtp.test.com')
+    def test_cuota_agotada_en_semiabierto_no_bloquea_el_circuito(self):
+        resilience.reiniciar()
+        self.addCleanup(resilience.reiniciar)
+        circuito = resilience.CircuitBreaker('sendgrid', umbral_fallos=1, tiempo_espera=30, reloj=self.reloj)
+        limite = resilience.TokenBucket(tasa=1, capacidad=10, reloj=self.reloj, dormir=self.reloj.dormir)
+        resilience.circuitos['sendgrid'] = circuito
+        resilience.limites['sendgrid'] = limite
+        circuito.registrar_fallo()
+        self.reloj.ahora += 30
+        limite.adquirir(10)
+        jobs = [
+            EmailJob(destinatario=f'semi{i}@test.com', asunto='A', cuerpo_texto='T', sustituciones={})
+            for i in range(5)
+        ]
+
+        with mock.patch('notifications.email_providers.enviar_grupo_sendgrid') as sendgrid, \
+                mock.patch('notifications.email_providers.enviar_lote_smtp', side_effect=lambda js: [None] * len(js)):
+            # Sin tokens para el grupo: la prueba semiabierta se devuelve sin enviar
+            email_providers.enviar_lote(jobs)
+            self.assertEqual(sendgrid.call_count, 0)
+            self.assertEqual(circuito.estado, circuito.SEMIABIERTO)
+
+            self.reloj.ahora += 10
+            resultados = email_providers.enviar_lote(jobs)
+
+        self.assertEqual(sendgrid.call_count, 1)
+        self.assertEqual(circuito.estado, circuito.CERRADO)
+        self.assertEqual({proveedor for proveedor, _ in resultados}, {'sendgrid'})
+
+    def test_cuota_smtp_agotada_en_semiabierto_libera_la_prueba(self):
+        circuito = resilience.CircuitBreaker('smtp', umbral_fallos=1, tiempo_espera=30, reloj=self.reloj)
+        circuito.registrar_fallo()
+        self.reloj.ahora += 30
+        with override_settings(EMAIL_HOST='smtp.test.com'), \
+                mock.patch.dict(resilience.circuitos, {'smtp': circuito}), \
+                mock.patch.dict(resilience.limites, {'smtp': resilience.TokenBucket(tasa=0.1, capacidad=1, reloj=self.reloj)}), \
+                mock.patch.object(email_providers.smtp_pool, 'conexion', return_value=mock.MagicMock()), \
+                mock.patch('notifications.email_providers.enviar_con_smtp') as envio:
+            resilience.limites['smtp'].adquirir(1)
+            errores = email_providers.enviar_lote_smtp([EmailJob(destinatario='semi@test.com')])
+
+        self.assertIsInstance(errores[0], resilience.ProveedorNoDisponible)
+        envio.assert_not_called()
+        self.assertTrue(circuito.permitir())
+
+
+class NotificationCounterTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='contador@test.com', document='68000001', password='testpass123', role=User.Role.CLIENT
+        )
+        self.tipo = registry.obtener_tipo('ticket_creado')
+
+    def crear(self, **kwargs):
+        return Notification.objects.create(usuario=self.user, tipo=self.tipo, titulo='T', mensaje='M', **kwargs)
+
+    def contador(self):
+        return NotificationCounter.objects.get(pk=self.user.pk)
+
+    def test_contadores_siguen_creacion_cambios_y_borrado(self):
+        primera = self.crear()
+        self.crear(estado=Notification.Estado.ENVIADA)
+        tercera = self.crear()
+        primera.marcar_como_leida()
+        tercera.delete()
+
+        contador = self.contador()
+        self.assertEqual(
+            (contador.total, contador.pendientes, contador.enviadas, contador.leidas, contador.fallidas),
+            (2, 0, 1, 1, 0),
+        )
+        self.assertEqual(NotificationCounter.recalcular([self.user.pk]), 0)
+
+    def test_marcado_masivo_ajusta_contadores(self):
+        for _ in range(3):
+            self.crear()
+        self.crear(estado=Notification.Estado.FALLIDA)
+        self.assertEqual(NotificationDelivery.objects.filter(usuario=self.user).marcar_como_leidas(), 4)
+
+        contador = self.contador()
+        self.assertEqual((contador.leidas, contador.pendientes, contador.fallidas, contador.no_leidas), (4, 0, 0, 0))
+
+    def test_stats_es_una_lectura_por_clave_primaria(self):
+        self.crear()
+        self.crear(estado=Notification.Estado.ENVIADA)
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        with self.assertNumQueries(1):
+            response = client.get(reverse('notifications:notification-stats'))
+        self.assertEqual(response.data['total'], 2)
+        self.assertEqual(response.data['no_leidas'], 2)
+
+    def test_reconciliacion_corrige_desviaciones(self):
+        self.crear()
+        NotificationCounter.objects.filter(pk=self.user.pk).delete()
+        otro = User.objects.create_user(
+            email='contador2@test.com', document='68000002', password='testpass123', role=User.Role.CLIENT
+        )
+        NotificationCounter.objects.filter(pk=otro.pk).update(total=3)
+
+        salida = StringIO()
+        call_command('reconcile_notification_counters', stdout=salida)
+
+        self.assertIn('contadores corregidos: 2', salida.getvalue())
+        self.assertEqual((self.contador().total, self.contador().pendientes), (1, 1))
+        self.assertEqual(NotificationCounter.objects.get(pk=otro.pk).total, 0)
+
+
+class NotificationDeliveryTest(TestCase):
+    def setUp(self):
+        self.principal = User.objects.create_user(
+            email='entrega1@test.com', document='69000001', password='testpass123', role=User.Role.TECH
+        )
+        self.otro = User.objects.create_user(
+            email='entrega2@test.com', document='69000002', password='testpass123', role=User.Role.TECH
+        )
+        self.tipo = registry.obtener_tipo('ticket_creado')
+        self.notificacion = Notification.objects.create(
+            usuario=self.principal, tipo=self.tipo, titulo='T', mensaje='M', estado=Notification.Estado.ENVIADA
+        )
+        self.notificacion.destinatarios.add(self.principal, self.otro)
+
+    def test_una_entrega_por_usuario(self):
+        entregas = NotificationDelivery.objects.filter(notificacion=self.notificacion)
+        self.assertEqual(sorted(entregas.values_list('usuario_id', flat=True)), sorted([self.principal.pk, self.otro.pk]))
+        self.assertEqual(NotificationCounter.objects.get(pk=self.otro.pk).enviadas, 1)
+
+    def test_lectura_por_destinatario(self):
+        self.notificacion.marcar_como_leida(self.otro)
+
+        self.notificacion.refresh_from_db()
+        self.assertEqual(self.notificacion.estado, Notification.Estado.ENVIADA)
+        entrega = NotificationDelivery.objects.get(notificacion=self.notificacion, usuario=self.otro)
+        self.assertEqual(entrega.estado, Notification.Estado.LEIDA)
+        self.assertEqual(NotificationCounter.objects.get(pk=self.otro.pk).no_leidas, 0)
+        self.assertEqual(NotificationCounter.objects.get(pk=self.principal.pk).no_leidas, 1)
+
+        # La lectura del principal se refleja en la notificación y en su entrega
+        self.notificacion.marcar_como_leida()
+        entrega = NotificationDelivery.objects.get(notificacion=self.notificacion, usuario=self.principal)
+        self.assertEqual(entrega.estado, Notification.Estado.LEIDA)
+
+    def test_quitar_destinatario_elimina_su_entrega(self):
+        self.notificacion.destinatarios.remove(self.otro, self.principal)
+        self.assertFalse(NotificationDelivery.objects.filter(usuario=self.otro).exists())
+        self.assertTrue(NotificationDelivery.objects.filter(usuario=self.principal).exists())
+        self.assertEqual(NotificationCounter.objects.get(pk=self.otro.pk).total, 0)
+
+    def test_fan_out_crea_entregas_en_bloque(self):
+        admins = [
+            User.objects.create_user(
+                email=f'entrega_admin{i}@test.com', document=f'6900010{i}', password='testpass123',
+                role=User.Role.ADMIN, is_active=True,
+            )
+            for i in range(3)
+        ]
+        resultados = {'emails_enviados': 0, 'emails_fallidos': 0, 'notificaciones_internas': 0, 'errores': []}
+        NotificationService._enviar_notificacion_masiva(admins, None, 'ticket_creado', 'Titulo', 'Mensaje', resultados)
+
+        self.assertEqual(NotificationDelivery.objects.filter(usuario__in=admins).count(), 3)
+        self.assertEqual(NotificationCounter.recalcular([a.pk for a in admins]), 0)
+
+
+class CreateNotificationSerializerTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(
+            email='crear_admin@test.com', document='70000001', password='testpass123', role=User.Role.ADMIN
+        )
+        self.destinatarios = [
+            User.objects.create_user(
+                email=f'crear{i}@test.com', document=f'7010{i:04d}', role=User.Role.TECH
+            )
+            for i in range(60)
+        ]
+        self.request = mock.Mock(user=self.admin)
+
+    def serializer(self, documentos, **extra):
+        datos = {'user_documents': documentos, 'tipo_codigo': 'ticket_asignado', 'titulo': 'T', 'mensaje': 'M', **extra}
+        return CreateNotificationSerializer(data=datos, context={'request': self.request})
+
+    def consultas_para(self, cantidad):
+        serializer = self.serializer([u.document for u in self.destinatarios[:cantidad]])
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+            notificacion = serializer.save()
+        self.assertEqual(notificacion.destinatarios.count(), cantidad)
+        return len(ctx.captured_queries)
+
+    def test_consultas_constantes_por_cantidad_de_destinatarios(self):
+        self.assertEqual(self.consultas_para(5), self.consultas_para(60))
+
+    def test_documentos_faltantes_se_reportan_juntos(self):
+        serializer = self.serializer([self.destinatarios[0].document, 'no-existe-1', 'no-existe-2'])
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('no-existe-1, no-existe-2', str(serializer.errors['user_documents']))
+
+    def test_tipo_inactivo_y_ticket_inexistente(self):
+        NotificationType.objects.filter(codigo='ticket_asignado').update(es_activo=False)
+        registry.limpiar_cache_tipos()
+        serializer = self.serializer([self.destinatarios[0].document], ticket_id=999999)
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('tipo_codigo', serializer.errors)
+        self.assertIn('ticket_id', serializer.errors)
+
+
+class NotificationRetentionTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        self.user = User.objects.create_user(email='retencion@test.com', document='71000001', role=User.Role.TECH)
+        self.otro = User.objects.create_user(email='retencion2@test.com', document='71000002', role=User.Role.TECH)
+        self.tipo = registry.obtener_tipo('ticket_creado')
+        self.antigua = timezone.now() - timedelta(days=retention.NOTIFICATIONS_RETENTION_DAYS + 1)
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def crear(self, leida=True, fecha=None, tipo=None, destinatarios=()):
+        notificacion = Notification.objects.create(
+            usuario=self.user, tipo=tipo or self.tipo, titulo='T', mensaje='M',
+            fecha_creacion=fecha or self.antigua, datos_adicionales={'clave': 'valor'},
+        )
+        notificacion.destinatarios.add(*destinatarios)
+        if leida:
+            NotificationDelivery.objects.filter(notificacion=notificacion).marcar_como_leidas()
+        return notificacion
+
+    def test_archiva_y_elimina_solo_las_vencidas_y_leidas(self):
+        vencidas = [self.crear(destinatarios=[self.otro]) for _ in range(3)]
+        sin_leer = self.crear(leida=False)
+        leida_por_uno = self.crear(leida=False, destinatarios=[self.otro])
+        leida_por_uno.marcar_como_leida()
+        reciente = self.crear(fecha=timezone.now())
+        conservar = registry.obtener_tipo('ticket_cerrado')
+        NotificationType.objects.filter(pk=conservar.pk).update(dias_retencion=0)
+        permanente = self.crear(tipo=conservar)
+
+        salida = StringIO()
+        call_command('prune_notifications', '--batch-size', '2', stdout=salida)
+
+        restantes = set(Notification.objects.values_list('pk', flat=True))
+        self.assertEqual(restantes, {sin_leer.pk, leida_por_uno.pk, reciente.pk, permanente.pk})
+        self.assertIn('Notificaciones eliminadas: 3', salida.getvalue())
+        self.assertIn('archivos generados: 2', salida.getvalue())
+        self.assertEqual(NotificationCounter.recalcular([self.user.pk, self.otro.pk]), 0)
+
+        archivados = []
+        for nombre in os.listdir(os.path.join(self.media_root, retention.NOTIFICATIONS_ARCHIVE_PATH)):
+            with gzip.open(os.path.join(self.media_root, retention.NOTIFICATIONS_ARCHIVE_PATH, nombre), 'rt') as f:
+                archivados += [json.loads(linea) for linea in f]
+        self.assertEqual(sorted(r['id'] for r in archivados), sorted(n.pk for n in vencidas))
+        self.assertEqual(archivados[0]['datos_adicionales'], {'clave': 'valor'})
+        self.assertEqual(len(archivados[0]['entregas']), 2)
+
+    def test_dry_run_no_elimina(self):
+        self.crear()
+        salida = StringIO()
+        call_command('prune_notifications', '--dry-run', stdout=salida)
+        self.assertIn('ticket_creado: 1', salida.getvalue())
+        self.assertEqual(Notification.objects.count(), 1)
+
+
+class NotificationIdempotencyTest(TestCase):
+    def setUp(self):
+        self.cliente = User.objects.create_user(email='idem@test.com', document='72000001', role=User.Role.CLIENT)
+        self.abierto, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto'})
+        self.reparacion, _ = Estado.objects.get_or_create(codigo='in_repair', defaults={'nombre': 'En reparación'})
+        self.ticket = Ticket.objects.create(titulo='Idem', descripcion='Prueba', cliente=self.cliente, estado=self.abierto)
+
+    def cambiar_estado(self, estado):
+        self.ticket.estado = estado
+        self.ticket.save()
+
+    def cambios_de_estado(self):
+        return Notification.objects.filter(tipo__codigo='estado_cambiado', usuario=self.cliente)
+
+    def test_signal_y_vista_notifican_una_sola_vez(self):
+        EmailJob.objects.all().delete()
+        self.cambiar_estado(self.reparacion)
+        # La vista vuelve a notificar la misma transición que ya notificó el signal
+        resultados = NotificationService.enviar_notificacion_estado_cambiado(self.ticket, self.abierto.nombre)
+
+        self.assertEqual(self.cambios_de_estado().count(), 1)
+        self.assertEqual(EmailJob.objects.count(), 1)
+        self.assertEqual(resultados['notificaciones_internas'], 0)
+        self.assertEqual(resultados['emails_enviados'], 0)
+
+    def test_transicion_repetida_se_notifica_de_nuevo(self):
+        self.cambiar_estado(self.reparacion)
+        self.cambiar_estado(self.abierto)
+        self.cambiar_estado(self.reparacion)
+
+        self.assertEqual(self.cambios_de_estado().count(), 3)
+        self.assertEqual(len(set(self.cambios_de_estado().values_list('clave_idempotencia', flat=True))), 3)
+
+    def test_sin_transicion_usa_la_version_del_ticket(self):
+        ticket = Ticket.objects.get(pk=self.ticket.pk)
+        NotificationService.enviar_notificacion_estado_cambiado(ticket, self.abierto.nombre)
+        NotificationService.enviar_notificacion_estado_cambiado(ticket, self.abierto.nombre)
+        self.assertEqual(self.cambios_de_estado().count(), 1)
+
+    def solicitud(self, **campos):
+        tecnico = User.objects.create_user(email='idem_tec@test.com', document='72000002', role=User.Role.TECH)
+        admin = User.objects.create_user(email='idem_admin@test.com', document='72000003', role=User.Role.ADMIN)
+        self.ticket.tecnico = tecnico
+        self.ticket.save()
+        return StateChangeRequest.objects.create(
+            ticket=self.ticket, requested_by=tecnico, approved_by=admin,
+            from_state=self.abierto, to_state=self.reparacion, **campos
+        )
+
+    def test_aprobacion_repetida_no_duplica(self):
+        solicitud = self.solicitud(status=StateChangeRequest.Status.APPROVED)
+        Notification.objects.all().delete()
+        EmailJob.objects.all().delete()
+
+        primera = NotificationService.enviar_aprobacion_cambio_estado(solicitud)
+        segunda = NotificationService.enviar_aprobacion_cambio_estado(solicitud)
+
+        self.assertEqual(primera['notificaciones_internas'], 3)
+        self.assertEqual(segunda['notificaciones_internas'], 0)
+        self.assertEqual(Notification.objects.count(), 3)
+        self.assertEqual(EmailJob.objects.count(), 3)
+
+    def test_rechazo_repetido_no_duplica(self):
+        solicitud = self.solicitud(status=StateChangeRequest.Status.REJECTED, rejection_reason='No aplica')
+        Notification.objects.all().delete()
+
+        NotificationService.enviar_rechazo_cambio_estado(solicitud)
+        NotificationService.enviar_rechazo_cambio_estado(solicitud)
+
+        self.assertEqual(Notification.objects.count(), 3)
+
+    def test_cancelacion_repetida_no_duplica(self):
+        User.objects.create_user(email='idem_admin2@test.com', document='72000004', role=User.Role.ADMIN)
+        self.ticket.save()
+        Notification.objects.all().delete()
+
+        NotificationService.enviar_notificacion_ticket_cancelado(self.ticket)
+        resultados = NotificationService.enviar_notificacion_ticket_cancelado(self.ticket)
+
+        self.assertEqual(resultados['notificaciones_internas'], 0)
+        self.assertEqual(Notification.objects.filter(tipo__codigo='ticket_cancelado').count(), 2)
@@ -1,7 +1,19 @@
+import asyncio
+import json
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.test import APITestCase
 from rest_framework import status
+from rest_framework_simplejwt.tokens import RefreshToken
 from users.models import User
+from notifications import pubsub, registry, views
+from notifications.models import Notification, NotificationDelivery
+from tickets.models import Estado, Ticket
 
 class NotificationsEndpointsTests(APITestCase):
     def setUp(self):
@@ -21,3 +33,369 @@ class NotificationsEndpointsTests(APITestCase):
         url = reverse('notifications:user-notifications')
         response = self.client.get(url, HTTP_ACCEPT='application/json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class NotificationStreamTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='stream_notif@test.com', password='Password123!', document='stream_notif_01', role=User.Role.CLIENT, is_active=True
+        )
+        self.url = reverse('notifications:notification-stream')
+
+    def test_stream_requires_ticket(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get(self.url, {'ticket': 'invalido'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        # El JWT ya no se acepta en la URL
+        response = self.client.get(self.url, {'token': str(RefreshToken.for_user(self.user).access_token)})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_stream_ticket_is_issued_to_authenticated_users_and_expires(self):
+        url = reverse('notifications:notification-stream-ticket')
+        self.assertEqual(self.client.post(url).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['expires_in'], views.NOTIFICATIONS_STREAM_TICKET_TTL)
+
+        with mock.patch.object(views, 'NOTIFICATIONS_STREAM_TICKET_TTL', -1):
+            response = self.client.get(self.url, {'ticket': response.data['ticket']})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_new_notification_is_published_on_commit(self):
+        tipo = registry.obtener_tipo('ticket_creado')
+        with mock.patch.object(pubsub.MemoryPubSub, 'publicar') as publicar:
+            with self.captureOnCommitCallbacks(execute=True):
+                notification = Notification.objects.create(usuario=self.user, tipo=tipo, titulo='Hola', mensaje='Nueva')
+
+        publicar.assert_called_once()
+        canal, mensaje = publicar.call_args.args
+        self.assertEqual(canal, pubsub.canal_usuario(self.user.pk))
+        self.assertEqual(mensaje['id'], notification.pk)
+        self.assertEqual(mensaje['tipo_codigo'], 'ticket_creado')
+
+    async def test_stream_pushes_published_notifications(self):
+        response = await self.async_client.get(self.url, {'ticket': views.emitir_ticket_stream(self.user)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        eventos = response.streaming_content.__aiter__()
+        self.assertTrue((await eventos.__anext__()).startswith(b'retry:'))
+
+        pubsub.get_pubsub().publicar(pubsub.canal_usuario(self.user.pk), {'id': 7, 'titulo': 'Nueva'})
+        pubsub.get_pubsub().publicar(pubsub.canal_usuario('otro'), {'id': 8, 'titulo': 'Ajena'})
+        evento = await asyncio.wait_for(eventos.__anext__(), timeout=2)
+        await eventos.aclose()
+
+        self.assertTrue(evento.startswith(b'id: 7\nevent: notification\n'))
+        self.assertEqual(json.loads(evento.split(b'data: ')[1])['titulo'], 'Nueva')
+
+
+class NotificationWaitTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='wait_notif@test.com', document='wait_notif_01', role=User.Role.CLIENT, is_active=True
+        )
+        self.tipo = registry.obtener_tipo('ticket_creado')
+        self.url = reverse('notifications:notification-wait')
+        self.refresh = RefreshToken.for_user(self.user)
+        self.auth = {'HTTP_AUTHORIZATION': f'Bearer {self.refresh.access_token}'}
+
+    def test_wait_requires_token_and_since(self):
+        response = self.client.get(self.url, {'since': 0})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        # Los tokens de refresco no sirven para autenticar
+        response = self.client.get(self.url, {'since': 0}, HTTP_AUTHORIZATION=f'Bearer {self.refresh}')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get(self.url, **self.auth)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(self.url, {'since': 'x'}, **self.auth)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_wait_returns_existing_newer_notifications_immediately(self):
+        vieja = Notification.objects.create(usuario=self.user, tipo=self.tipo, titulo='Vieja', mensaje='m')
+        nueva = Notification.objects.create(usuario=self.user, tipo=self.tipo, titulo='Nueva', mensaje='m')
+
+        response = self.client.get(self.url, {'since': vieja.pk, 'timeout': 5}, **self.auth)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([n['id'] for n in response.json()['notifications']], [nueva.pk])
+        self.assertEqual(response.json()['last_id'], nueva.pk)
+
+    def test_wait_times_out_with_empty_list(self):
+        response = self.client.get(self.url, {'since': 0, 'timeout': 0}, **self.auth)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'notifications': [], 'last_id': 0})
+
+    def test_wait_queries_again_on_timeout(self):
+        consultar = views._notificaciones_perdidas
+        creadas = []
+
+        def consulta_y_otro_proceso_crea(usuario_id, ultimo_id):
+            resultado = consultar(usuario_id, ultimo_id)
+            if not creadas:
+                # Otro proceso confirma una notificación durante la espera: el pub/sub
+                # en memoria de este proceso no se entera
+                creadas.append(Notification.objects.create(usuario=self.user, tipo=self.tipo, titulo='Otra', mensaje='m'))
+            return resultado
+
+        with mock.patch.object(views, '_notificaciones_perdidas', side_effect=consulta_y_otro_proceso_crea):
+            response = self.client.get(self.url, {'since': 0, 'timeout': 0.1}, **self.auth)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([n['id'] for n in response.json()['notifications']], [creadas[0].pk])
+        self.assertEqual(response.json()['last_id'], creadas[0].pk)
+
+    async def test_wait_wakes_up_on_published_notification(self):
+        espera = asyncio.ensure_future(
+            self.async_client.get(self.url, {'ticket': views.emitir_ticket_stream(self.user), 'since': 0, 'timeout': 5})
+        )
+        canal = pubsub.canal_usuario(self.user.pk)
+        while not pubsub.get_pubsub()._suscripciones.get(canal):
+            await asyncio.sleep(0.01)
+
+        pubsub.get_pubsub().publicar(pubsub.canal_usuario('otro'), {'id': 8, 'titulo': 'Ajena'})
+        pubsub.get_pubsub().publicar(canal, {'id': 7, 'titulo': 'Nueva'})
+        response = await asyncio.wait_for(espera, timeout=2)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'notifications': [{'id': 7, 'titulo': 'Nueva'}], 'last_id': 7})
+
+
+class NotificationBulkMarkReadTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='bulk_read@test.com', password='Password123!', document='bulk_read_01', role=User.Role.CLIENT, is_active=True
+        )
+        self.otro = User.objects.create_user(
+            email='bulk_read_otro@test.com', password='Password123!', document='bulk_read_02', role=User.Role.CLIENT, is_active=True
+        )
+        self.creado = registry.obtener_tipo('ticket_creado')
+        self.cerrado = registry.obtener_tipo('ticket_cerrado')
+        self.notificaciones = [
+            Notification.objects.create(usuario=self.user, tipo=self.creado, titulo=f'N{i}', mensaje='m')
+            for i in range(3)
+        ]
+        self.notificaciones.append(
+            Notification.objects.create(usuario=self.user, tipo=self.cerrado, titulo='Cerrado', mensaje='m')
+        )
+        self.ajena = Notification.objects.create(usuario=self.otro, tipo=self.creado, titulo='Ajena', mensaje='m')
+        self.client.force_authenticate(user=self.user)
+
+    def test_mark_read_by_ids_single_update(self):
+        ids = [self.notificaciones[0].pk, self.notificaciones[1].pk, self.ajena.pk]
+        url = reverse('notifications:notification-bulk-mark-read')
+        # Bloqueo de las entregas, UPDATE de las entregas, de los contadores y de las
+        # notificaciones de las que el usuario es destinatario principal
+        with self.assertNumQueries(4):
+            response = self.client.post(url, {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['actualizadas'], 2)
+        self.assertEqual(Notification.objects.filter(estado=Notification.Estado.LEIDA).count(), 2)
+        self.ajena.refresh_from_db()
+        self.assertFalse(self.ajena.es_leida)
+
+        # Las ya leídas no se vuelven a contar
+        response = self.client.post(url, {'ids': ids}, format='json')
+        self.assertEqual(response.data['actualizadas'], 0)
+
+    def test_mark_read_by_filters(self):
+        url = reverse('notifications:notification-bulk-mark-read')
+        response = self.client.post(url, {'tipo': 'ticket_cerrado'}, format='json')
+        self.assertEqual(response.data['actualizadas'], 1)
+        self.notificaciones[3].refresh_from_db()
+        self.assertTrue(self.notificaciones[3].es_leida)
+        self.assertIsNotNone(self.notificaciones[3].fecha_lectura)
+
+    def test_mark_read_requires_selection(self):
+        url = reverse('notifications:notification-bulk-mark-read')
+        response = self.client.post(url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Notification.objects.filter(estado=Notification.Estado.LEIDA).exists())
+
+    def test_mark_all_read(self):
+        url = reverse('notifications:notification-mark-all-read')
+        response = self.client.post(url)
+        self.assertEqual(response.data['actualizadas'], 4)
+        self.assertFalse(NotificationDelivery.objects.filter(usuario=self.user).no_leidas().exists())
+        self.ajena.refresh_from_db()
+        self.assertFalse(self.ajena.es_leida)
+
+
+class NotificationInboxPaginationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email='inbox_notif@test.com', password='Password123!', document='inbox_notif_01', role=User.Role.CLIENT, is_active=True
+        )
+        self.otro = User.objects.create_user(
+            email='inbox_otro@test.com', password='Password123!', document='inbox_notif_02', role=User.Role.CLIENT, is_active=True
+        )
+        tipo = registry.obtener_tipo('ticket_creado')
+        fecha = timezone.now()
+        # Varias notificaciones con la misma fecha para ejercitar el desempate por id
+        self.propias = [
+            Notification.objects.create(usuario=self.user, tipo=tipo, titulo=f'P{i}', mensaje='m', fecha_creacion=fecha)
+            for i in range(4)
+        ]
+        self.compartida = Notification.objects.create(usuario=self.otro, tipo=tipo, titulo='C', mensaje='m')
+        # Destinatario principal y también en destinatarios: debe aparecer una sola vez
+        self.compartida.destinatarios.add(self.user, self.otro)
+        self.propias[0].destinatarios.add(self.user)
+        self.client.force_authenticate(user=self.user)
+
+    def recorrer(self, url):
+        vistos, params = [], {'limit': 2}
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            vistos += [n['id'] for n in response.data['notifications']]
+            if not response.data['next_cursor']:
+                return vistos, response.data['total_notifications']
+            params['cursor'] = response.data['next_cursor']
+
+    def test_user_notifications_keyset_without_duplicates(self):
+        vistos, total = self.recorrer(reverse('notifications:user-notifications'))
+        esperados = [self.compartida.pk] + sorted((n.pk for n in self.propias), reverse=True)
+        self.assertEqual(vistos, esperados)
+        self.assertEqual(total, 5)
+
+    def test_client_notifications_keyset_without_duplicates(self):
+        vistos, total = self.recorrer(reverse('notifications:client-notifications'))
+        self.assertEqual(len(vistos), len(set(vistos)))
+        self.assertEqual(total, 5)
+
+    def test_inbox_query_has_no_distinct(self):
+        url = reverse('notifications:user-notifications')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url)
+        self.assertFalse(any('DISTINCT' in q['sql'] for q in ctx.captured_queries))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('notifications:user-notifications'), {'cursor': 'no-es-un-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class NotificationListQueryCountTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='consultas_notif@test.com', password='Password123!', document='qc_notif_1', role=User.Role.CLIENT, is_active=True
+        )
+        self.admin = User.objects.create_user(
+            email='consultas_admin@test.com', password='Password123!', document='qc_notif_2', role=User.Role.ADMIN, is_active=True
+        )
+        self.otros = [
+            User.objects.create_user(
+                email=f'consultas_otro{i}@test.com', password='Password123!', document=f'qc_otro_{i}', role=User.Role.TECH, is_active=True
+            )
+            for i in range(3)
+        ]
+        estado, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto'})
+        self.tickets = [
+            Ticket.objects.create(
+                titulo=f'Ticket {i}', descripcion='Prueba', cliente=self.user, administrador=self.admin,
+                tecnico=self.otros[i], estado=estado,
+            )
+            for i in range(3)
+        ]
+        self.tipo = registry.obtener_tipo('ticket_asignado')
+        self.creadas = 0
+        self.client.force_authenticate(user=self.user)
+
+    def crear_hasta(self, cantidad):
+        for i in range(self.creadas, cantidad):
+            notificacion = Notification.objects.create(
+                usuario=self.user, tipo=self.tipo, ticket=self.tickets[i % 3], enviado_por=self.admin,
+                titulo=f'N{i}', mensaje='m',
+            )
+            notificacion.destinatarios.add(self.otros[i % 3], self.otros[(i + 1) % 3])
+        self.creadas = cantidad
+
+    def consultas(self, url, cantidad):
+        self.crear_hasta(cantidad)
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, {'limit': cantidad})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(ctx.captured_queries), response
+
+    def test_list_endpoints_use_constant_queries(self):
+        for nombre in ('notification-list', 'user-notifications', 'client-notifications'):
+            with self.subTest(endpoint=nombre):
+                url = reverse(f'notifications:{nombre}')
+                con_20, _ = self.consultas(url, 20)
+                con_100, response = self.consultas(url, 100)
+                self.assertEqual(con_20, con_100)
+
+        datos = response.data['notifications'][0]
+        self.assertEqual(len(datos['destinatarios']), 2)
+        self.assertEqual(datos['enviado_por']['email'], self.admin.email)
+
+    def test_user_notifications_include_ticket_technician(self):
+        _, response = self.consultas(reverse('notifications:user-notifications'), 20)
+        tecnicos = {n['new_technician_info']['email'] for n in response.data['notifications']}
+        self.assertEqual(tecnicos, {u.email for u in self.otros})
+
+
+class NotificationConditionalGetTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email='etag_notif@test.com', password='Password123!', document='etag_notif', role=User.Role.CLIENT, is_active=True
+        )
+        self.tipo = registry.obtener_tipo('ticket_creado')
+        self.notificacion = Notification.objects.create(usuario=self.user, tipo=self.tipo, titulo='T', mensaje='m')
+        self.client.force_authenticate(user=self.user)
+        # Los totales se cachean por versión y las versiones se repiten entre pruebas
+        cache.clear()
+
+    def test_unchanged_inbox_returns_304_without_serializing(self):
+        for nombre in ('notification-list', 'notification-stats', 'user-notifications', 'client-notifications'):
+            with self.subTest(endpoint=nombre):
+                url = reverse(f'notifications:{nombre}')
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                etag = response['ETag']
+
+                # Solo se lee la versión de los contadores
+                with self.assertNumQueries(1):
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_with_new_and_read_notifications(self):
+        url = reverse('notifications:user-notifications')
+        inicial = self.client.get(url)['ETag']
+
+        Notification.objects.create(usuario=self.user, tipo=self.tipo, titulo='Nueva', mensaje='m')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=inicial)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_notifications'], 2)
+
+        self.client.post(reverse('notifications:notification-mark-all-read'))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_etag_changes_when_notification_content_or_type_changes(self):
+        url = reverse('notifications:user-notifications')
+        etag = self.client.get(url)['ETag']
+
+        self.notificacion.mensaje = 'editado'
+        self.notificacion.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['notifications'][0]['mensaje'], 'editado')
+
+        self.tipo.nombre = 'Ticket registrado'
+        self.tipo.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['notifications'][0]['tipo_nombre'], 'Ticket registrado')
+
+    def test_etag_depends_on_query_params(self):
+        url = reverse('notifications:user-notifications')
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, {'leidas': 'true'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_notifications'], 0)
@@ -10,6 +10,14 @@ urlpatterns = [
     # Detalle de notificación específica
     path('<int:notification_id>/', views.notification_detail, name='notification-detail'),
     
+    # Stream en tiempo real (Server-Sent Events) de notificaciones nuevas
+    path('stream/', views.notification_stream, name='notification-stream'),
+    # Ticket de corta duración para abrir el stream sin poner el JWT en la URL
+    path('stream/ticket/', views.NotificationStreamTicketAV.as_view(), name='notification-stream-ticket'),
+    
+    # Long polling: espera hasta que haya notificaciones posteriores a `since`
+    path('wait/', views.notification_wait, name='notification-wait'),
+    
     # Estadísticas del usuario autenticado
     path('stats/', views.notification_stats, name='notification-stats'),
     
@@ -22,6 +30,13 @@ urlpatterns = [
     # Marcar notificación como leída
     path('<int:notification_id>/mark-read/', views.NotificationMarkAsReadAV.as_view(), name='notification-mark-read'),
     
+    # Marcar varias notificaciones como leídas (por ids o filtros) o todas
+    path('mark-read/', views.NotificationBulkMarkReadAV.as_view(), name='notification-bulk-mark-read'),
+    path('mark-all-read/', views.NotificationMarkAllReadAV.as_view(), name='notification-mark-all-read'),
+    
+    # Preferencias de correo (inmediato o resumen) del usuario autenticado
+    path('preferences/', views.NotificationPreferenceAV.as_view(), name='notification-preferences'),
+    
     # Notificaciones específicas para clientes
     path('client/', views.ClientNotificationsAV.as_view(), name='client-notifications'),
 ]
\ No newline at end of file
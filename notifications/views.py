@@ -1,52 +1,75 @@
+import asyncio
+import json
+from functools import cached_property
+
+from asgiref.sync import sync_to_async
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from rest_framework.generics import ListAPIView, UpdateAPIView
+from rest_framework.views import APIView
+from rest_framework.generics import ListAPIView, RetrieveUpdateAPIView, UpdateAPIView
 from django.shortcuts import get_object_or_404
-from django.db.models import Q, Count
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.core import signing
 
-from .models import Notification, NotificationType
+from . import inbox
+from .models import Notification, NotificationCounter, NotificationDelivery, NotificationPreference, NotificationType
+from .pubsub import canal_usuario, get_pubsub, serializar_notificacion
 from .serializers import (
-    NotificationSerializer, NotificationListSerializer,
+    NotificationBulkMarkReadSerializer, NotificationSerializer, NotificationListSerializer, NotificationPreferenceSerializer,
     NotificationStatsSerializer, NotificationTypeSerializer, NotificationUpdateSerializer
 )
 from tickets.permissions import IsClient
 
 User = get_user_model()
 
+# Cada cuántos segundos se envía un comentario al stream para mantener viva la conexión
+NOTIFICATIONS_STREAM_HEARTBEAT = getattr(settings, 'NOTIFICATIONS_STREAM_HEARTBEAT', 15)
+# Notificaciones perdidas que se reenvían al reconectar con Last-Event-ID
+NOTIFICATIONS_STREAM_REPLAY_LIMIT = getattr(settings, 'NOTIFICATIONS_STREAM_REPLAY_LIMIT', 100)
+# Segundos de validez del ticket para abrir el stream (solo se verifica al conectar)
+NOTIFICATIONS_STREAM_TICKET_TTL = getattr(settings, 'NOTIFICATIONS_STREAM_TICKET_TTL', 60)
+# Segundos máximos que se retiene una petición de long polling
+NOTIFICATIONS_WAIT_TIMEOUT = getattr(settings, 'NOTIFICATIONS_WAIT_TIMEOUT', 25)
 
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def notification_list(request):
-    user = request.user
-
-    # Solo mostrar notificaciones donde el usuario es el destinatario principal
-    queryset = Notification.objects.filter(usuario=user).select_related('tipo', 'ticket', 'enviado_por').order_by('-fecha_creacion')
-
-    estado = request.query_params.get('estado')
-    if estado:
-        queryset = queryset.filter(estado=estado)
 
-    tipo = request.query_params.get('tipo')
-    if tipo:
-        queryset = queryset.filter(tipo__codigo=tipo)
+def _respuesta_condicional(request, etag, construir):
+    """
+    Responde 304 sin consultar ni serializar si el cliente ya tiene la versión
+    `etag` (If-None-Match); si no, construye la respuesta y le agrega el ETag.
+    """
+    previos = {e.removeprefix('W/') for e in parse_etags(request.headers.get('If-None-Match', ''))}
+    if etag in previos or '*' in previos:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = construir()
+    response['ETag'] = etag
+    # La respuesta depende del usuario del token: no debe compartirse entre usuarios
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Authorization'])
+    return response
 
-    leidas = request.query_params.get('leidas')
-    if leidas is not None:
-        if leidas.lower() == 'true':
-            queryset = queryset.filter(estado=Notification.Estado.LEIDA)
-        elif leidas.lower() == 'false':
-            queryset = queryset.exclude(estado=Notification.Estado.LEIDA)
 
-    limit = min(int(request.query_params.get('limit', 20)), 100)
-    offset = int(request.query_params.get('offset', 0))
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def notification_list(request):
+    def construir():
+        # Entregas del usuario (como destinatario principal o adicional), con su estado de lectura
+        queryset = inbox.filtrar(inbox.con_relaciones(inbox.bandeja(request.user)), request.query_params)
+        entregas, _ = inbox.paginar(queryset, request.query_params)
+        serializer = NotificationListSerializer(inbox.notificaciones(entregas), many=True)
+        return Response(serializer.data)
 
-    notifications = queryset[offset:offset + limit]
-    serializer = NotificationListSerializer(notifications, many=True)
-    return Response(serializer.data)
+    version = NotificationCounter.version_de(request.user)
+    return _respuesta_condicional(request, inbox.etag(request.user.pk, version, request), construir)
 
 
 @api_view(['GET'])
@@ -58,24 +81,24 @@ def notification_detail(request, notification_id):
     )
 
     user = request.user
+    # La entrega del usuario indica si es destinatario y guarda su estado de lectura
+    entrega = notification.entregas.filter(usuario_id=user.pk).first()
     # Permitir acceso si es el dueño, destinatario o administrador
     allowed = (
         getattr(user, 'role', None) == getattr(User.Role, 'ADMIN', 'ADMIN') or
-        notification.usuario == user or
-        notification.enviado_por == user or
-        notification.destinatarios.filter(pk=user.pk).exists()
+        entrega is not None or
+        notification.enviado_por == user
     )
 
     if not allowed:
         return Response({"detail": "No autorizado."}, status=status.HTTP_403_FORBIDDEN)
 
-    try:
-        is_recipient = (request.user and request.user.is_authenticated and notification.usuario == request.user)
-    except Exception:
-        is_recipient = (user is not None and notification.usuario == user)
-
-    if is_recipient and not notification.es_leida:
-        notification.marcar_como_leida()
+    if entrega is not None:
+        if entrega.estado != Notification.Estado.LEIDA:
+            notification.marcar_como_leida(user)
+            entrega.refresh_from_db(fields=['estado', 'fecha_lectura'])
+        notification.estado = entrega.estado
+        notification.fecha_lectura = entrega.fecha_lectura
 
     serializer = NotificationSerializer(notification)
     return Response(serializer.data)
@@ -84,18 +107,13 @@ def notification_detail(request, notification_id):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def notification_stats(request):
-    user = request.user
-    # Solo contar notificaciones donde el usuario es el destinatario principal
-    stats = Notification.objects.filter(usuario=user).aggregate(
-        total=Count('id'),
-        pendientes=Count('id', filter=Q(estado=Notification.Estado.PENDIENTE)),
-        enviadas=Count('id', filter=Q(estado=Notification.Estado.ENVIADA)),
-        leidas=Count('id', filter=Q(estado=Notification.Estado.LEIDA)),
-        fallidas=Count('id', filter=Q(estado=Notification.Estado.FALLIDA))
+    # Contadores mantenidos por usuario: una lectura por clave primaria
+    contador = NotificationCounter.para_usuario(request.user)
+    return _respuesta_condicional(
+        request,
+        inbox.etag(contador.pk, contador.version, request),
+        lambda: Response(NotificationStatsSerializer(contador).data),
     )
-    stats['no_leidas'] = stats['pendientes'] + stats['enviadas']
-    serializer = NotificationStatsSerializer(stats)
-    return Response(serializer.data)
 
 
 @api_view(['GET'])
@@ -112,40 +130,24 @@ class UserNotificationsAV(ListAPIView):
     permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
-        user = self.request.user
-        return Notification.objects.filter(
-            Q(usuario=user) | Q(destinatarios=user)
-        ).select_related('tipo', 'ticket', 'enviado_por').order_by('-fecha_creacion').distinct()
+        return inbox.con_relaciones(inbox.bandeja(self.request.user))
     
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        
-        # Aplicar filtros opcionales
-        estado = request.query_params.get('estado')
-        if estado:
-            queryset = queryset.filter(estado=estado)
-        
-        tipo = request.query_params.get('tipo')
-        if tipo:
-            queryset = queryset.filter(tipo__codigo=tipo)
-        
-        leidas = request.query_params.get('leidas')
-        if leidas is not None:
-            if leidas.lower() == 'true':
-                queryset = queryset.filter(estado=Notification.Estado.LEIDA)
-            elif leidas.lower() == 'false':
-                queryset = queryset.exclude(estado=Notification.Estado.LEIDA)
-        
-        # Paginación
-        limit = min(int(request.query_params.get('limit', 20)), 100)
-        offset = int(request.query_params.get('offset', 0))
-        
-        notifications = queryset[offset:offset + limit]
-        serializer = self.get_serializer(notifications, many=True)
+        version = NotificationCounter.version_de(request.user)
+        return _respuesta_condicional(
+            request, inbox.etag(request.user.pk, version, request), lambda: self.construir(request, version)
+        )
+    
+    def construir(self, request, version):
+        # Filtros opcionales y paginación por cursor (fecha_creacion, id)
+        queryset = inbox.filtrar(self.get_queryset(), request.query_params)
+        entregas, next_cursor = inbox.paginar(queryset, request.query_params)
+        serializer = self.get_serializer(inbox.notificaciones(entregas), many=True)
         
         return Response({
             'message': 'Historial de notificaciones',
-            'total_notifications': queryset.count(),
+            'total_notifications': inbox.contar(queryset, request.user, request.query_params, version),
+            'next_cursor': next_cursor,
             'notifications': serializer.data
         }, status=status.HTTP_200_OK)
 
@@ -161,7 +163,7 @@ class NotificationMarkAsReadAV(UpdateAPIView):
         
         # Buscar notificación que pertenezca al usuario
         return get_object_or_404(
-            Notification.objects.filter(usuario=user),
+            Notification.objects.filter(entregas__usuario=user),
             pk=notification_id
         )
     
@@ -180,64 +182,246 @@ class NotificationMarkAsReadAV(UpdateAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class NotificationBulkMarkReadAV(APIView):
+    """Marca como leídas varias notificaciones del usuario (por ids o filtros) con un solo UPDATE."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = NotificationBulkMarkReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        queryset = serializer.filtrar(inbox.bandeja(request.user))
+        actualizadas = queryset.marcar_como_leidas()
+        return Response({
+            'message': 'Notificaciones marcadas como leídas',
+            'actualizadas': actualizadas,
+        }, status=status.HTTP_200_OK)
+
+
+class NotificationMarkAllReadAV(APIView):
+    """Marca como leídas todas las notificaciones no leídas del usuario."""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        actualizadas = inbox.bandeja(request.user).marcar_como_leidas()
+        return Response({
+            'message': 'Todas las notificaciones marcadas como leídas',
+            'actualizadas': actualizadas,
+        }, status=status.HTTP_200_OK)
+
+
+class NotificationPreferenceAV(RetrieveUpdateAPIView):
+    """Consulta y actualiza la frecuencia de correos (inmediata o resumen horario/diario) del usuario."""
+    serializer_class = NotificationPreferenceSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_object(self):
+        preferencia, _ = NotificationPreference.objects.get_or_create(usuario=self.request.user)
+        return preferencia
+
+
 class ClientNotificationsAV(ListAPIView):
     """Endpoint específico para que los clientes consulten sus notificaciones."""
     serializer_class = NotificationListSerializer
     permission_classes = [IsClient]
     
-    def get_queryset(self):
-        user = self.request.user
-        
+    @cached_property
+    def usuario(self):
         # Obtener usuario por user_document si se proporciona (para compatibilidad)
         user_document = self.request.query_params.get('user_document')
-        if user_document:
-            try:
-                user = User.objects.only('id', 'email', 'role').get(document=user_document, role=User.Role.CLIENT)
-            except User.DoesNotExist:
-                return Notification.objects.none()
-        
-        # Optimización: usar Q objects con OR para mejor rendimiento y optimizar con select_related/prefetch_related
-        # Esto es más eficiente que usar union y permite usar select_related/prefetch_related
-        queryset = Notification.objects.filter(
-            Q(usuario=user) | Q(destinatarios=user)
-        ).select_related(
-            'tipo', 'ticket', 'enviado_por', 'usuario'
-        ).prefetch_related('destinatarios').order_by('-fecha_creacion').distinct()
-        
-        return queryset
+        if not user_document:
+            return self.request.user
+        return User.objects.only('pk').filter(document=user_document, role=User.Role.CLIENT).first()
+    
+    def get_queryset(self):
+        if self.usuario is None:
+            return NotificationDelivery.objects.none()
+        return inbox.con_relaciones(inbox.bandeja(self.usuario))
     
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        
-        # Aplicar filtros opcionales (antes de paginación para mejor rendimiento)
-        estado = request.query_params.get('estado')
-        if estado:
-            queryset = queryset.filter(estado=estado)
-        
-        tipo = request.query_params.get('tipo')
-        if tipo:
-            queryset = queryset.filter(tipo__codigo=tipo)
-        
-        leidas = request.query_params.get('leidas')
-        if leidas is not None:
-            if leidas.lower() == 'true':
-                queryset = queryset.filter(estado=Notification.Estado.LEIDA)
-            elif leidas.lower() == 'false':
-                queryset = queryset.exclude(estado=Notification.Estado.LEIDA)
-        
-        # Cachear el count antes de paginar (más eficiente)
-        total_count = queryset.count()
-        
-        # Paginación
-        limit = min(int(request.query_params.get('limit', 20)), 100)
-        offset = int(request.query_params.get('offset', 0))
-        
-        notifications = queryset[offset:offset + limit]
-        serializer = self.get_serializer(notifications, many=True)
+        if self.usuario is None:
+            return self.construir(request, None)
+        version = NotificationCounter.version_de(self.usuario)
+        return _respuesta_condicional(
+            request, inbox.etag(self.usuario.pk, version, request), lambda: self.construir(request, version)
+        )
+    
+    def construir(self, request, version):
+        # Filtros opcionales antes de paginar por cursor (fecha_creacion, id)
+        queryset = inbox.filtrar(self.get_queryset(), request.query_params)
+        entregas, next_cursor = inbox.paginar(queryset, request.query_params)
+        serializer = self.get_serializer(inbox.notificaciones(entregas), many=True)
         
         return Response({
             'message': 'Notificaciones del cliente',
-            'total_notifications': total_count,
+            'total_notifications': inbox.contar(queryset, self.usuario, request.query_params, version) if self.usuario else 0,
+            'next_cursor': next_cursor,
             'notifications': serializer.data
         }, status=status.HTTP_200_OK)
 
+
+def _evento_sse(mensaje: dict) -> str:
+    return f"id: {mensaje['id']}\nevent: notification\ndata: {json.dumps(mensaje)}\n\n"
+
+
+def _notificaciones_perdidas(usuario_id, ultimo_id):
+    entregas = (
+        NotificationDelivery.objects.filter(usuario_id=usuario_id, notificacion_id__gt=ultimo_id)
+        .select_related('notificacion__tipo').order_by('notificacion_id')[:NOTIFICATIONS_STREAM_REPLAY_LIMIT]
+    )
+    return [serializar_notificacion(n) for n in inbox.notificaciones(entregas)]
+
+
+def _firmador_stream():
+    return signing.TimestampSigner(salt='notifications.stream-ticket')
+
+
+def emitir_ticket_stream(usuario) -> str:
+    return _firmador_stream().sign(str(usuario.pk))
+
+
+class NotificationStreamTicketAV(APIView):
+    """
+    Emite un ticket firmado para abrir el stream (o el long polling) con
+    EventSource, que no permite cabeceras. Así el JWT nunca va en la URL, que
+    queda registrada en logs de acceso y proxies: el ticket solo sirve para
+    estos endpoints y vence a los NOTIFICATIONS_STREAM_TICKET_TTL segundos, por
+    lo que al reconectar después de ese plazo hay que pedir otro.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        return Response({
+            'ticket': emitir_ticket_stream(request.user),
+            'expires_in': NOTIFICATIONS_STREAM_TICKET_TTL,
+        }, status=status.HTTP_200_OK)
+
+
+async def _usuario_del_stream(request):
+    """
+    Autentica con `?ticket=` (emitido por NotificationStreamTicketAV) o con el
+    JWT de acceso en `Authorization: Bearer`. El JWT no se acepta en la URL y
+    JWTAuthentication rechaza los tokens de refresco.
+    """
+    ticket = request.GET.get('ticket')
+    if ticket:
+        try:
+            pk = _firmador_stream().unsign(ticket, max_age=NOTIFICATIONS_STREAM_TICKET_TTL)
+        except signing.BadSignature:
+            return None
+        return await User.objects.filter(pk=pk, is_active=True).afirst()
+
+    autenticacion = JWTAuthentication()
+    encabezado = autenticacion.get_header(request)
+    token = autenticacion.get_raw_token(encabezado) if encabezado else None
+    if not token:
+        return None
+    try:
+        validado = autenticacion.get_validated_token(token)
+        return await sync_to_async(autenticacion.get_user)(validado)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return None
+
+
+async def _stream_notificaciones(usuario_id, ultimo_id):
+    pubsub = get_pubsub()
+    # Suscribirse antes de reenviar las perdidas para no dejar huecos
+    suscripcion = pubsub.suscribir(canal_usuario(usuario_id))
+    try:
+        yield "retry: 5000\n\n"
+        if ultimo_id:
+            for mensaje in await sync_to_async(_notificaciones_perdidas)(usuario_id, ultimo_id):
+                yield _evento_sse(mensaje)
+        while True:
+            try:
+                mensaje = await suscripcion.obtener(NOTIFICATIONS_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            yield _evento_sse(mensaje)
+    finally:
+        pubsub.cancelar(suscripcion)
+
+
+async def notification_stream(request):
+    """
+    Stream Server-Sent Events con las notificaciones nuevas del usuario, para
+    reemplazar el sondeo de la lista y las estadísticas. Requiere servir la
+    aplicación por ASGI (tickethelp/asgi.py).
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Método no permitido.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    usuario = await _usuario_del_stream(request)
+    if usuario is None:
+        return JsonResponse(
+            {'detail': 'Las credenciales de autenticación no se proveyeron o son inválidas.'},
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+
+    ultimo_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    try:
+        ultimo_id = int(ultimo_id) if ultimo_id else None
+    except ValueError:
+        ultimo_id = None
+
+    response = StreamingHttpResponse(
+        _stream_notificaciones(usuario.pk, ultimo_id), content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def notification_wait(request):
+    """
+    Long polling: responde en cuanto el usuario tiene notificaciones con id
+    mayor que `since`, o con una lista vacía al cumplirse `timeout` segundos
+    (máximo NOTIFICATIONS_WAIT_TIMEOUT). La espera no consulta la base de
+    datos: se despierta con el mismo pub/sub del stream, y al vencer se
+    consulta una vez más.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Método no permitido.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    usuario = await _usuario_del_stream(request)
+    if usuario is None:
+        return JsonResponse(
+            {'detail': 'Las credenciales de autenticación no se proveyeron o son inválidas.'},
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+
+    try:
+        desde = int(request.GET['since'])
+        timeout = min(float(request.GET.get('timeout', NOTIFICATIONS_WAIT_TIMEOUT)), NOTIFICATIONS_WAIT_TIMEOUT)
+    except (KeyError, ValueError):
+        return JsonResponse(
+            {'detail': 'El parámetro since es obligatorio y, como timeout, debe ser numérico.'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    pubsub = get_pubsub()
+    # Suscribirse antes de consultar para no perder una notificación creada entre medio
+    suscripcion = pubsub.suscribir(canal_usuario(usuario.pk))
+    try:
+        nuevas = await sync_to_async(_notificaciones_perdidas)(usuario.pk, desde)
+        if not nuevas and timeout > 0:
+            try:
+                mensaje = await suscripcion.obtener(timeout)
+            except asyncio.TimeoutError:
+                # Última consulta: otro proceso puede haber confirmado una notificación
+                # durante la espera sin que el pub/sub de este proceso la reciba
+                nuevas = await sync_to_async(_notificaciones_perdidas)(usuario.pk, desde)
+            else:
+                # Se vuelve a consultar para incluir todas las que llegaron juntas
+                nuevas = await sync_to_async(_notificaciones_perdidas)(usuario.pk, desde)
+                if not nuevas and mensaje['id'] > desde:
+                    nuevas = [mensaje]
+    finally:
+        pubsub.cancelar(suscripcion)
+
+    response = JsonResponse({
+        'notifications': nuevas,
+        'last_id': max((n['id'] for n in nuevas), default=desde),
+    })
+    response['Cache-Control'] = 'no-cache'
+    return response
@@ -225,9 +225,50 @@ EMAIL_TIMEOUT = int(os.getenv("EMAIL_TIMEOUT", "30"))
 # Integración SendGrid (opcional, vía API HTTP)
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY", "")
 SENDGRID_FROM_EMAIL = os.getenv("SENDGRID_FROM_EMAIL", DEFAULT_FROM_EMAIL)
+SENDGRID_API_HOST = os.getenv("SENDGRID_API_HOST", "https://api.sendgrid.com")
 
 # Configuración de notificaciones
 NOTIFICATIONS_EMAIL_ENABLED = os.getenv("NOTIFICATIONS_EMAIL_ENABLED", "True") == "True"
+# Segundos que cada proceso mantiene en memoria un tipo de notificación
+NOTIFICATION_TYPE_CACHE_TTL = int(os.getenv("NOTIFICATION_TYPE_CACHE_TTL", "300"))
+# Stream en tiempo real (SSE) y long polling. El pub/sub en memoria solo reparte dentro
+# de un proceso: con PostgreSQL se usa LISTEN/NOTIFY para llegar a todos los workers web
+NOTIFICATIONS_PUBSUB_BACKEND = os.getenv(
+    "NOTIFICATIONS_PUBSUB_BACKEND",
+    "notifications.pubsub.PostgresPubSub"
+    if DATABASES["default"]["ENGINE"].endswith("postgresql")
+    else "notifications.pubsub.MemoryPubSub",
+)
+NOTIFICATIONS_STREAM_HEARTBEAT = int(os.getenv("NOTIFICATIONS_STREAM_HEARTBEAT", "15"))
+# Segundos de validez del ticket (POST notifications/stream/ticket/) para abrir el stream
+NOTIFICATIONS_STREAM_TICKET_TTL = int(os.getenv("NOTIFICATIONS_STREAM_TICKET_TTL", "60"))
+# Segundos máximos que `notifications/wait/` retiene la petición esperando notificaciones
+NOTIFICATIONS_WAIT_TIMEOUT = int(os.getenv("NOTIFICATIONS_WAIT_TIMEOUT", "25"))
+# Segundos que se reutiliza el total de la bandeja de notificaciones (caché de Django)
+NOTIFICATIONS_INBOX_COUNT_TTL = int(os.getenv("NOTIFICATIONS_INBOX_COUNT_TTL", "30"))
+# Retención (`manage.py prune_notifications`): días por defecto para las notificaciones
+# leídas (NotificationType.dias_retencion lo ajusta por tipo), tamaño de lote y
+# carpeta del storage donde se archivan como JSONL comprimido
+NOTIFICATIONS_RETENTION_DAYS = int(os.getenv("NOTIFICATIONS_RETENTION_DAYS", "180"))
+NOTIFICATIONS_RETENTION_BATCH_SIZE = int(os.getenv("NOTIFICATIONS_RETENTION_BATCH_SIZE", "500"))
+NOTIFICATIONS_ARCHIVE_PATH = os.getenv("NOTIFICATIONS_ARCHIVE_PATH", "notifications/archive")
+
+# Cola persistente de correos (procesada por `manage.py run_email_worker`)
+EMAIL_QUEUE_BATCH_SIZE = int(os.getenv("EMAIL_QUEUE_BATCH_SIZE", "20"))
+EMAIL_QUEUE_MAX_ATTEMPTS = int(os.getenv("EMAIL_QUEUE_MAX_ATTEMPTS", "5"))
+EMAIL_QUEUE_LEASE_SECONDS = int(os.getenv("EMAIL_QUEUE_LEASE_SECONDS", "300"))
+EMAIL_QUEUE_RETRY_BASE_SECONDS = int(os.getenv("EMAIL_QUEUE_RETRY_BASE_SECONDS", "30"))
+# Correos al mismo destinatario sobre el mismo ticket dentro de esta ventana se envían como uno solo (0 desactiva)
+EMAIL_COALESCE_WINDOW_SECONDS = int(os.getenv("EMAIL_COALESCE_WINDOW_SECONDS", "60"))
+EMAIL_DIGEST_HOUR = int(os.getenv("EMAIL_DIGEST_HOUR", "8"))
+# Conexiones SMTP reutilizadas por el worker
+EMAIL_SMTP_POOL_SIZE = int(os.getenv("EMAIL_SMTP_POOL_SIZE", "2"))
+EMAIL_SMTP_POOL_IDLE_SECONDS = int(os.getenv("EMAIL_SMTP_POOL_IDLE_SECONDS", "60"))
+# Circuit breaker y cuota por proveedor de correo
+EMAIL_BREAKER_FAILURE_THRESHOLD = int(os.getenv("EMAIL_BREAKER_FAILURE_THRESHOLD", "5"))
+EMAIL_BREAKER_RESET_SECONDS = int(os.getenv("EMAIL_BREAKER_RESET_SECONDS", "60"))
+EMAIL_SENDGRID_RATE_PER_SECOND = float(os.getenv("EMAIL_SENDGRID_RATE_PER_SECOND", "10"))
+EMAIL_SMTP_RATE_PER_SECOND = float(os.getenv("EMAIL_SMTP_RATE_PER_SECOND", "5"))
 
 # -----------------------------
 # SIMPLE JWT CONFIGURATION
@@ -0,0 +1,561 @@
+"""
+Utilidades de almacenamiento para los adjuntos de ticket.
+
+Centraliza el acceso al storage configurado (S3 o sistema de archivos local)
+para que las vistas no tengan que conocer el backend concreto, y la detección
+del tipo real de los archivos subidos.
+"""
+import itertools
+import logging
+import mimetypes
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from datetime import datetime, timezone as dt_timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from tickets.models import TicketAttachment
+
+logger = logging.getLogger(__name__)
+
+try:
+    from botocore.exceptions import BotoCoreError, ClientError
+    from storages.backends.s3 import S3Storage
+    from storages.utils import clean_name
+except ImportError:  # pragma: no cover - django-storages es opcional en local
+    S3Storage = None
+    clean_name = None
+    BotoCoreError = ClientError = None
+
+# Errores al leer un adjunto del storage (archivo local o GetObject de S3)
+ERRORES_LECTURA = (OSError,) + ((ClientError, BotoCoreError) if ClientError is not None else ())
+
+
+# Segundos antes de la expiración en los que una URL firmada deja de reutilizarse
+ATTACHMENT_URL_EXPIRY_MARGIN = getattr(settings, 'ATTACHMENT_URL_EXPIRY_MARGIN', 300)
+# Máximo de URLs firmadas que se mantienen en memoria por proceso
+ATTACHMENT_URL_CACHE_SIZE = getattr(settings, 'ATTACHMENT_URL_CACHE_SIZE', 2048)
+# Bytes iniciales que se leen de cada archivo para detectar su tipo real
+ATTACHMENT_SNIFF_BYTES = getattr(settings, 'ATTACHMENT_SNIFF_BYTES', 4096)
+
+MIME_MS_OFFICE = ('application/msword', 'application/vnd.ms-excel')
+MIME_OOXML = {
+    'word/': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'xl/': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Tamaño de bloque al copiar archivos del storage al ZIP en streaming
+ATTACHMENT_ARCHIVE_CHUNK_SIZE = getattr(settings, 'ATTACHMENT_ARCHIVE_CHUNK_SIZE', 64 * 1024)
+# Archivos por página al reconciliar el storage con la BD (máximo de S3: 1000)
+ATTACHMENT_GC_BATCH_SIZE = getattr(settings, 'ATTACHMENT_GC_BATCH_SIZE', 1000)
+# Hilos para subir archivos al storage en paralelo (subida múltiple)
+ATTACHMENT_UPLOAD_WORKERS = getattr(settings, 'ATTACHMENT_UPLOAD_WORKERS', 4)
+
+_url_cache = OrderedDict()
+_url_cache_lock = threading.Lock()
+
+# Pool persistente: django-storages guarda la conexión boto3 por hilo, así que
+# reutilizar los hilos evita crear una sesión nueva en cada petición.
+_upload_executor = None
+_upload_executor_lock = threading.Lock()
+
+
+def get_attachment_storage():
+    """Storage usado por el campo `archivo` de TicketAttachment."""
+    return TicketAttachment._meta.get_field('archivo').storage
+
+
+def _es_storage_s3(storage):
+    return S3Storage is not None and isinstance(storage, S3Storage)
+
+
+def _url_cacheada(key):
+    with _url_cache_lock:
+        entrada = _url_cache.get(key)
+        if entrada is None:
+            return None
+        url, valida_hasta = entrada
+        if valida_hasta <= time.monotonic():
+            del _url_cache[key]
+            return None
+        _url_cache.move_to_end(key)
+        return url
+
+
+def _guardar_url(key, url, ttl):
+    if ttl <= 0:
+        return
+    with _url_cache_lock:
+        _url_cache[key] = (url, time.monotonic() + ttl)
+        _url_cache.move_to_end(key)
+        while len(_url_cache) > ATTACHMENT_URL_CACHE_SIZE:
+            _url_cache.popitem(last=False)
+
+
+def limpiar_cache_urls():
+    """Vacía la caché de URLs firmadas (útil en pruebas)."""
+    with _url_cache_lock:
+        _url_cache.clear()
+
+
+def _firmar_urls_s3(storage, nombres):
+    """
+    Firma todas las URLs con un único cliente boto3 y reutiliza las firmas
+    vigentes. La firma s3v4 es local (HMAC), así que el coste está en crear el
+    cliente y en recalcular la firma; ambos se evitan aquí.
+    """
+    if storage.custom_domain or not storage.querystring_auth:
+        # Sin firma: storage.url() solo construye la cadena
+        return {nombre: storage.url(nombre) for nombre in nombres}
+
+    expire = storage.querystring_expire
+    ttl = expire - ATTACHMENT_URL_EXPIRY_MARGIN
+    client = None
+    bucket_name = storage.bucket_name
+    urls = {}
+
+    for nombre in nombres:
+        key = storage._normalize_name(clean_name(nombre))
+        cache_key = (bucket_name, key)
+        url = _url_cacheada(cache_key)
+        if url is None:
+            if client is None:
+                client = storage.bucket.meta.client
+            url = client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': bucket_name, 'Key': key},
+                ExpiresIn=expire,
+            )
+            _guardar_url(cache_key, url, ttl)
+        urls[nombre] = url
+    return urls
+
+
+def generar_urls_adjuntos(adjuntos, request=None):
+    """
+    Genera las URLs de descarga de una lista de adjuntos en un solo paso.
+    Retorna un diccionario {pk_adjunto: url}.
+    """
+    storage = get_attachment_storage()
+    nombres = [a.archivo.name for a in adjuntos if a.archivo]
+
+    if _es_storage_s3(storage):
+        por_nombre = _firmar_urls_s3(storage, nombres)
+    else:
+        por_nombre = {nombre: storage.url(nombre) for nombre in nombres}
+
+    urls = {}
+    for adjunto in adjuntos:
+        url = por_nombre.get(adjunto.archivo.name) if adjunto.archivo else None
+        if url and request is not None:
+            url = request.build_absolute_uri(url)
+        urls[adjunto.pk] = url
+    return urls
+
+
+# =============================================================================
+# Guardado concurrente
+# =============================================================================
+
+def _get_upload_executor():
+    global _upload_executor
+    with _upload_executor_lock:
+        if _upload_executor is None:
+            _upload_executor = ThreadPoolExecutor(
+                max_workers=ATTACHMENT_UPLOAD_WORKERS,
+                thread_name_prefix='attachment-upload',
+            )
+        return _upload_executor
+
+
+def guardar_archivos(adjuntos):
+    """
+    Escribe en el storage los archivos de varios TicketAttachment (sin guardar
+    en BD) usando el pool de hilos. Cada adjunto debe tener `ticket` y
+    `archivo` asignados; al terminar `archivo.name` contiene la ruta final.
+
+    Retorna una lista paralela a `adjuntos` con None (éxito) o la excepción.
+    """
+    field = TicketAttachment._meta.get_field('archivo')
+    storage = field.storage
+
+    def _guardar(adjunto):
+        archivo = adjunto.archivo.file
+        nombre = field.generate_filename(adjunto, archivo.name)
+        adjunto.archivo.name = storage.save(nombre, archivo, max_length=field.max_length)
+        adjunto.archivo._committed = True
+
+    def _intentar(adjunto):
+        try:
+            _guardar(adjunto)
+        except Exception as e:
+            return e
+        return None
+
+    if len(adjuntos) <= 1:
+        return [_intentar(adjunto) for adjunto in adjuntos]
+    return list(_get_upload_executor().map(_intentar, adjuntos))
+
+
+def eliminar_archivos(nombres):
+    """Elimina archivos del storage sin propagar errores (limpieza best-effort)."""
+    storage = get_attachment_storage()
+    for nombre in nombres:
+        try:
+            storage.delete(nombre)
+        except Exception as e:
+            logger.warning(f"No se pudo eliminar el archivo huérfano {nombre}: {e}")
+
+
+# =============================================================================
+# Descarga en ZIP (streaming)
+# =============================================================================
+
+# Formatos ya comprimidos: recomprimirlos solo gasta CPU
+MIME_SIN_COMPRESION = {
+    'image/jpeg', 'image/png', 'image/gif', 'image/webp',
+    *MIME_OOXML.values(),
+}
+
+
+class _ZipStream:
+    """
+    Destino de escritura para zipfile que no es seekable: zipfile escribe los
+    tamaños en descriptores de datos y el generador entrega los bytes a medida
+    que se producen, sin archivo temporal.
+    """
+
+    def __init__(self):
+        self._partes = []
+
+    def write(self, data):
+        self._partes.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def extraer(self):
+        data = b''.join(self._partes)
+        self._partes.clear()
+        return data
+
+
+def _nombre_en_zip(nombre, usados):
+    """Evita entradas duplicadas cuando dos adjuntos tienen el mismo nombre."""
+    nombre = os.path.basename(nombre or '') or 'archivo'
+    base, ext = os.path.splitext(nombre)
+    candidato = nombre
+    i = 1
+    while candidato.lower() in usados:
+        candidato = f"{base} ({i}){ext}"
+        i += 1
+    usados.add(candidato.lower())
+    return candidato
+
+
+def _leer_por_bloques(storage, nombre, chunk_size):
+    """
+    Iterador de bloques de un archivo del storage. En S3 se recorre el cuerpo
+    de GetObject: storage.open() devuelve un S3File que descarga el objeto
+    completo a un buffer en memoria antes de la primera lectura.
+    """
+    if _es_storage_s3(storage):
+        cuerpo = storage.bucket.Object(storage._normalize_name(clean_name(nombre))).get()['Body']
+        try:
+            yield from cuerpo.iter_chunks(chunk_size)
+        finally:
+            cuerpo.close()
+        return
+
+    with storage.open(nombre, 'rb') as origen:
+        while True:
+            bloque = origen.read(chunk_size)
+            if not bloque:
+                break
+            yield bloque
+
+
+def generar_zip_adjuntos(adjuntos, chunk_size=None):
+    """
+    Generador que produce un ZIP con los archivos de `adjuntos`, leyendo cada
+    uno del storage por bloques. La memoria usada no depende del tamaño total.
+    """
+    chunk_size = chunk_size or ATTACHMENT_ARCHIVE_CHUNK_SIZE
+    storage = get_attachment_storage()
+    destino = _ZipStream()
+    usados = set()
+
+    with zipfile.ZipFile(destino, mode='w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for adjunto in adjuntos:
+            # Se lee el primer bloque antes de escribir la cabecera de la entrada:
+            # en S3 un objeto inexistente falla recién al pedirlo, y hacerlo con la
+            # entrada abierta dejaría el ZIP enviado corrupto
+            bloques = _leer_por_bloques(storage, adjunto.archivo.name, chunk_size)
+            try:
+                primero = next(bloques, b'')
+            except ERRORES_LECTURA as e:
+                logger.warning(f"Adjunto #{adjunto.pk} no disponible en el storage: {e}")
+                continue
+
+            fecha = timezone.localtime(adjunto.creado_en) if adjunto.creado_en else timezone.localtime()
+            info = zipfile.ZipInfo(_nombre_en_zip(adjunto.nombre_original, usados), date_time=fecha.timetuple()[:6])
+            info.compress_type = (
+                zipfile.ZIP_STORED if adjunto.tipo_mime in MIME_SIN_COMPRESION else zipfile.ZIP_DEFLATED
+            )
+            info.file_size = adjunto.tamano_bytes or 0
+
+            with zf.open(info, 'w') as entrada:
+                for bloque in itertools.chain((primero,), bloques):
+                    entrada.write(bloque)
+                    data = destino.extraer()
+                    if data:
+                        yield data
+            data = destino.extraer()
+            if data:
+                yield data
+
+    # Directorio central del ZIP
+    data = destino.extraer()
+    if data:
+        yield data
+
+
+async def generar_zip_adjuntos_async(adjuntos, chunk_size=None):
+    """
+    Versión asíncrona de `generar_zip_adjuntos` para servir el ZIP bajo ASGI:
+    Django consume un iterador síncrono completo (en memoria) antes de enviar
+    la respuesta. Cada bloque se produce en un hilo, porque leer del storage
+    y comprimir bloquean.
+    """
+    bloques = generar_zip_adjuntos(adjuntos, chunk_size)
+    siguiente = sync_to_async(next, thread_sensitive=False)
+    fin = object()
+    try:
+        while True:
+            data = await siguiente(bloques, fin)
+            if data is fin:
+                break
+            yield data
+    finally:
+        # Cierra el archivo o cuerpo de S3 en lectura si el cliente se desconecta
+        await sync_to_async(bloques.close, thread_sensitive=False)()
+
+
+# =============================================================================
+# Recolección de archivos huérfanos
+# =============================================================================
+
+ATTACHMENTS_PREFIX = 'tickets/'
+
+
+def _es_ruta_de_adjunto(nombre):
+    # tickets/<ticket_id>/attachments/<archivo>
+    partes = nombre.split('/')
+    return len(partes) >= 4 and partes[0] == 'tickets' and partes[2] == 'attachments'
+
+
+def _listar_s3(storage, batch_size):
+    client = storage.bucket.meta.client
+    location = storage.location.strip('/')
+    prefijo = f"{location}/{ATTACHMENTS_PREFIX}" if location else ATTACHMENTS_PREFIX
+    paginator = client.get_paginator('list_objects_v2')
+    paginas = paginator.paginate(
+        Bucket=storage.bucket_name,
+        Prefix=prefijo,
+        PaginationConfig={'PageSize': min(batch_size, 1000)},
+    )
+    for pagina in paginas:
+        lote = []
+        for obj in pagina.get('Contents', []):
+            nombre = obj['Key'][len(location) + 1:] if location else obj['Key']
+            lote.append((nombre, obj['Size'], obj['LastModified']))
+        if lote:
+            yield lote
+
+
+def _listar_local(storage, batch_size):
+    raiz = storage.path('')
+    inicio = os.path.join(raiz, ATTACHMENTS_PREFIX)
+    if not os.path.isdir(inicio):
+        return
+    pendientes = [inicio]
+    lote = []
+    while pendientes:
+        with os.scandir(pendientes.pop()) as entradas:
+            for entrada in entradas:
+                if entrada.is_dir(follow_symlinks=False):
+                    pendientes.append(entrada.path)
+                elif entrada.is_file(follow_symlinks=False):
+                    info = entrada.stat(follow_symlinks=False)
+                    nombre = os.path.relpath(entrada.path, raiz).replace(os.sep, '/')
+                    modificado = datetime.fromtimestamp(info.st_mtime, tz=dt_timezone.utc)
+                    lote.append((nombre, info.st_size, modificado))
+                    if len(lote) >= batch_size:
+                        yield lote
+                        lote = []
+    if lote:
+        yield lote
+
+
+def listar_archivos_adjuntos(batch_size=None):
+    """
+    Recorre los archivos bajo tickets/ en el storage por páginas.
+    Cada página es una lista de tuplas (nombre, tamaño_bytes, fecha_modificación).
+    """
+    batch_size = batch_size or ATTACHMENT_GC_BATCH_SIZE
+    storage = get_attachment_storage()
+    if _es_storage_s3(storage):
+        return _listar_s3(storage, batch_size)
+    return _listar_local(storage, batch_size)
+
+
+def eliminar_archivos_en_lote(nombres):
+    """
+    Elimina archivos usando la API de borrado en lote si el storage la ofrece.
+    Retorna la lista de nombres que no se pudieron eliminar.
+    """
+    storage = get_attachment_storage()
+    fallidos = []
+    if _es_storage_s3(storage):
+        client = storage.bucket.meta.client
+        for i in range(0, len(nombres), 1000):
+            bloque = nombres[i:i + 1000]
+            keys = {storage._normalize_name(clean_name(n)): n for n in bloque}
+            respuesta = client.delete_objects(
+                Bucket=storage.bucket_name,
+                Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True},
+            )
+            for error in respuesta.get('Errors', []):
+                logger.warning(f"No se pudo eliminar {error.get('Key')}: {error.get('Message')}")
+                fallidos.append(keys.get(error.get('Key'), error.get('Key')))
+        return fallidos
+
+    for nombre in nombres:
+        try:
+            os.remove(storage.path(nombre))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"No se pudo eliminar {nombre}: {e}")
+            fallidos.append(nombre)
+    return fallidos
+
+
+def recolectar_adjuntos_huerfanos(edad_minima, dry_run=False, batch_size=None):
+    """
+    Compara el storage con los TicketAttachment existentes y elimina los
+    archivos sin registro. Los archivos más recientes que `edad_minima`
+    (timedelta) se ignoran para no borrar subidas en curso.
+    """
+    limite = timezone.now() - edad_minima
+    resumen = {'revisados': 0, 'huerfanos': 0, 'eliminados': 0, 'bytes_liberados': 0, 'fallidos': 0}
+
+    for lote in listar_archivos_adjuntos(batch_size):
+        resumen['revisados'] += len(lote)
+        candidatos = {
+            nombre: tamano for nombre, tamano, modificado in lote
+            if _es_ruta_de_adjunto(nombre) and modificado <= limite
+        }
+        if not candidatos:
+            continue
+        existentes = set(
+            TicketAttachment.objects.filter(archivo__in=list(candidatos)).values_list('archivo', flat=True)
+        )
+        huerfanos = [nombre for nombre in candidatos if nombre not in existentes]
+        resumen['huerfanos'] += len(huerfanos)
+        if not huerfanos or dry_run:
+            continue
+
+        fallidos = set(eliminar_archivos_en_lote(huerfanos))
+        for nombre in huerfanos:
+            if nombre in fallidos:
+                resumen['fallidos'] += 1
+            else:
+                resumen['eliminados'] += 1
+                resumen['bytes_liberados'] += candidatos[nombre]
+    return resumen
+
+
+# =============================================================================
+# Detección del tipo real (magic bytes)
+# =============================================================================
+
+def _es_texto_plano(muestra):
+    if b'\x00' in muestra:
+        return False
+    try:
+        muestra.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # La muestra puede cortar un carácter multibyte al final
+        if e.start < len(muestra) - 3:
+            try:
+                muestra.decode('cp1252')
+            except UnicodeDecodeError:
+                return False
+    control = sum(1 for b in muestra if b < 32 and b not in (9, 10, 12, 13))
+    return control <= len(muestra) // 100
+
+
+def _candidatos_por_firma(muestra):
+    """
+    Retorna la lista de tipos MIME compatibles con la cabecera del archivo.
+    Algunos formatos contenedores (OLE2, ZIP) corresponden a varios tipos.
+    """
+    if muestra.startswith(b'\xff\xd8\xff'):
+        return ['image/jpeg']
+    if muestra.startswith(b'\x89PNG\r\n\x1a\n'):
+        return ['image/png']
+    if muestra[:6] in (b'GIF87a', b'GIF89a'):
+        return ['image/gif']
+    if muestra[:4] == b'RIFF' and muestra[8:12] == b'WEBP':
+        return ['image/webp']
+    if muestra.startswith(b'%PDF-'):
+        return ['application/pdf']
+    if muestra.startswith(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
+        return list(MIME_MS_OFFICE)
+    if muestra.startswith(b'PK\x03\x04'):
+        for prefijo, mime in MIME_OOXML.items():
+            if prefijo.encode() in muestra:
+                return [mime]
+        return list(MIME_OOXML.values())
+    if muestra and _es_texto_plano(muestra):
+        return ['text/plain']
+    return []
+
+
+def leer_cabecera(file, tamano=None):
+    """Lee solo los primeros bytes del archivo y deja el puntero al inicio."""
+    tamano = tamano or ATTACHMENT_SNIFF_BYTES
+    file.seek(0)
+    muestra = file.read(tamano)
+    file.seek(0)
+    return muestra or b''
+
+
+def detectar_tipo_mime(file, declarado=''):
+    """
+    Determina el tipo MIME real del archivo a partir de sus primeros bytes.
+
+    Si la firma admite varios tipos (p. ej. .doc/.xls), se usa el declarado por
+    el cliente o, en su defecto, la extensión. Retorna None si el contenido no
+    corresponde a ningún tipo conocido o contradice al tipo declarado.
+    """
+    candidatos = _candidatos_por_firma(leer_cabecera(file))
+    if not candidatos:
+        return None
+
+    declarado = (declarado or '').split(';')[0].strip().lower()
+    if declarado and declarado != 'application/octet-stream':
+        return declarado if declarado in candidatos else None
+
+    if len(candidatos) == 1:
+        return candidatos[0]
+    por_extension, _ = mimetypes.guess_type(getattr(file, 'name', '') or '')
+    return por_extension if por_extension in candidatos else None
@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from tickets.attachments import recolectar_adjuntos_huerfanos
+
+
+def _formatear_bytes(total):
+    valor = float(total)
+    for unidad in ('B', 'KB', 'MB', 'GB'):
+        if valor < 1024 or unidad == 'GB':
+            break
+        valor /= 1024
+    return f"{valor:.1f} {unidad}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Elimina del storage (S3 o MEDIA_ROOT) los archivos bajo tickets/<id>/attachments/ "
+        "que no tienen un TicketAttachment asociado. Pensado para ejecutarse periódicamente (cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age-hours', type=float, default=24,
+            help='Solo considera archivos con al menos esta antigüedad (evita borrar subidas en curso).',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Archivos por página al recorrer el storage (por defecto ATTACHMENT_GC_BATCH_SIZE).',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Solo reporta los huérfanos, sin eliminarlos.',
+        )
+
+    def handle(self, *args, **options):
+        resumen = recolectar_adjuntos_huerfanos(
+            edad_minima=timedelta(hours=options['min_age_hours']),
+            dry_run=options['dry_run'],
+            batch_size=options['batch_size'],
+        )
+
+        if options['dry_run']:
+            self.stdout.write(
+                f"[dry-run] Revisados: {resumen['revisados']}, huérfanos encontrados: {resumen['huerfanos']}"
+            )
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Revisados: {resumen['revisados']}, huérfanos: {resumen['huerfanos']}, "
+            f"eliminados: {resumen['eliminados']}, "
+            f"espacio liberado: {_formatear_bytes(resumen['bytes_liberados'])} ({resumen['bytes_liberados']} bytes)"
+        ))
+        if resumen['fallidos']:
+            self.stdout.write(self.style.WARNING(f"No se pudieron eliminar {resumen['fallidos']} archivos."))
@@ -131,9 +131,9 @@ class TicketHistory(models.Model):
         return f"Historial #{self.id} - Ticket #{self.ticket.id} - {self.accion} ({self.fecha})"
     
     @staticmethod
-    def crear_entrada_historial(ticket, accion, realizado_por, estado_anterior=None, tecnico_anterior=None, datos_ticket=None):
+    def construir_entrada_historial(ticket, accion, realizado_por, estado_anterior=None, tecnico_anterior=None, datos_ticket=None):
         """
-        Método helper para crear entradas en el historial.
+        Construye (sin guardar) una entrada de historial. Útil para bulk_create.
         """
         # Preparar datos del ticket si se proporcionan
         if datos_ticket is None:
@@ -145,7 +145,7 @@ class TicketHistory(models.Model):
                 'cliente': ticket.cliente.document if ticket.cliente else None,
             }
         
-        return TicketHistory.objects.create(
+        return TicketHistory(
             ticket=ticket,
             estado=ticket.estado.nombre if ticket.estado else 'Sin estado',
             estado_anterior=estado_anterior,
@@ -156,6 +156,17 @@ class TicketHistory(models.Model):
             datos_ticket=datos_ticket
         )
 
+    @staticmethod
+    def crear_entrada_historial(ticket, accion, realizado_por, estado_anterior=None, tecnico_anterior=None, datos_ticket=None):
+        """
+        Método helper para crear entradas en el historial.
+        """
+        entrada = TicketHistory.construir_entrada_historial(
+            ticket, accion, realizado_por, estado_anterior, tecnico_anterior, datos_ticket
+        )
+        entrada.save()
+        return entrada
+
 
 # =============================================================================
 # HU13B - Historial: Signal para rastrear cambios previos
@@ -172,12 +183,15 @@ def store_previous_values(sender, instance, **kwargs):
             old_instance = Ticket.objects.get(pk=instance.pk)
             instance._old_estado = old_instance.estado
             instance._old_tecnico = old_instance.tecnico
+            instance._old_actualizado_en = old_instance.actualizado_en
         except Ticket.DoesNotExist:
             instance._old_estado = None
             instance._old_tecnico = None
+            instance._old_actualizado_en = None
     else:
         instance._old_estado = None
         instance._old_tecnico = None
+        instance._old_actualizado_en = None
 
 
 # =============================================================================
@@ -1,10 +1,12 @@
 from rest_framework import serializers
+from django.db import transaction
 from django.db.models import Count, Max
 from django.utils import timezone
 from django.conf import settings as django_settings
 from users.models import User
 from tickets.models import Ticket, Estado, StateChangeRequest, TicketAttachment
 from tickets.models import TicketHistory
+from tickets.attachments import detectar_tipo_mime, guardar_archivos, eliminar_archivos
 
 class TicketSerializer(serializers.ModelSerializer):
 
@@ -301,7 +303,11 @@ class TicketTimelineSerializer(serializers.Serializer):
 # =============================================================================
 
 class TicketAttachmentListSerializer(serializers.ModelSerializer):
-    """Serializer para listar adjuntos. Solo devuelve nombre original y URL."""
+    """
+    Serializer para listar adjuntos. Solo devuelve nombre original y URL.
+    Si el contexto trae `urls` ({pk: url}, ver tickets.attachments) las usa en
+    lugar de firmar cada URL por separado.
+    """
     url = serializers.SerializerMethodField()
 
     class Meta:
@@ -309,6 +315,9 @@ class TicketAttachmentListSerializer(serializers.ModelSerializer):
         fields = ['nombre_original', 'url']
 
     def get_url(self, obj):
+        urls = self.context.get('urls')
+        if urls is not None and obj.pk in urls:
+            return urls[obj.pk]
         request = self.context.get('request')
         if obj.archivo and request:
             return request.build_absolute_uri(obj.archivo.url)
@@ -324,37 +333,57 @@ class TicketAttachmentCreateResponseSerializer(serializers.ModelSerializer):
         fields = ['creado_en', 'url']
 
     def get_url(self, obj):
+        urls = self.context.get('urls')
+        if urls is not None and obj.pk in urls:
+            return urls[obj.pk]
         request = self.context.get('request')
         if obj.archivo and request:
             return request.build_absolute_uri(obj.archivo.url)
         return obj.archivo.url if obj.archivo else None
 
 
-class TicketAttachmentUploadSerializer(serializers.Serializer):
-    """Serializer de ESCRITURA. Valida tamaño y tipo MIME antes de crear el adjunto."""
-    archivo = serializers.FileField(required=True)
+def validar_archivo_adjunto(file):
+    """
+    Valida tamaño y tipo de un archivo adjunto. El tipo se determina por el
+    contenido (primeros bytes), no por el `content_type` enviado por el cliente.
+    """
+    max_size = getattr(django_settings, 'MAX_UPLOAD_SIZE', 10 * 1024 * 1024)
+    allowed_mimes = getattr(
+        django_settings,
+        'ALLOWED_UPLOAD_MIME_TYPES',
+        ['image/jpeg', 'image/png', 'application/pdf'],
+    )
 
-    def validate_archivo(self, file):
-        max_size = getattr(django_settings, 'MAX_UPLOAD_SIZE', 10 * 1024 * 1024)
-        allowed_mimes = getattr(
-            django_settings,
-            'ALLOWED_UPLOAD_MIME_TYPES',
-            ['image/jpeg', 'image/png', 'application/pdf'],
+    if file.size > max_size:
+        raise serializers.ValidationError(
+            f"El archivo es demasiado grande. Tamaño máximo permitido: {max_size // (1024 * 1024)} MB."
         )
 
-        if file.size > max_size:
-            raise serializers.ValidationError(
-                f"El archivo es demasiado grande. Tamaño máximo permitido: {max_size // (1024 * 1024)} MB."
-            )
+    content_type = getattr(file, 'content_type', '')
+    if content_type and content_type not in allowed_mimes and content_type != 'application/octet-stream':
+        raise serializers.ValidationError(
+            f"Tipo de archivo no permitido: {content_type}. "
+            f"Tipos permitidos: {', '.join(allowed_mimes)}."
+        )
 
-        content_type = getattr(file, 'content_type', '')
-        if content_type and content_type not in allowed_mimes:
-            raise serializers.ValidationError(
-                f"Tipo de archivo no permitido: {content_type}. "
-                f"Tipos permitidos: {', '.join(allowed_mimes)}."
-            )
+    tipo_real = detectar_tipo_mime(file, content_type)
+    if not tipo_real or tipo_real not in allowed_mimes:
+        raise serializers.ValidationError(
+            "El contenido del archivo no corresponde a un tipo permitido"
+            + (f" ni al tipo declarado ({content_type})." if content_type else ".")
+        )
+
+    # El tipo detectado es el que se guarda y se envía al storage
+    file.content_type = tipo_real
+    return file
+
+
+class TicketAttachmentUploadSerializer(serializers.Serializer):
+    """Serializer de ESCRITURA. Valida tamaño y tipo MIME antes de crear el adjunto."""
+    archivo = serializers.FileField(required=True)
 
-        return file
+    def validate_archivo(self, file):
+        return validar_archivo_adjunto(file)
 
     def create(self, validated_data):
         file = validated_data['archivo']
@@ -370,3 +399,68 @@ class TicketAttachmentUploadSerializer(serializers.Serializer):
             tamano_bytes=file.size,
         )
         return adjunto
+
+
+class TicketAttachmentBulkUploadSerializer(serializers.Serializer):
+    """
+    Serializer de ESCRITURA para subir varios archivos en una sola petición.
+    Cada archivo se valida por separado: los inválidos se reportan en el
+    resultado sin impedir que se guarden los demás.
+    """
+    archivos = serializers.ListField(
+        child=serializers.FileField(),
+        allow_empty=False,
+        max_length=getattr(django_settings, 'ATTACHMENT_BULK_MAX_FILES', 25),
+    )
+
+    def create(self, validated_data):
+        ticket = self.context['ticket']
+        subido_por = self.context['subido_por']
+
+        resultados = []
+        pendientes = []
+        for file in validated_data['archivos']:
+            resultado = {'nombre_original': file.name, 'adjunto': None, 'errores': []}
+            resultados.append(resultado)
+            try:
+                validar_archivo_adjunto(file)
+            except serializers.ValidationError as e:
+                resultado['errores'] = [str(detalle) for detalle in e.detail]
+                continue
+            adjunto = TicketAttachment(
+                ticket=ticket,
+                subido_por=subido_por,
+                archivo=file,
+                nombre_original=file.name,
+                tipo_mime=file.content_type,
+                tamano_bytes=file.size,
+            )
+            pendientes.append((resultado, adjunto))
+
+        # Subida en paralelo al storage; la BD se escribe después en lote
+        errores = guardar_archivos([adjunto for _, adjunto in pendientes])
+        guardados = []
+        for (resultado, adjunto), error in zip(pendientes, errores):
+            if error is not None:
+                resultado['errores'] = [f"No se pudo guardar el archivo: {error}"]
+            else:
+                resultado['adjunto'] = adjunto
+                guardados.append(adjunto)
+
+        if guardados:
+            try:
+                with transaction.atomic():
+                    TicketAttachment.objects.bulk_create(guardados)
+                    TicketHistory.objects.bulk_create([
+                        TicketHistory.construir_entrada_historial(
+                            ticket=ticket,
+                            accion=f"Archivo adjunto agregado: '{adjunto.nombre_original}'",
+                            realizado_por=subido_por,
+                        )
+                        for adjunto in guardados
+                    ])
+            except Exception:
+                eliminar_archivos([adjunto.archivo.name for adjunto in guardados])
+                raise
+
+        return resultados
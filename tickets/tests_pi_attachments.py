@@ -0,0 +1,305 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.models import User
+from tickets.models import Ticket, Estado, TicketAttachment
+from tickets import attachments
+
+
+class TicketAttachmentsTestMixin:
+    """Crea usuarios, ticket y un MEDIA_ROOT temporal para las pruebas de adjuntos."""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.media_root)
+        self.override.enable()
+        attachments.limpiar_cache_urls()
+
+        self.admin = User.objects.create_user(
+            email='admin_adj@test.com', password='Password123!', document='4100', role=User.Role.ADMIN, is_active=True
+        )
+        self.tech = User.objects.create_user(
+            email='tech_adj@test.com', password='Password123!', document='4200', role=User.Role.TECH, is_active=True
+        )
+        self.client_user = User.objects.create_user(
+            email='client_adj@test.com', password='Password123!', document='4300', role=User.Role.CLIENT, is_active=True
+        )
+        self.e_open, _ = Estado.objects.get_or_create(codigo='open', defaults={'nombre': 'Abierto', 'es_final': False})
+        self.ticket = Ticket.objects.create(
+            cliente=self.client_user,
+            administrador=self.admin,
+            tecnico=self.tech,
+            estado=self.e_open,
+            titulo="Impresora",
+            descripcion="No imprime",
+        )
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def crear_adjunto(self, nombre, contenido=b'%PDF-1.4 prueba'):
+        adjunto = TicketAttachment(
+            ticket=self.ticket,
+            subido_por=self.admin,
+            nombre_original=nombre,
+            tipo_mime='application/pdf',
+            tamano_bytes=len(contenido),
+        )
+        adjunto.archivo.save(nombre, ContentFile(contenido), save=True)
+        return adjunto
+
+    async def acrear_adjunto(self, nombre, contenido=b'%PDF-1.4 prueba'):
+        return await sync_to_async(self.crear_adjunto)(nombre, contenido)
+
+
+class TicketAttachmentListTests(TicketAttachmentsTestMixin, APITestCase):
+
+    def test_list_attachments_constant_queries(self):
+        for i in range(5):
+            self.crear_adjunto(f"doc_{i}.pdf")
+        self.client.force_authenticate(user=self.client_user)
+        url = reverse('ticket-attachments', args=[self.ticket.pk])
+
+        with CaptureQueriesContext(connection) as ctx_pocos:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_adjuntos'], 5)
+        self.assertTrue(all(a['url'].startswith('http://testserver/') for a in response.data['adjuntos']))
+
+        for i in range(5, 20):
+            self.crear_adjunto(f"doc_{i}.pdf")
+        with CaptureQueriesContext(connection) as ctx_muchos:
+            response = self.client.get(url)
+        self.assertEqual(response.data['total_adjuntos'], 20)
+        self.assertEqual(len(ctx_pocos.captured_queries), len(ctx_muchos.captured_queries))
+
+    def test_signed_urls_are_cached_until_near_expiry(self):
+        adjuntos = [mock.Mock(pk=i) for i in range(3)]
+        for i, adjunto in enumerate(adjuntos):
+            adjunto.archivo.name = f"tickets/1/attachments/f{i}.jpg"
+
+        storage = mock.Mock(custom_domain=None, querystring_auth=True, querystring_expire=3600, bucket_name='bucket')
+        storage._normalize_name.side_effect = lambda name: name
+        client = storage.bucket.meta.client
+        client.generate_presigned_url.side_effect = lambda op, Params, ExpiresIn: f"https://s3/{Params['Key']}?sig"
+
+        with mock.patch.object(attachments, 'get_attachment_storage', return_value=storage), \
+                mock.patch.object(attachments, '_es_storage_s3', return_value=True):
+            primera = attachments.generar_urls_adjuntos(adjuntos)
+            segunda = attachments.generar_urls_adjuntos(adjuntos)
+
+        self.assertEqual(primera, segunda)
+        self.assertEqual(client.generate_presigned_url.call_count, 3)
+
+
+class TicketAttachmentSniffingTests(TicketAttachmentsTestMixin, APITestCase):
+    PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 32
+
+    def subir(self, archivo):
+        self.client.force_authenticate(user=self.admin)
+        url = reverse('ticket-attachments', args=[self.ticket.pk])
+        return self.client.post(url, {'archivo': archivo}, format='multipart')
+
+    def test_spoofed_content_type_is_rejected(self):
+        archivo = SimpleUploadedFile("foto.jpg", b"MZ\x90\x00\x03binario", content_type="image/jpeg")
+        response = self.subir(archivo)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('archivo', response.data)
+        self.assertFalse(TicketAttachment.objects.exists())
+
+    def test_mismatched_allowed_type_is_rejected(self):
+        archivo = SimpleUploadedFile("foto.pdf", self.PNG, content_type="application/pdf")
+        response = self.subir(archivo)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_detected_type_is_stored(self):
+        archivo = SimpleUploadedFile("foto.png", self.PNG, content_type="application/octet-stream")
+        response = self.subir(archivo)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(TicketAttachment.objects.get().tipo_mime, 'image/png')
+
+    def test_only_header_is_read(self):
+        archivo = mock.Mock(wraps=io.BytesIO(b"a" * (attachments.ATTACHMENT_SNIFF_BYTES * 4)))
+        archivo.name = "notas.txt"
+        self.assertEqual(attachments.detectar_tipo_mime(archivo, 'text/plain'), 'text/plain')
+        archivo.read.assert_called_once_with(attachments.ATTACHMENT_SNIFF_BYTES)
+        self.assertEqual(archivo.tell(), 0)
+
+
+class TicketAttachmentBulkUploadTests(TicketAttachmentsTestMixin, APITestCase):
+
+    def test_bulk_upload_reports_per_file_results(self):
+        self.client.force_authenticate(user=self.admin)
+        url = reverse('ticket-attachments-bulk', args=[self.ticket.pk])
+        archivos = [
+            SimpleUploadedFile("foto_1.png", TicketAttachmentSniffingTests.PNG, content_type="image/png"),
+            SimpleUploadedFile("informe.pdf", b"%PDF-1.4 informe", content_type="application/pdf"),
+            SimpleUploadedFile("virus.jpg", b"MZ\x90\x00", content_type="image/jpeg"),
+        ]
+        response = self.client.post(url, {'archivos': archivos}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['total_adjuntados'], 2)
+        self.assertEqual(response.data['total_fallidos'], 1)
+        resultados = {r['nombre_original']: r for r in response.data['resultados']}
+        self.assertTrue(resultados['foto_1.png']['adjuntado'])
+        self.assertFalse(resultados['virus.jpg']['adjuntado'])
+        self.assertTrue(resultados['virus.jpg']['errores'])
+        self.assertEqual(TicketAttachment.objects.filter(ticket=self.ticket).count(), 2)
+        self.assertEqual(self.ticket.historial.filter(accion__startswith='Archivo adjunto agregado').count(), 2)
+
+    def test_bulk_upload_requires_admin(self):
+        self.client.force_authenticate(user=self.tech)
+        url = reverse('ticket-attachments-bulk', args=[self.ticket.pk])
+        archivo = SimpleUploadedFile("informe.pdf", b"%PDF-1.4 informe", content_type="application/pdf")
+        response = self.client.post(url, {'archivos': [archivo]}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TicketAttachmentArchiveTests(TicketAttachmentsTestMixin, APITestCase):
+
+    def test_archive_streams_all_attachments(self):
+        self.crear_adjunto("informe.pdf", b"%PDF-1.4 uno")
+        self.crear_adjunto("informe.pdf", b"%PDF-1.4 dos")
+        self.client.force_authenticate(user=self.client_user)
+        url = reverse('ticket-attachments-archive', args=[self.ticket.pk])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+
+        contenido = b''.join(response.streaming_content)
+        with zipfile.ZipFile(io.BytesIO(contenido)) as zf:
+            self.assertEqual(sorted(zf.namelist()), ['informe (1).pdf', 'informe.pdf'])
+            self.assertEqual(
+                sorted(zf.read(n) for n in zf.namelist()),
+                [b"%PDF-1.4 dos", b"%PDF-1.4 uno"],
+            )
+
+    async def test_archive_streams_under_asgi(self):
+        await self.acrear_adjunto("uno.pdf", b"%PDF-1.4 uno")
+        await self.acrear_adjunto("dos.pdf", b"%PDF-1.4 dos")
+        token = RefreshToken.for_user(self.client_user).access_token
+        url = reverse('ticket-attachments-archive', args=[self.ticket.pk])
+
+        with mock.patch.object(attachments, '_leer_por_bloques', wraps=attachments._leer_por_bloques) as lecturas:
+            response = await AsyncClient().get(url, headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # Un iterador asíncrono: Django no lo acumula en memoria antes de enviarlo
+            self.assertTrue(response.is_async)
+
+            partes = []
+            async for parte in response.streaming_content:
+                if not partes:
+                    # El primer bloque sale antes de leer el segundo adjunto
+                    self.assertEqual(lecturas.call_count, 1)
+                partes.append(parte)
+
+        self.assertEqual(lecturas.call_count, 2)
+        self.assertGreater(len(partes), 1)
+        with zipfile.ZipFile(io.BytesIO(b''.join(partes))) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(sorted(zf.namelist()), ['dos.pdf', 'uno.pdf'])
+
+    def test_archive_skips_missing_files(self):
+        faltante = self.crear_adjunto("faltante.pdf", b"%PDF-1.4 borrado")
+        self.crear_adjunto("presente.pdf", b"%PDF-1.4 presente")
+        os.remove(os.path.join(self.media_root, faltante.archivo.name))
+
+        contenido = b''.join(attachments.generar_zip_adjuntos(TicketAttachment.objects.order_by('pk')))
+
+        with zipfile.ZipFile(io.BytesIO(contenido)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ['presente.pdf'])
+
+    def test_archive_streams_s3_body_and_skips_failing_objects(self):
+        from botocore.exceptions import ClientError
+
+        faltante = self.crear_adjunto("faltante.pdf")
+        presente = self.crear_adjunto("presente.pdf")
+        cuerpo = mock.Mock()
+        cuerpo.iter_chunks.return_value = iter([b"%PDF-1.4 ", b"desde s3"])
+
+        def objeto(key):
+            obj = mock.Mock()
+            if key == faltante.archivo.name:
+                obj.get.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+            else:
+                obj.get.return_value = {'Body': cuerpo}
+            return obj
+
+        storage = mock.Mock(_normalize_name=lambda nombre: nombre)
+        storage.bucket.Object.side_effect = objeto
+        with mock.patch.object(attachments, 'get_attachment_storage', return_value=storage), \
+                mock.patch.object(attachments, '_es_storage_s3', return_value=True):
+            contenido = b''.join(attachments.generar_zip_adjuntos([faltante, presente], chunk_size=9))
+
+        storage.open.assert_not_called()
+        cuerpo.iter_chunks.assert_called_once_with(9)
+        cuerpo.close.assert_called_once()
+        with zipfile.ZipFile(io.BytesIO(contenido)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), ['presente.pdf'])
+            self.assertEqual(zf.read('presente.pdf'), b"%PDF-1.4 desde s3")
+
+    def test_archive_uses_read_permissions(self):
+        otro_cliente = User.objects.create_user(
+            email='otro_adj@test.com', password='Password123!', document='4400', role=User.Role.CLIENT, is_active=True
+        )
+        self.client.force_authenticate(user=otro_cliente)
+        url = reverse('ticket-attachments-archive', args=[self.ticket.pk])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class PurgeOrphanAttachmentsTests(TicketAttachmentsTestMixin, APITestCase):
+
+    def escribir_huerfano(self, ruta, contenido, horas):
+        destino = os.path.join(self.media_root, ruta)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        with open(destino, 'wb') as f:
+            f.write(contenido)
+        antiguedad = time.time() - horas * 3600
+        os.utime(destino, (antiguedad, antiguedad))
+        return destino
+
+    def test_purge_removes_only_old_orphans(self):
+        adjunto = self.crear_adjunto("vigente.pdf")
+        vigente = os.path.join(self.media_root, adjunto.archivo.name)
+        os.utime(vigente, (time.time() - 48 * 3600,) * 2)
+        viejo = self.escribir_huerfano("tickets/999/attachments/viejo.pdf", b"x" * 100, horas=48)
+        reciente = self.escribir_huerfano("tickets/999/attachments/reciente.pdf", b"y" * 10, horas=1)
+
+        salida = io.StringIO()
+        call_command('purge_orphan_attachments', '--min-age-hours', '24', '--batch-size', '2', stdout=salida)
+
+        self.assertFalse(os.path.exists(viejo))
+        self.assertTrue(os.path.exists(reciente))
+        self.assertTrue(os.path.exists(vigente))
+        self.assertIn("eliminados: 1", salida.getvalue())
+        self.assertIn("(100 bytes)", salida.getvalue())
+
+    def test_purge_dry_run_keeps_files(self):
+        viejo = self.escribir_huerfano("tickets/999/attachments/viejo.pdf", b"x", horas=48)
+        call_command('purge_orphan_attachments', '--dry-run', stdout=io.StringIO())
+        self.assertTrue(os.path.exists(viejo))
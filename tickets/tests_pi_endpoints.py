@@ -79,7 +79,7 @@ class TicketEndpointsTests(APITestCase):
         url = reverse('ticket-attachments', args=[self.ticket.pk])
         
         # Archivo simulado (PDF)
-        file = SimpleUploadedFile("documento.pdf", b"file_content", content_type="application/pdf")
+        file = SimpleUploadedFile("documento.pdf", b"%PDF-1.4 file_content", content_type="application/pdf")
         
         response = self.client.post(url, {'archivo': file}, format='multipart')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
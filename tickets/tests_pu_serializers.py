@@ -12,7 +12,7 @@ class TicketSerializerPUTests(SimpleTestCase):
     def test_attachment_upload_serializer_valid_file(self):
         """Verificar que un archivo de PDF pequeño pasa la validación (PU)"""
         serializer = TicketAttachmentUploadSerializer()
-        file = SimpleUploadedFile("doc.pdf", b"test content", content_type="application/pdf")
+        file = SimpleUploadedFile("doc.pdf", b"%PDF-1.4 test content", content_type="application/pdf")
         
         # Validar directamente el método de la clase
         validated_file = serializer.validate_archivo(file)
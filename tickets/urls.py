@@ -3,7 +3,7 @@ from tickets.views import (
     TicketAV, EstadoAV, LeastBusyTechnicianAV, ChangeTechnicianAV, 
     ActiveTechniciansAV, StateChangeAV, PendingApprovalsAV, TicketListView, 
     TicketTimelineAV, TestingApprovalAV, TicketHistoryAV, TicketCancelAV,
-    TicketAttachmentAV,
+    TicketAttachmentAV, TicketAttachmentBulkAV, TicketAttachmentArchiveAV,
 )
 
 urlpatterns = [
@@ -50,4 +50,8 @@ urlpatterns = [
     # POST → sube un nuevo archivo adjunto (solo administrador)
     # =============================================================================
     path('tickets/<int:ticket_id>/attachments/', TicketAttachmentAV.as_view(), name="ticket-attachments"),
+    # POST → sube varios archivos en una sola petición (campo `archivos`, solo administrador)
+    path('tickets/<int:ticket_id>/attachments/bulk/', TicketAttachmentBulkAV.as_view(), name="ticket-attachments-bulk"),
+    # GET → descarga todos los adjuntos del ticket en un ZIP (mismos permisos que el listado)
+    path('tickets/<int:ticket_id>/attachments/archive/', TicketAttachmentArchiveAV.as_view(), name="ticket-attachments-archive"),
 ]
\ No newline at end of file
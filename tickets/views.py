@@ -1,12 +1,15 @@
-from rest_framework.generics import ListCreateAPIView, RetrieveAPIView, UpdateAPIView, ListAPIView
+from rest_framework.generics import ListCreateAPIView, RetrieveAPIView, UpdateAPIView, ListAPIView, CreateAPIView
 from rest_framework import status, serializers
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny
 from tickets.permissions import (
     IsAdmin, IsAdminOrTechnician, IsClient, IsTechnician, 
     IsAdminOrTechnicianOrClient, IsAuthenticated, IsTicketOwnerOrAdmin
 )
 from django.shortcuts import get_object_or_404
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from datetime import timedelta
@@ -18,8 +21,10 @@ from tickets.serializers import (
     TicketSerializer, EstadoSerializer, LeastBusyTechnicianSerializer,
     ChangeTechnicianSerializer, ActiveTechnicianSerializer, StateChangeSerializer,
     StateApprovalSerializer, PendingApprovalSerializer,
-    TicketTimelineSerializer, TicketAttachmentListSerializer, TicketAttachmentCreateResponseSerializer, TicketAttachmentUploadSerializer
+    TicketTimelineSerializer, TicketAttachmentListSerializer, TicketAttachmentCreateResponseSerializer, TicketAttachmentUploadSerializer,
+    TicketAttachmentBulkUploadSerializer,
 )
+from tickets.attachments import generar_urls_adjuntos, generar_zip_adjuntos, generar_zip_adjuntos_async
 from notifications.services import NotificationService
 from rest_framework import viewsets, permissions
 from .models import TicketHistory
@@ -283,7 +288,7 @@ class StateChangeAV(UpdateAPIView):
             # Marcar que ya se notificó manualmente para evitar duplicación con el signal
             ticket._notificacion_manual = True
             ticket.estado = to_state
-            ticket.save(update_fields=['estado'])
+            ticket.save(update_fields=['estado', 'actualizado_en'])
             
             # Notificar al cliente sobre el cambio de estado
             # (El signal también lo hará, pero con la bandera evitamos duplicación)
@@ -470,7 +475,7 @@ class TestingApprovalAV(UpdateAPIView):
                 )
             
             ticket.estado = estado_final
-            ticket.save(update_fields=["estado"])
+            ticket.save(update_fields=["estado", "actualizado_en"])
 
             # Registrar cambio en historial
             TicketHistory.crear_entrada_historial(
@@ -534,7 +539,7 @@ class TestingApprovalAV(UpdateAPIView):
         )
         
         ticket.estado = estado_reparacion
-        ticket.save(update_fields=["estado"])
+        ticket.save(update_fields=["estado", "actualizado_en"])
 
         # Registrar cambio en historial
         TicketHistory.crear_entrada_historial(
@@ -929,18 +934,8 @@ class TicketCancelAV(UpdateAPIView):
         }, status=status.HTTP_200_OK)
 
 
-class TicketAttachmentAV(ListCreateAPIView):
-    """
-    GET  /api/tickets/<ticket_id>/attachments/  → Lista los adjuntos del ticket.
-    POST /api/tickets/<ticket_id>/attachments/  → Sube un nuevo archivo adjunto.
-
-    Permisos:
-    - Solo el administrador puede subir archivos (POST).
-    - El cliente dueño, el técnico asignado y el administrador pueden ver la lista (GET).
-    - El ticket no debe estar en estado final para permitir subidas.
-    """
-    permission_classes = [IsAuthenticated]
-    serializer_class = TicketAttachmentUploadSerializer
+class TicketAttachmentAccessMixin:
+    """Reglas de acceso compartidas por los endpoints de adjuntos de un ticket."""
 
     def _get_ticket(self):
         return get_object_or_404(Ticket, pk=self.kwargs.get('ticket_id'))
@@ -959,9 +954,38 @@ class TicketAttachmentAV(ListCreateAPIView):
         """Solo el administrador puede subir archivos."""
         return user.role == User.Role.ADMIN
 
+    def _upload_denied_response(self, user, ticket):
+        """Retorna la respuesta de error si no se puede subir al ticket, o None."""
+        if not user.is_authenticated or not self._check_upload_permission(user, ticket):
+            return Response({
+                'error': 'No autorizado',
+                'message': 'Solo el administrador puede adjuntar archivos a los tickets.'
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        # No se puede adjuntar a un ticket finalizado o cancelado
+        if ticket.estado.es_final:
+            return Response({
+                'error': 'Ticket cerrado',
+                'message': 'No se pueden adjuntar archivos a un ticket finalizado o cancelado.'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        return None
+
+
+class TicketAttachmentAV(TicketAttachmentAccessMixin, ListCreateAPIView):
+    """
+    GET  /api/tickets/<ticket_id>/attachments/  → Lista los adjuntos del ticket.
+    POST /api/tickets/<ticket_id>/attachments/  → Sube un nuevo archivo adjunto.
+
+    Permisos:
+    - Solo el administrador puede subir archivos (POST).
+    - El cliente dueño, el técnico asignado y el administrador pueden ver la lista (GET).
+    - El ticket no debe estar en estado final para permitir subidas.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = TicketAttachmentUploadSerializer
+
     def get_queryset(self):
-        ticket = self._get_ticket()
-        return TicketAttachment.objects.filter(ticket=ticket).select_related('subido_por')
+        return TicketAttachment.objects.filter(ticket_id=self.kwargs.get('ticket_id'))
 
     def list(self, request, *args, **kwargs):
         ticket = self._get_ticket()
@@ -973,12 +997,16 @@ class TicketAttachmentAV(ListCreateAPIView):
                 'message': 'No tiene permiso para ver los adjuntos de este ticket.'
             }, status=status.HTTP_403_FORBIDDEN)
 
-        queryset = self.get_queryset()
-        serializer = TicketAttachmentListSerializer(queryset, many=True, context={'request': request})
+        # Una sola consulta: el total sale de la lista ya cargada
+        adjuntos = list(self.get_queryset().only('id', 'archivo', 'nombre_original'))
+        urls = generar_urls_adjuntos(adjuntos, request)
+        serializer = TicketAttachmentListSerializer(
+            adjuntos, many=True, context={'request': request, 'urls': urls}
+        )
         return Response({
             'message': 'Adjuntos del ticket',
             'ticket_id': ticket.pk,
-            'total_adjuntos': queryset.count(),
+            'total_adjuntos': len(adjuntos),
             'adjuntos': serializer.data,
         }, status=status.HTTP_200_OK)
 
@@ -986,18 +1014,9 @@ class TicketAttachmentAV(ListCreateAPIView):
         ticket = self._get_ticket()
         user = request.user
 
-        if not user.is_authenticated or not self._check_upload_permission(user, ticket):
-            return Response({
-                'error': 'No autorizado',
-                'message': 'Solo el administrador puede adjuntar archivos a los tickets.'
-            }, status=status.HTTP_403_FORBIDDEN)
-
-        # No se puede adjuntar a un ticket finalizado o cancelado
-        if ticket.estado.es_final:
-            return Response({
-                'error': 'Ticket cerrado',
-                'message': 'No se pueden adjuntar archivos a un ticket finalizado o cancelado.'
-            }, status=status.HTTP_400_BAD_REQUEST)
+        denied = self._upload_denied_response(user, ticket)
+        if denied is not None:
+            return denied
 
         serializer = TicketAttachmentUploadSerializer(
             data=request.data,
@@ -1018,3 +1037,86 @@ class TicketAttachmentAV(ListCreateAPIView):
             'message': 'Archivo adjuntado correctamente.',
             'adjunto': read_serializer.data,
         }, status=status.HTTP_201_CREATED)
+
+
+class TicketAttachmentBulkAV(TicketAttachmentAccessMixin, CreateAPIView):
+    """
+    POST /api/tickets/<ticket_id>/attachments/bulk/ → Sube varios archivos a la vez.
+
+    Recibe los archivos en el campo multipart `archivos` (repetido). Cada archivo
+    se valida por separado y la respuesta incluye el resultado de cada uno.
+    Mismos permisos que la subida individual.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = TicketAttachmentBulkUploadSerializer
+
+    def create(self, request, *args, **kwargs):
+        ticket = self._get_ticket()
+        user = request.user
+
+        denied = self._upload_denied_response(user, ticket)
+        if denied is not None:
+            return denied
+
+        serializer = TicketAttachmentBulkUploadSerializer(
+            data=request.data,
+            context={'ticket': ticket, 'subido_por': user, 'request': request}
+        )
+        serializer.is_valid(raise_exception=True)
+        resultados = serializer.save()
+
+        adjuntos = [r['adjunto'] for r in resultados if r['adjunto'] is not None]
+        urls = generar_urls_adjuntos(adjuntos, request)
+        respuesta = []
+        for resultado in resultados:
+            adjunto = resultado['adjunto']
+            respuesta.append({
+                'nombre_original': resultado['nombre_original'],
+                'adjuntado': adjunto is not None,
+                'adjunto': TicketAttachmentCreateResponseSerializer(
+                    adjunto, context={'request': request, 'urls': urls}
+                ).data if adjunto is not None else None,
+                'errores': resultado['errores'],
+            })
+
+        total = len(adjuntos)
+        return Response({
+            'message': f'Se adjuntaron {total} de {len(resultados)} archivos.',
+            'total_adjuntados': total,
+            'total_fallidos': len(resultados) - total,
+            'resultados': respuesta,
+        }, status=status.HTTP_201_CREATED if total else status.HTTP_400_BAD_REQUEST)
+
+
+class TicketAttachmentArchiveAV(TicketAttachmentAccessMixin, APIView):
+    """
+    GET /api/tickets/<ticket_id>/attachments/archive/ → Descarga todos los adjuntos en un ZIP.
+
+    El ZIP se construye al vuelo leyendo cada archivo del storage por bloques
+    (sin archivo temporal). Mismos permisos de lectura que el listado.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        ticket = self._get_ticket()
+        user = request.user
+
+        if not user.is_authenticated or not self._check_read_permission(user, ticket):
+            return Response({
+                'error': 'No autorizado',
+                'message': 'No tiene permiso para ver los adjuntos de este ticket.'
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        adjuntos = list(
+            TicketAttachment.objects.filter(ticket=ticket)
+            .only('id', 'archivo', 'nombre_original', 'tipo_mime', 'tamano_bytes', 'creado_en')
+            .order_by('creado_en', 'id')
+        )
+        # Bajo ASGI un iterador síncrono se lee completo antes de enviarse: se usa el asíncrono
+        if isinstance(request._request, ASGIRequest):
+            contenido = generar_zip_adjuntos_async(adjuntos)
+        else:
+            contenido = generar_zip_adjuntos(adjuntos)
+        response = StreamingHttpResponse(contenido, content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="ticket_{ticket.pk}_adjuntos.zip"'
+        return response
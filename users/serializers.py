@@ -260,16 +260,21 @@ class AdminUpdateUserSerializer (serializers.ModelSerializer):
                 StateChangeRequest.objects.filter(approved_by_id=old_document).update(approved_by=new_user)
                 
                 # Actualizar referencias en Notification
-                from notifications.models import Notification
+                from notifications.models import (
+                    Notification, NotificationCounter, NotificationDelivery, NotificationPreference,
+                )
                 Notification.objects.filter(usuario_id=old_document).update(usuario=new_user)
                 Notification.objects.filter(enviado_por_id=old_document).update(enviado_por=new_user)
                 
-                # Actualizar ManyToMany en Notification (destinatarios)
-                # Obtener todas las notificaciones que tienen al usuario antiguo como destinatario
-                notifications_with_user = Notification.objects.filter(destinatarios=old_document)
-                for notification in notifications_with_user:
-                    notification.destinatarios.remove(instance)
-                    notification.destinatarios.add(new_user)
+                # Actualizar ManyToMany en Notification (destinatarios) directamente en la
+                # tabla intermedia: remove/add recrearía las entregas y perdería su estado
+                Notification.destinatarios.through.objects.filter(user_id=old_document).update(user_id=new_user.pk)
+                
+                # Mover las entregas (estado de lectura por usuario) y la preferencia de correo;
+                # si no, el borrado del usuario antiguo las elimina en cascada
+                NotificationDelivery.objects.filter(usuario_id=old_document).update(usuario=new_user)
+                NotificationPreference.objects.filter(usuario_id=old_document).update(usuario=new_user)
+                NotificationCounter.recalcular([new_user.pk])
                 
                 # Eliminar el usuario antiguo
                 instance.delete()
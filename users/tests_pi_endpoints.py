@@ -2,6 +2,8 @@ from django.urls import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
 from users.models import User
+from notifications import registry
+from notifications.models import Notification, NotificationDelivery
 
 class UserEndpointsTests(APITestCase):
     def setUp(self):
@@ -55,3 +57,37 @@ class UserEndpointsTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.client_user.refresh_from_db()
         self.assertFalse(self.client_user.is_active)
+
+    def test_change_document_keeps_notification_inbox(self):
+        """Al cambiar el documento el usuario conserva sus notificaciones y su estado de lectura"""
+        tipo = registry.obtener_tipo('ticket_creado')
+        propia = Notification.objects.create(
+            usuario=self.client_user, tipo=tipo, titulo='Propia', mensaje='M', estado=Notification.Estado.ENVIADA
+        )
+        compartida = Notification.objects.create(
+            usuario=self.admin, tipo=tipo, titulo='Compartida', mensaje='M', estado=Notification.Estado.ENVIADA
+        )
+        compartida.destinatarios.add(self.client_user)
+        compartida.marcar_como_leida(self.client_user)
+
+        self.client.force_authenticate(user=self.admin)
+        url = reverse('admin-update-user', args=[self.client_user.document])
+        response = self.client.patch(url, {
+            'document': 'client_02', 'email': 'client_users2@test.com', 'number': '3001234567',
+            'role': User.Role.CLIENT, 'is_active': True, 'first_name': 'Cliente', 'last_name': 'Prueba',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(NotificationDelivery.objects.filter(usuario_id='client_01').exists())
+
+        nuevo = User.objects.get(document='client_02')
+        self.client.force_authenticate(user=nuevo)
+        response = self.client.get(reverse('notifications:notification-list'), HTTP_ACCEPT='application/json')
+        self.assertEqual(sorted(n['id'] for n in response.data), sorted([propia.pk, compartida.pk]))
+
+        stats = self.client.get(reverse('notifications:notification-stats'), HTTP_ACCEPT='application/json').data
+        self.assertEqual((stats['total'], stats['leidas'], stats['no_leidas']), (2, 1, 1))
+
+        detalle = self.client.get(reverse('notifications:notification-detail', args=[compartida.pk]))
+        self.assertEqual(detalle.status_code, status.HTTP_200_OK)
+        marcar = self.client.patch(reverse('notifications:notification-mark-read', args=[propia.pk]))
+        self.assertEqual(marcar.status_code, status.HTTP_200_OK)